@@ -6,8 +6,10 @@ from .collecting_society import *
 from .account import *
 from .account_invoice import *
 from .party import *
+from .product import *
 from .web_user import *
 from .configuration import *
+from .ir import *
 
 
 def register():
@@ -19,12 +21,16 @@ def register():
         AccessRole,
         AccessRolePermission,
         AccessControlEntryRole,
+        AccessControlEffective,
         CollectingSociety,
         Artist,
         ArtistArtist,
         ArtistPayeeAcceptance,
         ArtistIdentifierSpace,
         ArtistIdentifier,
+        Account,
+        AccountTax,
+        AccountConfiguration,
         AccountMove,
         AccountMoveLine,
         AllocationAccountInvoice,
@@ -114,6 +120,7 @@ def register():
         DeviceMessageFingerprintMergeSelect,
         DeviceMessageUsagereport,
         Distribution,
+        DistributionPocket,
         DistributionPlan,
         Collection,
         Allocation,
@@ -123,7 +130,10 @@ def register():
         DeclarationCollection,
         Utilisation,
         DistributeStart,
+        DistributeReport,
         Configuration,
+        Sequence,
+        Cron,
         PartyIdentifierSpace,
         PartyIdentifier,
         Party,
@@ -131,6 +141,9 @@ def register():
         ContactMechanism,
         Category,
         Address,
+        ProductTemplate,
+        Product,
+        ProductCategory,
         module='collecting_society', type_='model')
     Pool.register(
         Collect,
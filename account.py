@@ -2,9 +2,14 @@
 # Repository: https://github.com/C3S/collecting_society
 from trytond.model import fields
 from trytond.pool import PoolMeta
-from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model.exceptions import AccessError
 
-__all__ = ['AccountMove', 'AccountMoveLine']
+from .product import clear_invoice_line_templates
+
+__all__ = [
+    'Account', 'AccountTax', 'AccountConfiguration',
+    'AccountMove', 'AccountMoveLine']
 
 
 # class AccountTemplate:
@@ -25,6 +30,43 @@ __all__ = ['AccountMove', 'AccountMoveLine']
 #         cls.kind.selection += [('hat', 'Hat'), ('pocket', 'Pocket')]
 
 
+class Account(metaclass=PoolMeta):
+    __name__ = 'account.account'
+
+    @classmethod
+    def write(cls, *args):
+        super(Account, cls).write(*args)
+        clear_invoice_line_templates()
+
+    @classmethod
+    def delete(cls, accounts):
+        super(Account, cls).delete(accounts)
+        clear_invoice_line_templates()
+
+
+class AccountTax(metaclass=PoolMeta):
+    __name__ = 'account.tax'
+
+    @classmethod
+    def write(cls, *args):
+        super(AccountTax, cls).write(*args)
+        clear_invoice_line_templates()
+
+    @classmethod
+    def delete(cls, taxes):
+        super(AccountTax, cls).delete(taxes)
+        clear_invoice_line_templates()
+
+
+class AccountConfiguration(metaclass=PoolMeta):
+    __name__ = 'account.configuration'
+
+    @classmethod
+    def write(cls, *args):
+        super(AccountConfiguration, cls).write(*args)
+        clear_invoice_line_templates()
+
+
 class AccountMove(metaclass=PoolMeta):
     __name__ = 'account.move'
 
@@ -48,10 +90,12 @@ class AccountMoveLine(metaclass=PoolMeta):
 
     # Cannot use super here as we need to remove only one check
     # of this method from module account
-    def check_account(self):
-        if self.account.kind in ('view',):
-            raise UserError(
-                'move_view_account', (self.account.rec_name,))
-        if not self.account.active:
-            raise UserError(
-                'move_inactive_account', (self.account.rec_name,))
+    @classmethod
+    def check_account(cls, lines, field_names=None):
+        if field_names and not (field_names & {'account', 'party'}):
+            return
+        for line in lines:
+            if not line.account.type or line.account.closed:
+                raise AccessError(
+                    gettext('account.msg_line_closed_account',
+                            account=line.account.rec_name))
@@ -2,28 +2,45 @@
 # Repository: https://github.com/C3S/collecting_society
 import sys
 import os
+import io
+import csv
+import copy
 import uuid
 import datetime
 import requests
 import json
+import logging
+import multiprocessing
+import math
 from decimal import Decimal
+from fractions import Fraction
 from dateutil.relativedelta import relativedelta
 from collections import Counter, defaultdict
-from typing import Protocol, Any
-from sql import Table
-from sql.functions import CharLength
+from concurrent.futures import ThreadPoolExecutor
+from typing import Protocol, Any, Optional
+from weakref import WeakKeyDictionary
+from sql import Table, With, Cast, Literal, Null
+from sql.aggregate import Count, Sum, Max, Min
+from sql.conditionals import Case, Coalesce
+from sql.functions import CharLength, Substring, Position, \
+    CurrentTimestamp, Function
+from sql.operators import Concat, Exists
 import hurry.filesize
 
-from trytond.model import ModelView, ModelSQL, fields, Unique
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields, Unique, Index
 from trytond.model.model import ModelMeta
 from trytond.model.fields import Field
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.wizard import Wizard, StateView, Button, StateTransition,  \
     StateAction
 from trytond.exceptions import UserError, UserWarning
 
 from trytond.transaction import Transaction
 from trytond.pool import Pool
-from trytond.pyson import Eval, Bool, Or, And
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.pyson import Eval, Bool, Or, And, PYSONEncoder, PYSONDecoder
 
 
 __all__ = [
@@ -37,6 +54,7 @@ __all__ = [
     'PublicApi',
     'CurrencyDigits',
     'AccessControlList',
+    'AccessControlCaches',
 
     # Collecting Society
     'CollectingSociety',
@@ -56,8 +74,10 @@ __all__ = [
     'AllocationInvoice',
     'Collection',
     'Distribution',
+    'DistributionPocket',
     'DistributionPlan',
     'DistributeStart',
+    'DistributeReport',
     'Distribute',
     'EventIndicators',
     'LocationIndicators',
@@ -151,6 +171,7 @@ __all__ = [
     # Portal
     'AccessControlEntry',
     'AccessControlEntryRole',
+    'AccessControlEffective',
     'AccessRole',
     'AccessRolePermission',
     'AccessPermission',
@@ -166,6 +187,48 @@ STATES = {
 DEPENDS = ['active']
 SEPARATOR = ' /25B6 '
 DEFAULT_ACCESS_ROLES = ['Administrator', 'Stakeholder']
+COLLECT_CHUNK_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteDateTime(Function):
+    'SQLite function to convert dates, which are stored as text'
+    __slots__ = ()
+    _function = 'DATETIME'
+
+
+class _TransactionMemo(dict):
+    'Dictionary to memoize values for the rest of a transaction'
+
+
+# memos by transaction, which hold the weakly referenced transaction caches
+_transaction_memos = WeakKeyDictionary()
+
+
+def _transaction_memo(name):
+    """
+    Returns a dictionary to memoize values for the rest of the transaction
+
+    The memo is also registered in the cache of the transaction, which is
+    cleared on commit and rollback.
+    """
+    transaction = Transaction()
+    memos = _transaction_memos.setdefault(transaction, {})
+    memo = memos.get(name)
+    if memo is None:
+        memo = memos[name] = _TransactionMemo()
+        transaction.cache[('collecting_society', name)] = memo
+    return memo
+
+
+def _clear_transaction_memo(name):
+    """
+    Clears the memoized values of the transaction, see _transaction_memo
+    """
+    memo = _transaction_memos.get(Transaction(), {}).get(name)
+    if memo is not None:
+        memo.clear()
 
 
 ##############################################################################
@@ -362,29 +425,334 @@ class AccessControlList:
         states=STATES, depends=DEPENDS,
         help='A list of acces control entries with object permissions.')
 
+    @classmethod
+    def get_permission_bits(cls, web_user, entities):
+        """
+        Returns the permission bitsets of a web user for entities
+
+        The roles of all entities not memoized yet are read with one join over
+        the ACEs and their roles and combined to a bitset of permission codes
+        (see AccessRole.get_permission_bits). The result is memoized for the
+        rest of the transaction, so a list of entities can be resolved upfront
+        for all later checks of its rows.
+
+        Args:
+            web_user: the web user (or its id)
+            entities: iterable of entities with an ACL
+
+        Returns:
+            dict of entity reference (str) to bitset (int)
+        """
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+
+        web_user_id = getattr(web_user, 'id', web_user)
+        keys = [str(entity) for entity in entities]
+        if web_user_id is None:
+            return dict.fromkeys(keys, 0)
+        memo = _transaction_memo('ace.permission_bits')
+        missing = {k for k in keys if (web_user_id, k) not in memo}
+        if missing:
+            Entry = pool.get('ace')
+            EntryRole = pool.get('ace-ace.role')
+            entry = Entry.__table__()
+            entry_role = EntryRole.__table__()
+            cursor = Transaction().connection.cursor()
+
+            _, role_bits = AccessRole.get_permission_bits()
+            bits = dict.fromkeys(missing, 0)
+            for sub_keys in grouped_slice(sorted(missing)):
+                cursor.execute(*entry.join(
+                        entry_role, condition=entry_role.ace == entry.id
+                        ).select(
+                        entry.entity, entry_role.role,
+                        where=(entry.web_user == web_user_id)
+                        & entry.entity.in_(list(sub_keys))))
+                for entity, role in cursor:
+                    bits[entity] |= role_bits.get(role, 0)
+            for key in missing:
+                memo[(web_user_id, key)] = bits[key]
+        return {key: memo[(web_user_id, key)] for key in keys}
+
+    @classmethod
+    def get_permission_codes(cls, web_user, entities):
+        """
+        Returns the permission codes of a web user for entities
+
+        Args:
+            web_user: the web user (or its id)
+            entities: iterable of entities with an ACL
+
+        Returns:
+            dict of entity reference (str) to frozenset of permission codes
+        """
+        AccessRole = Pool().get('ace.role')
+        code_bits, _ = AccessRole.get_permission_bits()
+        return {
+            key: frozenset(c for c, bit in code_bits.items() if bits & bit)
+            for key, bits in cls.get_permission_bits(
+                web_user, entities).items()}
+
     def permits(self, web_user, code, derive=True):
-        for ace in self.acl:
-            if ace.web_user != web_user:
-                continue
-            for role in ace.roles:
-                for permission in role.permissions:
-                    if permission.code == code:
-                        return True
-        return False
+        AccessRole = Pool().get('ace.role')
+        code_bits, _ = AccessRole.get_permission_bits()
+        bits = self.get_permission_bits(web_user, [self])[str(self)]
+        return bool(bits & code_bits.get(code, 0))
 
     def permissions(self, web_user, valid_codes=[], derive=True):
-        permissions = set()
-        for ace in self.acl:
-            if ace.web_user != web_user:
-                continue
-            permissions.update([
-                permission.code
-                for role in ace.roles
-                for permission in role.permissions])
+        permissions = self.get_permission_codes(web_user, [self])[str(self)]
         if valid_codes:
             permissions = permissions.intersection(valid_codes)
         return tuple(permissions)
 
+    @classmethod
+    def search_permitted(cls, web_user, code, domain=None, offset=0,
+                         limit=None, order=None, count=False):
+        """
+        Searches the entities, for which a web user has a permission code
+
+        The permission is checked by an SQL subquery in the database, so the
+        entities can be filtered, ordered and paginated like with search().
+
+        Args:
+            web_user: the web user (or its id)
+            code: the permission code, e.g. 'view_creation'
+            domain: the domain to filter the entities additionally
+
+        Returns:
+            list of entities or their count, see search()
+        """
+        Effective = Pool().get('ace.effective')
+        if Effective.enabled():
+            query = Effective.permitted_query(cls, web_user, code)
+        else:
+            query = cls._permitted_query(web_user, code)
+        return cls.search([
+                domain or [],
+                ('id', 'in', query),
+                ], offset=offset, limit=limit, order=order, count=count)
+
+    @classmethod
+    def _permitted_query(cls, web_user, code):
+        """
+        Returns an SQL query of the IDs of the entities, for which the web
+        user has the permission code in their ACEs
+
+        Entities with derived permissions extend the query.
+        """
+        pool = Pool()
+        Entry = pool.get('ace')
+        EntryRole = pool.get('ace-ace.role')
+        RolePermission = pool.get('ace.role-ace.permission')
+        Permission = pool.get('ace.permission')
+        entry = Entry.__table__()
+        entry_role = EntryRole.__table__()
+        role_permission = RolePermission.__table__()
+        permission = Permission.__table__()
+
+        return entry.join(
+            entry_role, condition=entry_role.ace == entry.id
+            ).join(
+            role_permission,
+            condition=role_permission.role == entry_role.role
+            ).join(
+            permission,
+            condition=permission.id == role_permission.permission
+            ).select(
+            Cast(
+                Substring(
+                    entry.entity,
+                    Position(',', entry.entity) + Literal(1)),
+                cls.id.sql_type().base),
+            where=(entry.web_user == getattr(web_user, 'id', web_user))
+            & (permission.code == code)
+            & entry.entity.like(cls.__name__ + ',%'))
+
+    @classmethod
+    def create_default_aces(cls, records):
+        """
+        Creates the ACEs with the default roles for new records
+
+        Records, which were created with an ACL, are skipped. The web users to
+        grant the default roles (see _get_default_ace_queries) are read for
+        all records with one query per source and the ACEs are created with
+        one call.
+
+        Returns:
+            list of the created ACEs
+        """
+        Entry = Pool().get('ace')
+        entry = Entry.__table__()
+        cursor = Transaction().connection.cursor()
+
+        with_acl = set()
+        for sub_records in grouped_slice(records):
+            cursor.execute(*entry.select(
+                    entry.entity,
+                    where=entry.entity.in_([str(r) for r in sub_records]),
+                    group_by=[entry.entity]))
+            with_acl.update(e for e, in cursor)
+        ids = [r.id for r in records if str(r) not in with_acl]
+
+        web_users = set()
+        for sub_ids in grouped_slice(ids):
+            for query in cls._get_default_ace_queries(list(sub_ids)):
+                cursor.execute(*query)
+                web_users.update(cursor)
+        if not web_users:
+            return []
+        roles = [('add', Entry.get_default_role_ids())]
+        return Entry.create([{
+                    'entity': '%s,%s' % (cls.__name__, record_id),
+                    'web_user': web_user,
+                    'roles': roles,
+                    } for record_id, web_user in sorted(web_users)])
+
+    @classmethod
+    def _get_default_ace_queries(cls, ids):
+        """
+        Returns SQL queries of the IDs of records and the web users, which
+        get the default roles on creation
+
+        By default, the creator of a record gets the default roles.
+        """
+        UserParty = Pool().get('web.user-party.party')
+        table = cls.__table__()
+        user_party = UserParty.__table__()
+        return [
+            table.join(
+                user_party, condition=user_party.party == table.entity_creator
+                ).select(
+                table.id, user_party.user,
+                where=reduce_ids(table.id, ids)),
+            ]
+
+    def _get_effective_codes(self, web_user):
+        """
+        Returns the materialized permission codes of a web user including the
+        derived ones, or None if the permissions are not materialized
+        """
+        Effective = Pool().get('ace.effective')
+        if not Effective.enabled():
+            return None
+        return Effective.get_permission_codes(web_user, [self])[str(self)]
+
+    @classmethod
+    def _get_effective_permissions(cls, records):
+        """
+        Returns the permissions of all web users in the ACEs of records
+
+        Entities with derived permissions extend the permissions.
+
+        Returns:
+            set of tuples of web user ID (int), entity reference (str) and
+            permission code (str)
+        """
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Entry = pool.get('ace')
+        EntryRole = pool.get('ace-ace.role')
+        entry = Entry.__table__()
+        entry_role = EntryRole.__table__()
+        cursor = Transaction().connection.cursor()
+
+        code_bits, role_bits = AccessRole.get_permission_bits()
+        bits = defaultdict(int)
+        for sub_records in grouped_slice(records):
+            cursor.execute(*entry.join(
+                    entry_role, condition=entry_role.ace == entry.id
+                    ).select(
+                    entry.web_user, entry.entity, entry_role.role,
+                    where=entry.entity.in_([str(r) for r in sub_records])))
+            for web_user, entity, role in cursor:
+                bits[(web_user, entity)] |= role_bits.get(role, 0)
+        return {
+            (web_user, entity, code)
+            for (web_user, entity), entity_bits in bits.items()
+            for code, bit in code_bits.items() if entity_bits & bit}
+
+    @classmethod
+    def _get_derived_effective_permissions(cls, entity_artists):
+        """
+        Returns the permissions derived from the permissions on artists
+
+        Args:
+            entity_artists: dict of entity reference (str) to list of artist
+                IDs (int)
+
+        Returns:
+            set of tuples, see _get_effective_permissions
+        """
+        Artist = Pool().get('artist')
+        derivation = {v: k for k, v in cls._derived_permissions.items()}
+        artist_entities = defaultdict(list)
+        for entity, artist_ids in entity_artists.items():
+            for artist_id in artist_ids:
+                artist_entities['artist,%s' % artist_id].append(entity)
+        artists = Artist.browse(
+            {int(a.split(',')[1]) for a in artist_entities})
+        return {
+            (web_user, entity, derivation[code])
+            for web_user, artist, code in Artist._get_effective_permissions(
+                artists)
+            if code in derivation for entity in artist_entities[artist]}
+
+
+class AccessControlCaches:
+    'Mixin to clear the caches of the access control on modifications'
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls.clear_access_control_caches()
+        cls._update_effective_permissions(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        records = [r for records in args[::2] for r in records]
+        entities = cls._get_effective_entities(records)
+        super().write(*args)
+        cls.clear_access_control_caches()
+        cls._update_effective_permissions(records, entities)
+
+    @classmethod
+    def delete(cls, records):
+        entities = cls._get_effective_entities(records)
+        super().delete(records)
+        cls.clear_access_control_caches()
+        cls._update_effective_permissions([], entities)
+
+    @classmethod
+    def clear_access_control_caches(cls):
+        '''
+        Clears the permissions memoized in the transaction
+
+        The models of roles and permissions clear the cached role bitsets,
+        too (see AccessRole.get_permission_bits).
+        '''
+        _clear_transaction_memo('ace.permission_bits')
+        _clear_transaction_memo('ace.effective')
+
+    @classmethod
+    def _get_effective_entities(cls, records):
+        """
+        Returns the references of the entities, whose effective permissions
+        depend on the records, or None for all entities
+        """
+        return None
+
+    @classmethod
+    def _update_effective_permissions(cls, records, entities=()):
+        Effective = Pool().get('ace.effective')
+        if not Effective.enabled():
+            return
+        if entities is not None:
+            current = cls._get_effective_entities(records)
+            entities = None if current is None else current | set(entities)
+        Effective.update(entities)
+
 
 ##############################################################################
 # Collecting Society
@@ -454,10 +822,7 @@ class TariffSystem(ModelSQL, ModelView, CurrentState):
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.tariff_system_sequence.get()
+        Configuration.set_codes(vlist, 'tariff_system_sequence')
         return super().create(vlist)
 
     @classmethod
@@ -515,6 +880,9 @@ class TariffCategory(ModelSQL, ModelView, CurrentState, PublicApi):
         help="The product which represents the distribution amount of the "
         "tariff.")
 
+    _invoice_line_templates_cache = Cache(
+        'tariff_system.category.invoice_line_templates', context=False)
+
     # creations = fields.Many2Many(
     #     'creation-tariff_category', 'category', 'Creations',
     #     help='The creations in this tariff category.')
@@ -549,6 +917,87 @@ class TariffCategory(ModelSQL, ModelView, CurrentState, PublicApi):
             ('code',) + tuple(clause[1:]),
         ]
 
+    @classmethod
+    def write(cls, *args):
+        Utilisation = Pool().get('utilisation')
+        super().write(*args)
+        cls._invoice_line_templates_cache.clear()
+        # the start and end of utilisations depend on the category code
+        categories = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'code' in values for r in records]
+        if categories:
+            with Transaction().set_context(active_test=False):
+                Utilisation.update_start_end(Utilisation.search([
+                            ('tariff.category', 'in',
+                                [c.id for c in categories]),
+                            ]))
+
+    @classmethod
+    def delete(cls, categories):
+        super().delete(categories)
+        cls._invoice_line_templates_cache.clear()
+
+    @classmethod
+    def get_invoice_line_templates(cls, categories):
+        '''
+        Returns the invoice line templates for each tariff category id
+
+        The templates are cached per company, until a tariff category, a
+        product, an account, a tax or the account configuration is modified
+        (see _get_invoice_line_templates).
+        '''
+        company = Transaction().context.get('company')
+        templates = {}
+        for category in categories:
+            key = (category.id, company)
+            lines = cls._invoice_line_templates_cache.get(key)
+            if lines is None:
+                lines = category._get_invoice_line_templates()
+                cls._invoice_line_templates_cache.set(key, lines)
+            templates[category.id] = lines
+        return templates
+
+    def _get_invoice_line_templates(self):
+        '''
+        Returns the invoice line values, which are common to all utilisations
+        of the tariff category
+
+        Each template is a tuple of the name of the utilisation field holding
+        the unit price and the invoice line values.
+        '''
+        products = [
+            ('Distribution', 'confirmed_distribution_amount',
+                self.distribution_product),
+            ('Administration', 'confirmed_administration_fee',
+                self.administration_product),
+        ]
+        if not all(product for _, _, product in products):
+            raise UserError(
+                'Missing Tariff Product',
+                'The tariff category "%s" is missing a distribution '
+                'product or administration product.' % self.rec_name)
+        templates = []
+        for description, price_field, product in products:
+            account = product.account_revenue_used
+            if not account:
+                raise UserError(
+                    'Missing Account Revenue',
+                    'The product "%s" misses a revenue account.' %
+                    product.rec_name)
+            templates.append((price_field, {
+                'type': 'line',
+                'product': product.id,
+                'account': account.id,
+                'description': description,
+                'quantity': 1,
+                'unit': product.default_uom.id,
+                'unit_price': product.list_price,
+                'taxes': tuple(t.id for t in product.customer_taxes_used),
+                'invoice_type': 'out',
+                }))
+        return tuple(templates)
+
 
 class TariffAdjustmentCategory(ModelSQL, ModelView, CurrentState):
     'Tariff Adjustment Category'
@@ -728,6 +1177,20 @@ class Tariff(ModelSQL, ModelView, CurrentState, PublicApi):
     category = fields.Many2One(
         'tariff_system.category', 'Category', required=True)
 
+    @classmethod
+    def write(cls, *args):
+        Utilisation = Pool().get('utilisation')
+        super().write(*args)
+        # the start and end of utilisations depend on the category code
+        tariffs = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'category' in values for r in records]
+        if tariffs:
+            with Transaction().set_context(active_test=False):
+                Utilisation.update_start_end(Utilisation.search([
+                            ('tariff', 'in', [t.id for t in tariffs]),
+                            ]))
+
     def get_name(self, name):
         return self.category.name
 
@@ -762,6 +1225,13 @@ class Collection(ModelSQL, ModelView):
     locked = fields.Boolean(
         'Locked', states={'readonly': True},
         help='Locked state for processing purposes')
+    domain = fields.Char(
+        'Domain', states={'readonly': True},
+        help='The encoded domain of the utilisations to collect')
+    cursor = fields.Integer(
+        'Cursor', states={'readonly': True},
+        help='The id of the last collected utilisation, to resume an '
+        'interrupted collection run')
 
     date = fields.Date(
         'Collection Date', required=True,
@@ -801,78 +1271,323 @@ class Collection(ModelSQL, ModelView):
     def default_uuid():
         return str(uuid.uuid4())
 
-    def __collect_finish_allocation(self, allocation: 'Allocation',
-                                    utilisations: list['Utilisation']) -> None:
+    def _get_allocation_values(self, licensee: int,
+                               utilisations: list[int]) -> dict:
         """
-        just a helper for collect(); see below'
+        just a helper for collect(); see below
 
         Args:
-            allocation:   the Allocation record to finish before continuing
-                          with the next licensee
-            utilisations: list of Utlisisation IDs (int) of utilisations that
-                          are associated with this licensee resp. allocation to
-                          be assigned to the allocation and cleared afterwards
+            licensee:     the id of the licensee party of the allocation
+            utilisations: list of Utilisation IDs (int) associated with the
+                          licensee
+
+        Returns:
+            the values to create the allocation for the licensee
         """
-        allocation.utilisations = utilisations
-        allocation.save()
-        utilisations.clear()
-        allocation.create_invoice()  # TODO: on error reset 'invoiced' state
+        # TODO: calculate the amounts from the utilisation indicators
+        return {
+            # the default is computed only once per create call
+            'uuid': str(uuid.uuid4()),
+            'state': 'calculated',  # 'invoiced'
+            'licensee': licensee,
+            'invoice_amount': len(utilisations),
+            'distribution_amount': Decimal('0.9') * len(utilisations),
+            'administration_fee': Decimal('0.1') * len(utilisations),
+            'collection': self.id,
+        }
 
-    def collect(self, from_utilisations: tuple['Utilisation', ...]) -> None:
+    def collect(self, from_utilisations: tuple['Utilisation', ...]
+                ) -> list['Allocation']:
         """
         collects money from licensees
 
-        scans utilisations and creates allocations to invoice the respective
-        licensees
+        groups the utilisations by licensee in the database and creates one
+        allocation per licensee to invoice the respective licensees; the
+        number of queries grows with the number of licensees, not with the
+        number of utilisations
+
+        Note: the collection needs to be saved before
+
+        Args:
+            from_utilisations: utilisations (or their ids) to collect from
+
+        Returns:
+            the created allocations
+        """
+        pool = Pool()
+        Allocation = pool.get('allocation')
+        Utilisation = pool.get('utilisation')
+        utilisation = Utilisation.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # group utilisation ids by licensee
+        licensee_utilisations = defaultdict(list)
+        for sub_ids in grouped_slice([int(u) for u in from_utilisations]):
+            cursor.execute(*utilisation.select(
+                    utilisation.licensee, utilisation.id,
+                    where=reduce_ids(utilisation.id, sub_ids),
+                    order_by=[utilisation.licensee, utilisation.id]))
+            for licensee, utilisation_id in cursor:
+                licensee_utilisations[licensee].append(utilisation_id)
+        if not licensee_utilisations:
+            return []
+
+        # one allocation for each licensee
+        licensees = sorted(licensee_utilisations)
+        allocations = Allocation.create([
+            self._get_allocation_values(
+                licensee, licensee_utilisations[licensee])
+            for licensee in licensees])
+
+        # assign utilisations to their allocation
+        to_write = []
+        for licensee, allocation in zip(licensees, allocations):
+            to_write.extend((
+                Utilisation.browse(licensee_utilisations[licensee]),
+                {'allocation': allocation.id}))
+        Utilisation.write(*to_write)
+
+        # TODO: on error reset 'invoiced' state
+        Allocation.create_invoices(allocations)
+        return allocations
+
+    def collect_chunks(self, chunk_size: int = COLLECT_CHUNK_SIZE) -> None:
+        """
+        collects money from licensees for all utilisations matching the
+        domain of the collection
+
+        processes the uncollected utilisations in chunks ordered by id and
+        commits after each chunk. The id of the last collected utilisation
+        is saved as cursor, so an interrupted collection run can be resumed
+        by calling this method again. The collection is locked until all
+        chunks are processed.
 
         Args:
-            from_utilisations: utilisations to collect from
+            chunk_size: the maximum number of utilisations per chunk
+        """
+        Utilisation = Pool().get('utilisation')
+        transaction = Transaction()
+
+        domain = PYSONDecoder().decode(self.domain) if self.domain else []
+        self.locked = True
+        self.save()
+        while True:
+            utilisations = Utilisation.search([
+                    domain,
+                    ('allocation', '=', None),
+                    ('id', '>', self.cursor or 0),
+                    ], limit=chunk_size, order=[('id', 'ASC')])
+            if not utilisations:
+                break
+            self.collect(utilisations)
+            self.cursor = utilisations[-1].id
+            self.save()
+            transaction.commit()
+        self.locked = False
+        self.save()
+
+    def _get_licensee_partitions(self, count: int) -> list[list[int]]:
         """
-        Allocation = Pool().get('allocation')
-        from_utilisations_by_licensee = sorted(from_utilisations,
-                                               key=lambda x: x.licensee)
-        current_allocation: AllocationAlias | None = None
-        current_utilisations: list['Utilisation'] = []
-        for utilisation in from_utilisations_by_licensee:  # one allocation for
-            if (current_allocation is None or              # each new licensee
-                    utilisation.licensee != current_allocation.licensee):
-                if current_allocation is not None:       # finish old allo-
-                    self.__collect_finish_allocation(current_allocation,
-                                                     current_utilisations)
-                current_licensee = utilisation.licensee  # cation before
-                new_allocation: AllocationAlias = Allocation()  # new instance
-                new_allocation.state = 'calculated'  # 'invoiced'      new one
-                new_allocation.licensee = current_licensee
-                new_allocation.invoice_amount = 0
-                new_allocation.distribution_amount = 0
-                new_allocation.administration_fee = 0
-                new_allocation.collection = self
-                current_allocation = new_allocation
-
-            # add utilisation to allocation and increase amounts
-            current_utilisations.append(utilisation.id)
-            current_allocation.invoice_amount = (
-                    current_allocation.invoice_amount + 1)
-            current_allocation.distribution_amount = (
-                    current_allocation.distribution_amount + Decimal('0.9'))
-            current_allocation.administration_fee = (
-                    current_allocation.administration_fee + Decimal('0.1'))
-
-        if current_allocation is not None:  # finish last allocation
-            self.__collect_finish_allocation(current_allocation,
-                                             current_utilisations)
+        just a helper for collect_parallel(); see below
+
+        Partitions the licensees of the uncollected utilisations matching the
+        domain of the collection. The licensees with the most utilisations
+        are added first to the partition with the least utilisations.
+
+        Args:
+            count: the maximum number of partitions
+
+        Returns:
+            list of partitions, each a list of licensee IDs (int)
+        """
+        Utilisation = Pool().get('utilisation')
+        utilisation = Utilisation.__table__()
+        cursor = Transaction().connection.cursor()
+
+        domain = PYSONDecoder().decode(self.domain) if self.domain else []
+        query = Utilisation.search(
+            [domain, ('allocation', '=', None)], query=True)
+        cursor.execute(*utilisation.select(
+                utilisation.licensee, Count(utilisation.id),
+                where=utilisation.id.in_(query),
+                group_by=[utilisation.licensee]))
+        partitions = [[] for _ in range(max(count, 1))]
+        sizes = [0] * len(partitions)
+        for licensee, size in sorted(
+                cursor, key=lambda row: row[1], reverse=True):
+            index = sizes.index(min(sizes))
+            partitions[index].append(licensee)
+            sizes[index] += size
+        return [partition for partition in partitions if partition]
+
+    def collect_parallel(self, workers: Optional[int] = None,
+                         chunk_size: int = COLLECT_CHUNK_SIZE,
+                         database_name: Optional[str] = None
+                         ) -> list['Allocation']:
+        """
+        collects money from licensees for all utilisations matching the
+        domain of the collection on a pool of worker processes
+
+        The allocations of different licensees are independent, so the
+        licensees are partitioned and each partition is collected by a worker
+        process in its own database transaction (see _collect_partition).
+        The collection is locked and committed before the workers start and
+        unlocked after the results of all workers are merged. If a worker
+        fails, the collection stays locked and can be resumed.
+
+        The workers are started with the configuration loaded by the current
+        process and the database passed explicitly, as the configuration file
+        may have been given on the command line. Without more than one worker
+        or partition, or if the database is not shared with other processes,
+        the collection is run with collect_chunks() in the current process.
+
+        Args:
+            workers:       the number of worker processes, defaults to the
+                           configured number of collection workers
+            chunk_size:    the maximum number of utilisations per chunk
+            database_name: the name of the database, defaults to the
+                           database of the current transaction
+
+        Returns:
+            the created allocations
+        """
+        pool = Pool()
+        Allocation = pool.get('allocation')
+        Configuration = pool.get('collecting_society.configuration')
+        transaction = Transaction()
+
+        if workers is None:
+            workers = Configuration.get_cached().collection_workers or 1
+        if database_name is None:
+            database_name = transaction.database.name
+        # in-memory databases are not shared with other processes
+        if workers > 1 and database_name in (None, '', ':memory:'):
+            logger.warning(
+                'collecting %s serially, as the database %r is not shared '
+                'with worker processes', self.rec_name, database_name)
+            workers = 1
+        partitions = self._get_licensee_partitions(workers)
+        if len(partitions) <= 1:
+            collected = [a.id for a in self.allocations]
+            self.collect_chunks(chunk_size)
+            return Allocation.search([
+                    ('collection', '=', self.id),
+                    ('id', 'not in', collected),
+                    ])
+
+        self.locked = True
+        self.save()
+        transaction.commit()
+        options = {
+            section: dict(config.items(section))
+            for section in config.sections()}
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(len(partitions)) as processes:
+            results = processes.starmap(_collect_partition, [(
+                        options, database_name, transaction.user,
+                        dict(transaction.context), self.id, licensees,
+                        chunk_size)
+                for licensees in partitions])
+        self.locked = False
+        self.save()
+        return Allocation.browse([id_ for ids in results for id_ in ids])
+
+
+def _collect_partition(options: dict, database_name: str, user: int,
+                       context: dict, collection_id: int,
+                       licensees: list[int], chunk_size: int) -> list[int]:
+    """
+    collects the utilisations of a partition of licensees in a worker process
+
+    just a helper for Collection.collect_parallel(); see above. The worker
+    loads the passed configuration options and the pool of the passed database
+    on its own and collects in chunks, committing after each chunk.
+
+    Returns:
+        list of Allocation IDs (int) created by the worker
+    """
+    config.read_dict(options)
+    Pool.start()
+    pool = Pool(database_name)
+    with Transaction().start(
+            database_name, user, context=context) as transaction:
+        pool.init()
+        Collection = pool.get('collection')
+        Utilisation = pool.get('utilisation')
+
+        collection = Collection(collection_id)
+        domain = [
+            PYSONDecoder().decode(collection.domain)
+            if collection.domain else [],
+            ('licensee', 'in', licensees),
+            ('allocation', '=', None),
+        ]
+        allocations = []
+        last_id = 0
+        while True:
+            utilisations = Utilisation.search(
+                domain + [('id', '>', last_id)],
+                limit=chunk_size, order=[('id', 'ASC')])
+            if not utilisations:
+                break
+            allocations += [a.id for a in collection.collect(utilisations)]
+            last_id = utilisations[-1].id
+            transaction.commit()
+    return allocations
 
 
 class CollectStart(ModelView):
     """
-    Defines the initial state of the Collect wizard, including a list of
-    utilizarions to use in the allocation process.
+    Defines the initial state of the Collect wizard, including either a list
+    of utilisations or the filters for the utilisations to use in the
+    allocation process.
     """
 
     __name__ = 'utilisation.allocation.collect.start'
+    _filter_states = {
+        'invisible': Or(Bool(Eval('utilisations')), Bool(Eval('collection'))),
+    }
+
     utilisations = fields.One2Many(
         'utilisation', None, 'Utilisations',
-        states={'required': True}, help='The utilisations to allocate')
+        states={'invisible': ~Eval('utilisations')},
+        help='The utilisations to allocate')
+    collection = fields.Many2One(
+        'collection', 'Resume Collection', domain=[('locked', '=', True)],
+        states={'invisible': Bool(Eval('utilisations'))},
+        depends=['utilisations'],
+        help='An interrupted collection run to resume')
+    from_date = fields.Date(
+        'From Date',
+        states=_filter_states, depends=['utilisations', 'collection'],
+        help='Include utilisations starting equal or after from date')
+    thru_date = fields.Date(
+        'Thru Date',
+        states=_filter_states, depends=['utilisations', 'collection'],
+        help='Include utilisations starting until thru date')
+    licensee = fields.Many2One(
+        'party.party', 'Licensee',
+        states=_filter_states, depends=['utilisations', 'collection'],
+        help='Include only utilisations of the licensee')
+    tariff_category = fields.Many2One(
+        'tariff_system.category', 'Tariff Category',
+        states=_filter_states, depends=['utilisations', 'collection'],
+        help='Include only utilisations of the tariff category')
+    state = fields.Selection(
+        'get_states', 'State', sort=False,
+        states=_filter_states, depends=['utilisations', 'collection'],
+        help='Include only utilisations in the state')
+    chunk_size = fields.Integer(
+        'Chunk Size', states={
+            'required': ~Eval('utilisations'),
+            'invisible': Bool(Eval('utilisations')),
+        }, depends=['utilisations'],
+        help='The number of utilisations collected and committed at once')
+
+    @staticmethod
+    def get_states():
+        Utilisation = Pool().get('utilisation')
+        return [(None, '')] + Utilisation.state.selection
 
 
 class Collect(Wizard):
@@ -891,37 +1606,70 @@ class Collect(Wizard):
         ])
     collect = StateTransition()
 
-    def default_start(self, fields) -> dict[str, list['Utilisation']]:
+    def default_start(self, fields) -> dict[str, Any]:
         """
         triggered by the Collect button of the wizard
 
         Returns:
             List of Utilization that are preselected for collection in the
-            wizard
+            wizard, if started from selected utilisations, otherwise the
+            default filters for the utilisations to collect
         """
-        Utilisation = Pool().get('utilisation')
         active_model = Transaction().context.get('active_model', '')
         if active_model == 'utilisation':
-            utilisations = Transaction().context['active_ids']
-        else:
-            utilisations = [
-                utilisation.id for utilisation
-                in Utilisation.search([])
-                ]
+            return {
+                'utilisations': Transaction().context['active_ids'],
+            }
         return {
-            'utilisations': utilisations
+            'state': 'confirmed',
+            'chunk_size': COLLECT_CHUNK_SIZE,
         }
 
+    def _get_utilisation_domain(self) -> list:
+        """
+        Returns:
+            the domain for the utilisations to collect built from the filters
+            of the start form
+        """
+        domain = []
+        if self.start.from_date:
+            domain.append(('start', '>=', datetime.datetime.combine(
+                self.start.from_date, datetime.time.min)))
+        if self.start.thru_date:
+            domain.append(('start', '<=', datetime.datetime.combine(
+                self.start.thru_date, datetime.time.max)))
+        if self.start.licensee:
+            domain.append(('licensee', '=', self.start.licensee.id))
+        if self.start.tariff_category:
+            domain.append(
+                ('tariff.category', '=', self.start.tariff_category.id))
+        if self.start.state:
+            domain.append(('state', '=', self.start.state))
+        return domain
+
     def transition_collect(self):
         Collection = Pool().get('collection')
+
+        # resume an interrupted collection run
+        if self.start.collection:
+            self.start.collection.collect_parallel(
+                chunk_size=self.start.chunk_size)
+            return 'end'
+
         collection = Collection()
         collection.locked = False
         collection.date = datetime.date.today()
         collection.time = datetime.datetime.now()
         collection.entity_origin = 'manually'
         collection.entity_creator = Pool().get('res.user')(Transaction().user)
-        collection.collect(self.start.utilisations)
-        collection.save()
+        if self.start.utilisations:
+            collection.save()
+            collection.collect(self.start.utilisations)
+        else:
+            collection.domain = PYSONEncoder().encode(
+                self._get_utilisation_domain())
+            collection.save()
+            collection.collect_parallel(chunk_size=self.start.chunk_size)
         # collection.allocations = ...
 
         # Notes
@@ -972,7 +1720,7 @@ class Allocation(ModelSQL, ModelView, CurrencyDigits):
         'Administration Fee', digits=(16, Eval('currency_digits', 2)),
         depends=['currency_digits'],
         help='The sum of adminstration fees over all utilisations')
-    # TODO: attach the created invoice in _get_invoice() etc
+    # TODO: attach the created invoice in _get_invoice_values() etc
     company = fields.Many2One('company.company', 'Company', required=True)
     invoice = fields.One2One(
         'allocation-account.invoice', 'allocation', 'invoice',
@@ -1020,28 +1768,20 @@ class Allocation(ModelSQL, ModelView, CurrencyDigits):
         # as discussed: one function to calculate all amounts, no split
         pass
 
-    def _get_invoice(self):
-        pool = Pool()
-        Invoice = pool.get('account.invoice')
-        Journal = pool.get('account.journal')
-
-        journals = Journal.search([
-            ('type', '=', 'revenue'),
-        ], limit=1)
-        if journals:
-            journal, = journals
-        else:
-            journal = None
-
-        data = {
-            'company': self.company,
+    def _get_invoice_values(self, journal):
+        invoice_address = self.licensee.address_get('invoice')
+        return {
+            'company': self.company.id,
             'type': 'out',
-            'journal': journal,
-            'party': self.licensee,
-            'invoice_address': self.licensee.address_get('invoice'),
-            'currency': self.company.currency,
-            'account': self.licensee.account_receivable,
-            'payment_term': self.licensee.customer_payment_term,
+            'journal': journal.id if journal else None,
+            'party': self.licensee.id,
+            'invoice_address': (
+                invoice_address.id if invoice_address else None),
+            'currency': self.company.currency.id,
+            'account': self.licensee.account_receivable.id,
+            'payment_term': (
+                self.licensee.customer_payment_term.id
+                if self.licensee.customer_payment_term else None),
             # TODO: fetch from right objects
             # 'description': self.distribution.rec_name,
             'description': "TODO",
@@ -1049,31 +1789,76 @@ class Allocation(ModelSQL, ModelView, CurrencyDigits):
             # 'invoice_date': self.distribution.date,
             'invoice_date': datetime.date.today(),
         }
-        return Invoice(**data)
 
     def create_invoice(self):
         '''
         Creates and returns an invoice
         '''
+        invoices = self.create_invoices([self])
+        if invoices:
+            return invoices[0]
+
+    @classmethod
+    def create_invoices(cls, allocations):
+        '''
+        Creates and returns the invoices for the allocations in one pass
+
+        The journal and the products, accounts and taxes of the tariff
+        categories are resolved once for all allocations. Allocations
+        without invoice lines are skipped.
+        '''
         pool = Pool()
         Invoice = pool.get('account.invoice')
+        Journal = pool.get('account.journal')
+        TariffCategory = pool.get('tariff_system.category')
+        Utilisation = pool.get('utilisation')
 
-        if not self.licensee.account_receivable:
-            raise UserError('Missing Account Receivable',
-                            'The Licensee "%s" has no account receivable '
-                            'assigned, so the allocation can\'t be invoiced.' %
-                            self.licensee.rec_name,)
+        for allocation in allocations:
+            if not allocation.licensee.account_receivable:
+                raise UserError(
+                    'Missing Account Receivable',
+                    'The Licensee "%s" has no account receivable assigned, '
+                    'so the allocation can\'t be invoiced.' %
+                    allocation.licensee.rec_name,)
+        if not allocations:
+            return []
 
-        invoice_lines = []
-        for utilisation in self.utilisations:
-            invoice_lines += utilisation._get_invoice_lines()
-        if not invoice_lines:
-            return
-        invoice = self._get_invoice()
-        invoice.lines = invoice_lines
-        invoice.save()
-        Invoice.update_taxes([invoice])
-        return invoice
+        journals = Journal.search([
+            ('type', '=', 'revenue'),
+        ], limit=1)
+        if journals:
+            journal, = journals
+        else:
+            journal = None
+
+        allocation_utilisations = defaultdict(list)
+        for utilisation in Utilisation.search([
+                    ('allocation', 'in', [a.id for a in allocations]),
+                    ('state', '=', 'confirmed'),
+                    ], order=[('allocation', 'ASC'), ('id', 'ASC')]):
+            allocation_utilisations[utilisation.allocation.id].append(
+                utilisation)
+        templates = TariffCategory.get_invoice_line_templates({
+            u.tariff.category for utilisations
+            in allocation_utilisations.values() for u in utilisations})
+
+        vlist = []
+        for allocation in allocations:
+            invoice_lines = []
+            for utilisation in allocation_utilisations[allocation.id]:
+                invoice_lines += utilisation._get_invoice_line_values(
+                    templates)
+            if not invoice_lines:
+                continue
+            values = allocation._get_invoice_values(journal)
+            for line in invoice_lines:
+                line['company'] = values['company']
+                line['currency'] = values['currency']
+            values['lines'] = [('create', invoice_lines)]
+            vlist.append(values)
+        invoices = Invoice.create(vlist)
+        Invoice.update_taxes(invoices)
+        return invoices
 
     # TODO: delete as soon as everything works out
     # -> artifact from imp
@@ -1116,11 +1901,7 @@ class AllocationInvoice(Wizard):
         Allocation = pool.get('allocation')
 
         allocations = Allocation.browse(Transaction().context['active_ids'])
-        invoices = []
-        for allocation in allocations:
-            invoice = Allocation.create_invoice(allocation)
-            if invoice:
-                invoices.append(invoice)
+        invoices = Allocation.create_invoices(allocations)
 
         data = {'res_id': [i.id for i in invoices]}
         if len(invoices) == 1:
@@ -1149,6 +1930,9 @@ class Distribution(ModelSQL, ModelView):
     allocations = fields.One2Many(
         'allocation', 'distribution', 'Allocations',
         help='All allocations in this distributon')
+    pockets = fields.One2Many(
+        'distribution.pocket', 'distribution', 'Pockets',
+        help='The snapshot of the pockets of the distributed parties')
 
     @classmethod
     def __setup__(cls):
@@ -1175,10 +1959,7 @@ class Distribution(ModelSQL, ModelView):
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.distribution_sequence.get()
+        Configuration.set_codes(vlist, 'distribution_sequence')
         return super().create(vlist)
 
     @classmethod
@@ -1198,6 +1979,146 @@ class Distribution(ModelSQL, ModelView):
         ]
 
 
+class DistributionPocket(ModelSQL, ModelView, CurrencyDigits):
+    'Distribution Pocket'
+    __name__ = 'distribution.pocket'
+
+    distribution = fields.Many2One(
+        'distribution', 'Distribution', required=True, ondelete='CASCADE',
+        help='The distribution of the snapshot')
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, ondelete='CASCADE',
+        help='The party of the pocket')
+    balance = fields.Numeric(
+        'Balance', digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits'],
+        help='The sum of the posted lines of the pocket account')
+    budget = fields.Numeric(
+        'Budget', digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits'],
+        help='The balance including the draft lines of the pocket account')
+    cursor = fields.Integer(
+        'Cursor', readonly=True,
+        help='The id of the last move line added to the balance, to resume '
+        'the balance in the next snapshot')
+
+    @classmethod
+    def snapshot(cls, distribution, parties, accounts):
+        """
+        materializes the pocket balances and budgets of parties
+
+        Args:
+            distribution: the distribution of the snapshot
+            parties: the parties to snapshot
+            accounts: the pocket accounts, see get_pockets()
+
+        Returns:
+            dict of Party ID (int) to pocket
+        """
+        pockets = cls.get_pockets(parties, accounts)
+        for pocket in pockets.values():
+            pocket.distribution = distribution
+        cls.save(list(pockets.values()))
+        return pockets
+
+    @classmethod
+    def get_pockets(cls, parties, accounts):
+        """
+        calculates the pocket balances and budgets of parties
+
+        The pocket of a party are its move lines on the pocket accounts. The
+        balance of the last snapshot of a party is resumed from its cursor,
+        the id of the last move line added: only the posted lines after the
+        cursor and before the first line of a draft move are added, as posted
+        lines are not changed anymore. Draft lines are aggregated anew for
+        the budget. The move lines of the parties with the same cursor are
+        aggregated with one query.
+
+        Args:
+            parties: the parties to calculate the pockets for
+            accounts: the pocket accounts
+
+        Returns:
+            dict of Party ID (int) to unsaved pocket
+        """
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        pocket = cls.__table__()
+        last = cls.__table__()
+        move = Move.__table__()
+        line = MoveLine.__table__()
+        draft_line = MoveLine.__table__()
+        draft_move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        party_ids = sorted({p.id for p in parties})
+        account_ids = sorted({a.id for a in accounts})
+        balances = dict.fromkeys(party_ids, Decimal(0))
+        budgets = {}
+        cursors = dict.fromkeys(party_ids, 0)
+        for sub_ids in grouped_slice(party_ids):
+            cursor.execute(*pocket.select(
+                    pocket.party, pocket.balance, pocket.cursor,
+                    where=pocket.id.in_(last.select(
+                            Max(last.id),
+                            where=reduce_ids(last.party, sub_ids),
+                            group_by=[last.party]))))
+            for party_id, balance, line_id in cursor:
+                balances[party_id] = balance or Decimal(0)
+                cursors[party_id] = line_id or 0
+        since = defaultdict(list)
+        for party_id, line_id in cursors.items():
+            since[line_id].append(party_id)
+
+        amount = Coalesce(line.credit, 0) - Coalesce(line.debit, 0)
+        for line_id, since_ids in since.items():
+            if not account_ids:
+                break
+            for sub_ids in grouped_slice(since_ids):
+                sub_ids = list(sub_ids)
+                where = (reduce_ids(line.party, sub_ids)
+                         & line.account.in_(account_ids)
+                         & (line.id > line_id))
+                drafts = draft_line.join(
+                    draft_move, condition=draft_line.move == draft_move.id
+                    ).select(
+                    draft_line.party.as_('party'),
+                    Min(draft_line.id).as_('first'),
+                    where=reduce_ids(draft_line.party, sub_ids)
+                    & draft_line.account.in_(account_ids)
+                    & (draft_line.id > line_id)
+                    & (draft_move.state == 'draft'),
+                    group_by=[draft_line.party])
+                posted = (move.state == 'posted') & (
+                    (drafts.first == Null) | (line.id < drafts.first))
+                cursor.execute(*line.join(
+                        move, condition=line.move == move.id
+                        ).join(
+                        drafts, 'LEFT', condition=drafts.party == line.party
+                        ).select(
+                        line.party,
+                        Sum(Case((posted, amount), else_=0)),
+                        Sum(amount),
+                        Max(line.id),
+                        Max(drafts.first),
+                        where=where,
+                        group_by=[line.party]))
+                for party_id, balance, total, max_id, first_id in cursor:
+                    budgets[party_id] = (
+                        balances[party_id] + Decimal(total or 0))
+                    balances[party_id] += Decimal(balance or 0)
+                    cursors[party_id] = first_id - 1 if first_id else max_id
+
+        return {
+            party_id: cls(
+                party=party_id,
+                balance=balances[party_id],
+                budget=budgets.get(party_id, balances[party_id]),
+                cursor=cursors[party_id])
+            for party_id in party_ids}
+
+
 class DistributionPlan(ModelSQL, ModelView):
     'Distribution Plan'
     __name__ = 'distribution.plan'
@@ -1215,6 +2136,30 @@ class DistributionPlan(ModelSQL, ModelView):
         'Transitional through',
         help='Date of the end of the transitinal phase, through which the '
         'tariff might still be used.')
+    adaption_share = fields.Numeric(
+        'Adaption Share', digits=(16, 4),
+        domain=[
+            'OR',
+            ('adaption_share', '=', None),
+            [('adaption_share', '>=', 0), ('adaption_share', '<=', 1)],
+            ],
+        help='The share of an adaption flowing to its originals [0-1]')
+    cover_share = fields.Numeric(
+        'Cover Share', digits=(16, 4),
+        domain=[
+            'OR',
+            ('cover_share', '=', None),
+            [('cover_share', '>=', 0), ('cover_share', '<=', 1)],
+            ],
+        help='The share of a cover flowing to its originals [0-1]')
+    remix_share = fields.Numeric(
+        'Remix Share', digits=(16, 4),
+        domain=[
+            'OR',
+            ('remix_share', '=', None),
+            [('remix_share', '>=', 0), ('remix_share', '<=', 1)],
+            ],
+        help='The share of a remix flowing to its originals [0-1]')
     # TODO: attachement
 
     @classmethod
@@ -1238,10 +2183,7 @@ class DistributionPlan(ModelSQL, ModelView):
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.distribution_plan_sequence.get()
+        Configuration.set_codes(vlist, 'distribution_plan_sequence')
         return super().create(vlist)
 
     @classmethod
@@ -1260,6 +2202,18 @@ class DistributionPlan(ModelSQL, ModelView):
             ('version',) + tuple(clause[1:]),
         ]
 
+    @property
+    def original_shares(self):
+        """
+        the shares of a derivative flowing to its originals
+
+        Returns:
+            dict of allocation type to share (Fraction)
+        """
+        return {
+            type_: Fraction(getattr(self, '%s_share' % type_) or 0)
+            for type_ in ['adaption', 'cover', 'remix']}
+
 
 class DistributeStart(ModelView):
     'Distribute Start'
@@ -1292,208 +2246,626 @@ class DistributeStart(ModelView):
         return Date.today() - relativedelta(months=1) + relativedelta(day=31)
 
 
+class DistributeReport(ModelView):
+    'Distribute Report'
+    __name__ = 'distribution.distribute.report'
+
+    utilisations = fields.Integer(
+        'Utilisations', readonly=True,
+        help='The number of utilisations to distribute')
+    parties = fields.Integer(
+        'Parties', readonly=True,
+        help='The number of licensees with an allocation to distribute')
+    artists = fields.Integer(
+        'Artists', readonly=True,
+        help='The number of artists with a hat credit')
+    amount = fields.Numeric(
+        'Amount', digits=(16, 2), readonly=True,
+        help='The sum of the allocated pocket amounts')
+    fee_amount = fields.Numeric(
+        'Fee Amount', digits=(16, 2), readonly=True,
+        help='The sum of the administration fees')
+    report = fields.Binary(
+        'Payout Report', filename='report_filename', readonly=True,
+        help='The fees per party and hat credits per artist (CSV)')
+    report_filename = fields.Char('Report Filename', readonly=True)
+
+
 class Distribute(Wizard):
     "Distribute"
     __name__ = 'distribution.distribute'
 
-    start = StateView(
-        'distribution.distribute.start',
-        'collecting_society.distribution_distribute_start_view_form',
-        [
-            Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Start', 'distribute', 'tryton-ok', default=True),
-        ])
-    distribute = StateTransition()
+    start = StateView(
+        'distribution.distribute.start',
+        'collecting_society.distribution_distribute_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Simulate', 'report', 'tryton-launch'),
+            Button('Start', 'distribute', 'tryton-ok', default=True),
+        ])
+    distribute = StateTransition()
+    report = StateView(
+        'distribution.distribute.report',
+        'collecting_society.distribution_distribute_report_view_form',
+        [
+            Button('Back', 'start', 'tryton-back'),
+            Button('Close', 'end', 'tryton-close', default=True),
+        ])
+
+    # share of the performers, if there are composers or texters
+    _performance_share = Fraction(1, 2)
+    # share of the composers, if there are texters
+    _composition_share = Fraction(65, 100)
+
+    def _get_party_utilisations(self):
+        """
+        collects the utilisations to distribute
+
+        The collected allocations, which are not distributed yet and have a
+        utilisation started within the distribution period, are distributed
+        as a whole. Their utilisations are read with one query.
+
+        Returns:
+            dict of Party ID (int) of the licensee to list of utilisations
+        """
+        Utilisation = Pool().get('utilisation')
+
+        utilisations = Utilisation.search([
+                ('allocation', 'where', [
+                        ('state', '=', 'collected'),
+                        ('distribution', '=', None),
+                        ('utilisations', 'where', [
+                                (
+                                    'effective_start', '>=',
+                                    datetime.datetime.combine(
+                                        self.start.from_date,
+                                        datetime.time.min)
+                                ), (
+                                    'effective_start', '<=',
+                                    datetime.datetime.combine(
+                                        self.start.thru_date,
+                                        datetime.time.max)
+                                ),
+                                ]),
+                        ]),
+                ], order=[('allocation', 'ASC'), ('id', 'ASC')])
+        party_utilisations = defaultdict(list)
+        for utilisation in utilisations:
+            party_utilisations[utilisation.allocation.licensee.id].append(
+                utilisation)
+        return party_utilisations
+
+    @staticmethod
+    def _get_pocket_accounts():
+        """
+        resolves the pocket accounts
+
+        The distribution amounts are invoiced on the revenue accounts of the
+        distribution products of the tariff categories, see
+        TariffCategory._get_invoice_line_templates(). The lines of a licensee
+        on these accounts are the pocket of the licensee.
+
+        Returns:
+            dict of Tariff Category ID (int) to account
+        """
+        TariffCategory = Pool().get('tariff_system.category')
+
+        accounts = {}
+        for category in TariffCategory.search([
+                    ('distribution_product', '!=', None),
+                    ]):
+            account = category.distribution_product.account_revenue_used
+            if account:
+                accounts[category.id] = account
+        return accounts
+
+    def _calculate(self, party_utilisations, pockets, accounts):
+        """
+        calculates the allocations of a distribution without writing records
+
+        The confirmed distribution amount of each utilisation is split over
+        the creations of its creation list by their weight and over the
+        artists of the creations by their share vectors of the distribution
+        plan of the utilisation. The hat credits are
+        rounded once per allocation and pocket account. The allocations of a
+        licensee are only distributed, if the pocket of the licensee covers
+        their amount.
+
+        Args:
+            party_utilisations: dict of Party ID (int) to list of utilisations
+            pockets: dict of Party ID (int) to pocket
+            accounts: dict of Tariff Category ID (int) to pocket account
+
+        Returns:
+            list of tuples of allocation, amount, fee amount and hat credits
+            (dict of Account ID (int) to dict of Artist ID (int) to amount)
+            for each allocation with an amount to distribute
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        company = Company(Transaction().context['company'])
+        currency = company.currency
+        vectors = self._get_share_vectors({
+                (u.distribution_plan.id, item.creation.id)
+                for utilisations in party_utilisations.values()
+                for u in utilisations if u.creation_list
+                for item in u.creation_list.items})
+
+        result = []
+        for party_id in sorted(party_utilisations):
+            allocation_amounts = defaultdict(
+                lambda: defaultdict(lambda: defaultdict(Fraction)))
+            fee_amounts = defaultdict(Decimal)
+            for utilisation in party_utilisations[party_id]:
+                allocation = utilisation.allocation
+                fee_amounts[allocation] += (
+                    utilisation.confirmed_administration_fee or Decimal(0))
+                account = accounts.get(utilisation.tariff.category.id)
+                amount = utilisation.confirmed_distribution_amount
+                items = (utilisation.creation_list.items
+                         if utilisation.creation_list else [])
+                weight = sum(item.weight for item in items)
+                if not (account and amount and weight):
+                    continue
+                creation_amounts = allocation_amounts[allocation][account.id]
+                for item in items:
+                    creation_amounts[(
+                            utilisation.distribution_plan.id,
+                            item.creation.id)] += (
+                        Fraction(amount) * Fraction(item.weight, weight))
+
+            calculation = []
+            for allocation in sorted(fee_amounts, key=lambda a: a.id):
+                credits = {}
+                for account_id, amounts in sorted(
+                        allocation_amounts[allocation].items()):
+                    artist_credits = {
+                        artist: credit for artist, credit in self._split(
+                            amounts, vectors, currency).items() if credit}
+                    if artist_credits:
+                        credits[account_id] = artist_credits
+                amount = sum(
+                    credit for artist_credits in credits.values()
+                    for credit in artist_credits.values())
+                if amount:
+                    calculation.append((
+                            allocation, amount,
+                            currency.round(fee_amounts[allocation]),
+                            credits))
+
+            pocket = pockets[party_id]
+            if sum(amount for _, amount, *_ in calculation) <= min(
+                    pocket.balance, pocket.budget):
+                result.extend(calculation)
+        return result
 
     def transition_distribute(self):
         pool = Pool()
         Company = pool.get('company.company')
+        Configuration = pool.get('collecting_society.configuration')
         Distribution = pool.get('distribution')
+        DistributionPocket = pool.get('distribution.pocket')
         Allocation = pool.get('allocation')
-        Utilisation = pool.get('utilisation')
-        Account = pool.get('account.account')
         AccountMove = pool.get('account.move')
         AccountJournal = pool.get('account.journal')
+        Artist = pool.get('artist')
         Party = pool.get('party.party')
         Period = pool.get('account.period')
 
         company = Company(Transaction().context['company'])
-        currency = company.currency
         # TODO:
         # * Redistribution
         # * Check if distribution period overlaps with existing distribution
 
         # Collect utilisations
-        utilisations = Utilisation.search([
-            (
-                'timestamp', '>=', datetime.datetime.combine(
-                    self.start.from_date, datetime.time.min)
-            ), (
-                'timestamp', '<=', datetime.datetime.combine(
-                    self.start.thru_date, datetime.time.max)
-            ), ('state', '=', 'not_distributed'),
-        ])
-        if not utilisations:
+        party_utilisations = self._get_party_utilisations()
+        if not party_utilisations:
             return 'end'
         # Create always a new distribution
         distribution, = Distribution.create(
             [
                 {
                     'date': self.start.date,
-                    'from_date': self.start.thru_date,
+                    'from_date': self.start.from_date,
                     'thru_date': self.start.thru_date,
                 }
             ]
         )
 
-        party_utilisations = defaultdict(list)
-        for utilisation in utilisations:
-            party_utilisations[utilisation.party.id].append(utilisation)
+        # Resolve the accounting records once per run
+        accounts = self._get_pocket_accounts()
+        period_id = Period.find(company.id, date=self.start.date)
+        journal, = AccountJournal.search([('code', '=', 'TRANS')])
+        # one line of each move is left for the pocket move line
+        move_lines = Configuration.get_cached().distribution_move_lines
+        max_credit_lines = max((move_lines or 1000) - 1, 1)
+
+        # Only the licensees of allocations not yet distributed are processed
+        pockets = DistributionPocket.snapshot(
+            distribution, Party.browse(sorted(party_utilisations)),
+            accounts.values())
+        calculation = self._calculate(party_utilisations, pockets, accounts)
+        if not calculation:
+            return 'end'
+
+        # Resolve the payees and their payable accounts once per artist
+        payables = {}
+        for artist in Artist.browse(sorted({
+                    artist_id for *_, credits in calculation
+                    for artist_credits in credits.values()
+                    for artist_id in artist_credits})):
+            payee = artist.payee or artist.party
+            if not payee or not payee.account_payable_used:
+                raise UserError(
+                    'Missing Account Payable',
+                    'The artist "%s" has no payee with an account payable '
+                    'assigned, so the hat can\'t be credited.' %
+                    artist.rec_name)
+            payables[artist.id] = (payee.id, payee.account_payable_used.id)
 
         account_moves = []
-        for party_id, utilisations in party_utilisations.items():
-            if not utilisations:
+        for allocation, _, _, credits in calculation:
+            for account_id, artist_credits in credits.items():
+                credit_lines = [{
+                    # Hat move lines
+                    'party': payables[artist_id][0],
+                    'artist': artist_id,
+                    'account': payables[artist_id][1],
+                    'debit': Decimal(0),
+                    'credit': artist_credits[artist_id],
+                } for artist_id in sorted(artist_credits)]
+                # Balance each move by its own pocket move line
+                for i in range(0, len(credit_lines), max_credit_lines):
+                    lines = credit_lines[i:i + max_credit_lines]
+                    lines.append({
+                        # Pocket move line
+                        'party': allocation.licensee.id,
+                        'artist': None,
+                        'account': account_id,
+                        'debit': sum(line['credit'] for line in lines),
+                        'credit': Decimal(0),
+                    })
+                    account_moves.append({
+                        'journal': journal.id,
+                        'origin': str(allocation),
+                        'date': self.start.date,
+                        'period': period_id,
+                        'lines': [('create', lines)],
+                    })
+        AccountMove.create(account_moves)
+        Allocation.write([a for a, *_ in calculation], {
+                'distribution': distribution.id,
+                })
+        return 'end'
+
+    def default_report(self, fields):
+        """
+        simulates the distribution
+
+        The distribution is calculated like in transition_distribute(), but
+        kept in memory without writing any records.
+        """
+        pool = Pool()
+        DistributionPocket = pool.get('distribution.pocket')
+        Party = pool.get('party.party')
+
+        party_utilisations = self._get_party_utilisations()
+        accounts = self._get_pocket_accounts()
+        pockets = DistributionPocket.get_pockets(
+            Party.browse(sorted(party_utilisations)), accounts.values())
+        calculation = self._calculate(party_utilisations, pockets, accounts)
+        return {
+            'utilisations': sum(map(len, party_utilisations.values())),
+            'parties': len({
+                    allocation.licensee for allocation, *_ in calculation}),
+            'artists': len({
+                    artist_id for *_, credits in calculation
+                    for artist_credits in credits.values()
+                    for artist_id in artist_credits}),
+            'amount': sum(amount for _, amount, *_ in calculation),
+            'fee_amount': sum(fee for _, _, fee, *_ in calculation),
+            'report': self._get_report(calculation),
+            'report_filename': 'distribution-%s-%s.csv' % (
+                self.start.from_date, self.start.thru_date),
+        }
+
+    @staticmethod
+    def _get_report(calculation):
+        """
+        exports a calculated distribution as payout report
+
+        The report lists the sum of the administration fees of each licensee
+        and the sum of the hat credits of each artist over all allocations.
+
+        Args:
+            calculation: the calculated distribution, see _calculate()
+
+        Returns:
+            the CSV file (bytes) with the columns type, code, name and amount
+        """
+        pool = Pool()
+        Artist = pool.get('artist')
+        Party = pool.get('party.party')
+
+        fees, hat_credits = Counter(), Counter()
+        for allocation, _, fee_amount, credits in calculation:
+            fees[allocation.licensee.id] += fee_amount
+            for artist_credits in credits.values():
+                hat_credits.update(artist_credits)
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['type', 'code', 'name', 'amount'])
+        for party in Party.browse(sorted(fees)):
+            writer.writerow(['fee', party.code, party.name, fees[party.id]])
+        for artist in Artist.browse(sorted(hat_credits)):
+            writer.writerow([
+                    'hat', artist.code, artist.name, hat_credits[artist.id]])
+        return output.getvalue().encode('utf-8')
+
+    @classmethod
+    def _get_share_vectors(cls, plan_creations):
+        """
+        computes the share vectors of creations
+
+        The share vector of a creation maps its artists to their exact share
+        of an amount. The share vector of a derivative includes the shares
+        of the artists of its originals by the shares of the distribution
+        plan, see _get_derived_vector. The derivation graph and the
+        contributions of all creations involved are read in one query each,
+        so each creation is computed once per distribution plan, regardless
+        of how often it was utilised or derived. Creations on a cycle of
+        derivations are computed per creation, see _get_derived_vector.
+
+        Args:
+            plan_creations: iterable of tuples of Distribution Plan ID (int)
+                and Creation ID (int)
+
+        Returns:
+            dict of tuple of Distribution Plan ID (int) and Creation ID (int)
+            to share vector (dict of Artist ID (int) to share (Fraction))
+        """
+        DistributionPlan = Pool().get('distribution.plan')
+
+        plan_creations = set(plan_creations)
+        creation_ids = {creation_id for _, creation_id in plan_creations}
+        originals = cls._get_originals(creation_ids)
+        vectors = cls._get_contribution_vectors(creation_ids | {
+                original for relations in originals.values()
+                for original, _ in relations})
+        plans = {
+            plan.id: plan for plan in DistributionPlan.browse(
+                sorted({plan_id for plan_id, _ in plan_creations}))}
+        memos = defaultdict(dict)
+        share_vectors = {}
+        for plan_id, creation_id in sorted(plan_creations):
+            if creation_id not in vectors:
                 continue
-            party = Party(party_id)
-            amount = party.pocket_balance
-            if not amount:
+            share_vectors[(plan_id, creation_id)], _ = (
+                cls._get_derived_vector(
+                    creation_id, vectors, originals,
+                    plans[plan_id].original_shares, memos[plan_id], set()))
+        return share_vectors
+
+    @staticmethod
+    def _get_originals(creation_ids):
+        """
+        loads the derivation graph of creations
+
+        The originals of the creations, their originals and so on are read
+        with one recursive query. The query unites the relations without
+        duplicates, so it also terminates on cyclic graphs.
+
+        Args:
+            creation_ids: iterable of derivative Creation IDs (int)
+
+        Returns:
+            dict of derivative Creation ID (int) to list of tuples of
+            original Creation ID (int) and allocation type (str)
+        """
+        Derivative = Pool().get('creation.original.derivative')
+        derivative = Derivative.__table__()
+        cursor = Transaction().connection.cursor()
+
+        relations = set()
+        for sub_ids in grouped_slice(list(creation_ids)):
+            graph = With('original', 'derivative', 'type', recursive=True)
+            graph.query = derivative.select(
+                derivative.original_creation,
+                derivative.derivative_creation,
+                derivative.allocation_type,
+                where=reduce_ids(derivative.derivative_creation, sub_ids))
+            graph.query |= derivative.join(
+                graph,
+                condition=derivative.derivative_creation == graph.original
+                ).select(
+                derivative.original_creation,
+                derivative.derivative_creation,
+                derivative.allocation_type)
+            cursor.execute(*graph.select(
+                    graph.original, graph.derivative, graph.type,
+                    with_=[graph]))
+            relations.update(cursor)
+        originals = defaultdict(list)
+        for original, derivative_, type_ in sorted(relations):
+            originals[derivative_].append((original, type_))
+        return originals
+
+    @classmethod
+    def _get_derived_vector(cls, creation_id, vectors, originals, shares,
+                            memo, path):
+        """
+        computes the share vector of a creation including its originals
+
+        Each original receives the share of its allocation type, divided by
+        the number of originals, and splits it by its own derived share
+        vector. The rest stays with the contributors of the creation.
+        Relations to originals already on the path of the traversal are
+        cycles and skipped. A vector computed with a skipped relation
+        depends on the path and is not memoized, so the vector of each
+        creation on a cycle is the same, whichever creation is computed
+        first.
+
+        Args:
+            creation_id: Creation ID (int)
+            vectors: dict of Creation ID (int) to contribution share vector
+            originals: the derivation graph, see _get_originals
+            shares: dict of allocation type to the share of a derivative
+                flowing to its originals (Fraction)
+            memo: dict of Creation ID (int) to derived share vector, which
+                is filled by the vectors computed without skipped relations
+            path: set of Creation IDs (int) on the path of the traversal
+
+        Returns:
+            tuple of the share vector, a dict of Artist ID (int) to share
+            (Fraction), and whether it was computed without skipped relations
+        """
+        if creation_id in memo:
+            return memo[creation_id], True
+        path.add(creation_id)
+        relations = [
+            (original, type_)
+            for original, type_ in originals.get(creation_id, [])
+            if original not in path]
+        complete = len(relations) == len(originals.get(creation_id, []))
+        vector = defaultdict(Fraction)
+        own_share = Fraction(1)
+        for original, type_ in relations:
+            share = shares.get(type_, 0) / len(relations)
+            original_vector, original_complete = cls._get_derived_vector(
+                original, vectors, originals, shares, memo, path)
+            complete &= original_complete
+            if not share or not original_vector:
                 continue
+            own_share -= share
+            for artist, artist_share in original_vector.items():
+                vector[artist] += share * artist_share
+        own_vector = vectors.get(creation_id, {})
+        for artist, artist_share in own_vector.items():
+            vector[artist] += own_share * artist_share
+        path.discard(creation_id)
+        if complete:
+            memo[creation_id] = dict(vector)
+        return dict(vector), complete
 
-            if party.pocket_budget < party.pocket_balance:
-                amount = party.pocket_budget
-            amount = currency.round(amount)
-            fee_amount = currency.round(amount * Decimal(10) / Decimal(100))
-            share_amount = currency.round(
-                (amount - fee_amount) / len(utilisations))
-            allocation = {
-                'party': party_id,
-                'distribution': distribution.id,
-                'type': 'pocket2hats',
-                'amount': amount,
-                'share_amount': share_amount,
-            }
-            # create allocation
-            allocation, = Allocation.create([allocation])
+    @classmethod
+    def _get_contribution_vectors(cls, creation_ids):
+        """
+        computes the share vectors of the contributions to creations
 
-            Utilisation.write(
-                utilisations,
-                {
-                    'state': 'processing',
-                    'allocation': allocation.id,
-                })
-            account_move_lines = [{
-                # Company fees move line
-                'party': company.party.id,
-                'artist': None,
-                'account': Account.search([('kind', '=', 'revenue')])[0],
-                'debit': Decimal(0),
-                'credit': fee_amount,
-                'state': 'draft',
-            }, {
-                # Pocket move line
-                'party': party.id,
-                'artist': None,
-                'account': party.pocket_account.id,
-                'debit': amount,
-                'credit': Decimal(0),
-                'state': 'draft',
-            }]
-            for utilisation in utilisations:
-                breakdown = self._allocate(
-                    utilisation.creation,
-                    share_amount)
-                for artist, amount in breakdown.items():
-                    account_move_lines += [{
-                        # Hat move lines
-                        'party': None,
-                        'artist': artist.id,
-                        'account': artist.hat_account.id,
-                        'debit': Decimal(0),
-                        'credit': currency.round(amount),
-                        'state': 'draft',
-                    }]
-            period_id = Period.find(company.id, date=self.start.date)
-            journal, = AccountJournal.search([('code', '=', 'TRANS')])
-            origin = 'allocation,%s' % (allocation.id)
-            account_moves.append({
-                'journal': journal.id,
-                'origin': origin,
-                'date': self.start.date,
-                'period': period_id,
-                'state': 'draft',
-                'lines': [('create', account_move_lines)],
-            })
-        AccountMove.create(account_moves)
-        Utilisation.write(utilisations, {'state': 'distributed'})
-        return 'end'
+        The contributions of all creations are read in one query.
 
-    def _allocate(self, creation, amount, result=None):
-        '''
-        Allocates an amount to all involved artists of a creation.
-        The tree of original creations is traversed and every node creation is
-        allocated by the appropriate derivative types.
+        Args:
+            creation_ids: iterable of Creation IDs (int)
 
-        Returns a dictionary with artist as key and the sum of amounts
-        as value.
-        '''
-        amount = Decimal(amount)
+        Returns:
+            dict of Creation ID (int) to share vector, see _get_share_vector
+        """
+        pool = Pool()
+        Creation = pool.get('creation')
+        Contribution = pool.get('creation.contribution')
+        creation = Creation.__table__()
+        contribution = Contribution.__table__()
+        cursor = Transaction().connection.cursor()
+
+        artists = {}
+        contributors = defaultdict(lambda: defaultdict(list))
+        for sub_ids in grouped_slice(list(creation_ids)):
+            cursor.execute(*creation.join(
+                    contribution, 'LEFT',
+                    condition=(contribution.creation == creation.id)
+                    & (contribution.artist != None)  # noqa: E711
+                    ).select(
+                    creation.id, creation.artist,
+                    contribution.type, contribution.artist,
+                    where=reduce_ids(creation.id, sub_ids),
+                    order_by=[creation.id, contribution.id]))
+            for creation_id, creation_artist, type_, artist in cursor:
+                artists[creation_id] = creation_artist
+                if type_:
+                    contributors[creation_id][type_].append(artist)
+        return {
+            creation_id: cls._get_share_vector(
+                creation_artist, contributors[creation_id])
+            for creation_id, creation_artist in artists.items()}
+
+    @classmethod
+    def _get_share_vector(cls, creation_artist, contributors):
+        """
+        computes the share vector of a creation
 
-        if result is None:
-            result = Counter()
+        Composers and texters split their part 65/35 and share the amount
+        with the performers by half. Creations without contributions, e.g.
+        from unclaimed fingerprinting identifications, are allocated
+        completely to the creation artist.
 
-        if not creation.contributions:
-            # Handle creations from unclaimed fingerprinting identification:
-            # allocate complete amount to creation artist
-            result[creation.artist] = amount
-            return result
+        Args:
+            creation_artist: Artist ID (int) of the creation
+            contributors: dict of contribution type to list of Artist IDs
 
-        composer = [
-            c.artist for c in creation.contributions
-            if c.type == 'composition']
-        texter = [
-            c.artist for c in creation.contributions if c.type == 'text']
-        performers = [
-            c.artist for c in creation.contributions
-            if c.type == 'performance']
-        creators = composer or texter
-
-        performer_amount = Decimal(0)
-        composer_amount = Decimal(0)
-        texter_amount = Decimal(0)
-
-        if performers and creators:
-            amount = amount / Decimal(2)
-
-        if composer and texter:
-            composer_amount = (
-                amount * Decimal(65) / Decimal(100) / Decimal(len(composer)))
-            texter_amount = (
-                amount * Decimal(35) / Decimal(100) / Decimal(len(texter)))
-        elif texter:
-            texter_amount = amount / Decimal(len(texter))
-        elif composer:
-            composer_amount = amount / Decimal(len(composer))
-
-        if performers:
-            performer_amount = amount / Decimal(len(performers))
-
-        for c in composer:
-            result[c] += composer_amount
-        for t in texter:
-            result[t] += texter_amount
-        for p in performers:
-            result[p] += performer_amount
-
-        # Traverse Originators
-        # for original in creation.original_creations:
-        #     if not original.derivative_type:
-        #         result = self._allocate(
-        #             creation=original.original_creation,
-        #             amount=amount / Decimal(
-        #                 len(creation.original_creations)),
-        #             result=result)
+        Returns:
+            dict of Artist ID (int) to share (Fraction), summing up to 1
+        """
+        composers = contributors.get('composition', [])
+        texters = contributors.get('text', [])
+        performers = contributors.get('performance', [])
+        vector = defaultdict(Fraction)
+        if not (composers or texters or performers):
+            if creation_artist:
+                vector[creation_artist] = Fraction(1)
+            return dict(vector)
+
+        share = Fraction(1)
+        if performers and (composers or texters):
+            share = cls._performance_share
+        composer_share = texter_share = share
+        if composers and texters:
+            composer_share = share * cls._composition_share
+            texter_share = share - composer_share
+        for artists, artists_share in [
+                (composers, composer_share),
+                (texters, texter_share),
+                (performers, share)]:
+            for artist in artists:
+                vector[artist] += artists_share / len(artists)
+        return dict(vector)
 
-        return result
+    @staticmethod
+    def _split(amounts, vectors, currency):
+        """
+        splits the amounts of creations into the amounts of their artists
+
+        The amounts and share vectors are keyed alike, e.g. by distribution
+        plan and creation, see _get_share_vectors().
+
+        The exact shares of all amounts are summed up per artist in units of
+        the currency rounding and rounded down. The rounding remainder is
+        handed out unit by unit to the artists with the largest fractions
+        rounded off, so the artist amounts add up to the rounded total.
+
+        Args:
+            amounts: dict of key to amount (Decimal or Fraction)
+            vectors: dict of key to share vector
+            currency: currency to round the amounts to
+
+        Returns:
+            dict of Artist ID (int) to amount (Decimal)
+        """
+        unit = Fraction(currency.rounding)
+        exact = defaultdict(Fraction)
+        for key, amount in amounts.items():
+            units = Fraction(amount) / unit
+            for artist, share in vectors.get(key, {}).items():
+                exact[artist] += units * share
+
+        units = {artist: math.floor(value) for artist, value in exact.items()}
+        remainder = round(sum(exact.values())) - sum(units.values())
+        for artist in sorted(
+                exact, key=lambda a: (units[a] - exact[a], a))[:remainder]:
+            units[artist] += 1
+        return {
+            artist: currency.rounding * value
+            for artist, value in units.items()}
 
 
 # --- Indicators --------------------------------------------------------------
@@ -1526,6 +2898,29 @@ class EventIndicators(ModelSQL, ModelView, CurrencyDigits):
         digits=(16, Eval('currency_digits', 2)),
         help='The expenses for the production')
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table, (table.start, Index.Range())),
+            Index(table, (table.end, Index.Range())),
+            Index(table, (table.attendants, Index.Range())),
+        })
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        if any({'start', 'end'} & set(values) for values in args[1::2]):
+            Event = Pool().get('event')
+            ids = [i.id for indicators in args[::2] for i in indicators]
+            with Transaction().set_context(active_test=False):
+                Event.update_start_end(Event.search([
+                            'OR',
+                            ('confirmed_indicators', 'in', ids),
+                            ('estimated_indicators', 'in', ids),
+                            ]))
+
 
 class LocationIndicators(ModelSQL, ModelView, CurrencyDigits):
     'Location Indicators'
@@ -1683,6 +3078,15 @@ class UtilisationIndicators(ModelSQL, ModelView, CurrencyDigits):
         states={'readonly': False}, depends=['currency_digits'],
         help='The amount to distribute')
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table, (table.invoice_amount, Index.Range())),
+            Index(table, (table.distribution_amount, Index.Range())),
+        })
+
 
 class IndicatorsMeta(ModelMeta):
     """
@@ -1724,13 +3128,21 @@ class IndicatorsMeta(ModelMeta):
     - Adds create/copy classmethods to autocreate the indicators objects
         - [classmethod] create
         - [classmethod] copy
+    - Adds a write classmethod to write all shortcut fields together
+        - [classmethod] write
+    - Adds indexes on the indicators fields in __setup__
+        - [classmethod] __setup__
     - Adds shortcut function fields with setter/getter for indicator attributes
         - [fields.Function] <SAMPLE_NAME>_<ATTRIBUTE_NAME>
-        - [method] get_<SAMPLE_NAME>_<ATTRIBUTE_NAME>
-        - [method] set_<SAMPLE_NAME>_<ATTRIBUTE_NAME>
-    - Adds original field name in shortcut fields to ease later access:
+        - [classmethod] get_indicators (shared by all shortcut fields)
+        - [classmethod] set_<SAMPLE_NAME>_<ATTRIBUTE_NAME>
+        - [classmethod] search_<SAMPLE_NAME>_<ATTRIBUTE_NAME>
+        - [classmethod] write_indicators (batch setter for all shortcut
+          fields, also used by write)
+    - Adds original field and sample name in shortcut fields to ease later
+      access:
         - [string] estimated_<ATTRIBUTE_NAME>._attribute_name
-        - [string] confirmed_<ATTRIBUTE_NAME>._attribute_name
+        - [string] estimated_<ATTRIBUTE_NAME>._sample_name
 
     Changes to the indicators model:
     - Adds back reference field to the measured for each sample
@@ -1760,67 +3172,186 @@ class IndicatorsMeta(ModelMeta):
 
     @staticmethod
     def create(indicators_model_name, samples):
-        """This copy method wraps the copy method of the measured class"""
+        """This create method wraps the create method of the measured class"""
         def create(cls, vlist):
-            for entry in vlist:
-                # autocreate indicator model
-                for sample_name in samples:
-                    IndicatorsModel = Pool().get(indicators_model_name)
-                    indicators, = IndicatorsModel.create([{}])
-                    indicators.save()
-                    entry['%s_indicators' % sample_name] = indicators.id
+            IndicatorsModel = Pool().get(indicators_model_name)
+            vlist = [x.copy() for x in vlist]
+            # autocreate indicator model, one create call per sample
+            for sample_name in samples:
+                field_name = '%s_indicators' % sample_name
+                entries = [e for e in vlist if not e.get(field_name)]
+                # move the shortcut fields into the new indicators
+                indicators = IndicatorsModel.create([{
+                            getattr(cls, name)._attribute_name:
+                            entry.pop(name)
+                            for name in list(entry)
+                            if getattr(
+                                getattr(cls, name, None), '_sample_name',
+                                None) == sample_name}
+                        for entry in entries])
+                for entry, indicators_ in zip(entries, indicators):
+                    entry[field_name] = indicators_.id
             return cls._create(vlist)
         return classmethod(create)
 
+    @staticmethod
+    def write():
+        """This write method wraps the write method of the measured class"""
+        def write(cls, *args):
+            # write shortcut fields of all records together
+            shortcut_args, args = [], list(args)
+            for i in range(1, len(args), 2):
+                shortcuts = {
+                    name: value for name, value in args[i].items()
+                    if hasattr(getattr(cls, name, None), '_sample_name')}
+                if shortcuts:
+                    shortcut_args.extend([args[i - 1], shortcuts])
+                    args[i] = {
+                        name: value for name, value in args[i].items()
+                        if name not in shortcuts}
+            cls._write(*args)
+            if shortcut_args:
+                cls.write_indicators(*shortcut_args)
+        return classmethod(write)
+
     @staticmethod
     def copy(samples):
-        """This create method wraps the create method of the measured class"""
+        """This copy method wraps the copy method of the measured class"""
         def copy(cls, measured_instances, default=None):
             if default is None:
                 default = {}
             default = default.copy()
+            # copies get new indicators, see create
             for sample_name in samples:
-                field_name = '%s_indicators' % sample_name
-                if field_name in default:
-                    default[field_name] = None
-            cls._copy(measured_instances, default=default)
+                default['%s_indicators' % sample_name] = None
+            return cls._copy(measured_instances, default=default)
         return classmethod(copy)
 
     @staticmethod
-    def get_attribute(sample_name):
-        def get_value(self, name):
-            indicators = getattr(self, '%s_indicators' % sample_name)
-            if indicators:
-                attribute_name = getattr(self.__class__, name)._attribute_name
-                value = getattr(indicators, attribute_name)
-                if isinstance(value, tuple):
-                    return [entry.id for entry in value]
-                if isinstance(value, ModelSQL):
-                    return value.id
-                return value
-        return get_value
+    def get_attributes(indicators_model_name):
+        """
+        This getter reads all requested shortcut fields of all records
+
+        The links to the indicators of all samples are read in one read of
+        the measured model and all requested attributes of all samples are
+        read in one read of the indicators model.
+        """
+        def get_values(cls, records, names):
+            IndicatorsModel = Pool().get(indicators_model_name)
+            sample_names = defaultdict(list)
+            for name in names:
+                sample_names[getattr(cls, name)._sample_name].append(name)
+            links = cls.read([r.id for r in records], [
+                    '%s_indicators' % sample_name
+                    for sample_name in sample_names])
+            indicators = {
+                values['id']: values for values in IndicatorsModel.read(
+                    list({
+                            link['%s_indicators' % sample_name]
+                            for link in links for sample_name in sample_names
+                            } - {None}),
+                    list({
+                            getattr(cls, name)._attribute_name
+                            for name in names}))}
+            result = {name: {} for name in names}
+            for link in links:
+                for sample_name, names_ in sample_names.items():
+                    values = indicators.get(
+                        link['%s_indicators' % sample_name], {})
+                    for name in names_:
+                        result[name][link['id']] = values.get(
+                            getattr(cls, name)._attribute_name)
+            return result
+        return classmethod(get_values)
 
     @staticmethod
-    def set_attribute(sample_name):
+    def set_attribute():
         def set_value(cls, measured_instances, name, value):
-            for instance in measured_instances:
-                attribute_name = getattr(cls, name)._attribute_name
-                indicators = getattr(instance, '%s_indicators' % sample_name)
-                if indicators:
-                    indicators.write([indicators], {
-                        attribute_name: value})
+            cls.write_indicators(measured_instances, {name: value})
         return classmethod(set_value)
 
     @staticmethod
-    def search_attribute(sample_name):
+    def write_attributes(indicators_model_name):
+        """
+        This setter writes shortcut fields of many records at once
+
+        It takes the same arguments as write: pairs of measured records and
+        dictionaries of shortcut field names and values. The indicators of
+        all records are grouped by their values and written with one write
+        call, which updates each distinct value once.
+        """
+        def write_values(cls, *args):
+            IndicatorsModel = Pool().get(indicators_model_name)
+            groups = {}
+            actions = iter(args)
+            for measured_instances, values in zip(actions, actions):
+                sample_values = defaultdict(dict)
+                for name, value in values.items():
+                    field = getattr(cls, name)
+                    sample_values[field._sample_name][
+                        field._attribute_name] = value
+                links = cls.read([i.id for i in measured_instances], [
+                        '%s_indicators' % sample_name
+                        for sample_name in sample_values])
+                for sample_name, attributes in sample_values.items():
+                    _, ids = groups.setdefault(
+                        repr(sorted(attributes.items())), (attributes, []))
+                    ids.extend(
+                        link['%s_indicators' % sample_name] for link in links
+                        if link['%s_indicators' % sample_name] is not None)
+            to_write = []
+            for attributes, ids in groups.values():
+                if ids:
+                    to_write.extend([IndicatorsModel.browse(ids), attributes])
+            if to_write:
+                IndicatorsModel.write(*to_write)
+        return classmethod(write_values)
+
+    @staticmethod
+    def search_attribute(indicators_model_name):
+        """
+        This searcher joins the indicators on the indexed link field
+
+        Relational and function attributes are searched by the dotted
+        domain of the link field instead.
+        """
         def search(cls, name, clause):
-            attribute_name = getattr(cls, name)._attribute_name
-            key = '%s_indicators.%s' % (sample_name, attribute_name)
-            return [
-                (key,) + tuple(clause[1:]),
-            ]
+            IndicatorsModel = Pool().get(indicators_model_name)
+            field = getattr(cls, name)
+            link_name = '%s_indicators' % field._sample_name
+            attribute = IndicatorsModel._fields[field._attribute_name]
+            if (isinstance(attribute, fields.Function)
+                    or attribute._type in (
+                        'many2one', 'one2many', 'many2many')):
+                key = '%s.%s' % (link_name, field._attribute_name)
+                return [
+                    (key,) + tuple(clause[1:]),
+                ]
+            measured = cls.__table__()
+            indicators = IndicatorsModel.__table__()
+            condition = attribute.convert_domain(
+                (field._attribute_name,) + tuple(clause[1:]),
+                {None: (indicators, None)}, IndicatorsModel)
+            query = measured.join(
+                indicators,
+                condition=getattr(measured, link_name) == indicators.id
+                ).select(measured.id, where=condition)
+            return [('id', 'in', query)]
         return classmethod(search)
 
+    @staticmethod
+    def setup(setup, samples):
+        """This __setup__ method extends the __setup__ of the measured class"""
+        def __setup__(cls):
+            setup(cls)
+            table = cls.__table__()
+            cls._sql_indexes.update({
+                    Index(table, (
+                            getattr(table, '%s_indicators' % sample_name),
+                            Index.Equality()))
+                    for sample_name in samples})
+        return classmethod(__setup__)
+
     def __new__(cls, measured_class_name, bases, dct):
         # execute PoolMeta.__new__()
         new = super().__new__(cls, measured_class_name, bases, dct)
@@ -1849,6 +3380,18 @@ class IndicatorsMeta(ModelMeta):
         else:
             setattr(new, '_copy', cls._copy(measured_class_name))
         setattr(new, 'copy', cls.copy(samples))
+        new._write = new.write
+        setattr(new, 'write', cls.write())
+        # add indexes on the links to the indicators
+        setattr(new, '__setup__', cls.setup(new.__setup__.__func__, samples))
+
+        # add one getter for all shortcut fields, so they are read together
+        setattr(new, 'get_indicators', cls.get_attributes(
+                indicators_model_name))
+        # add one setter for many shortcut fields, so they are written
+        # together
+        setattr(new, 'write_indicators', cls.write_attributes(
+                indicators_model_name))
 
         # for each sample
         for sample_name in samples:
@@ -1869,23 +3412,21 @@ class IndicatorsMeta(ModelMeta):
                         continue
                     # function field name (e.g. estimated_turnover)
                     field_name = '%s_%s' % (sample_name, attribute_name)
-                    # add function field
+                    # add function field, the copy of the attribute keeps
+                    # the names below apart per sample
                     setattr(new, field_name,
-                            fields.Function(field,
-                                            'get_%s' % field_name,
+                            fields.Function(copy.copy(field),
+                                            'get_indicators',
                                             'set_%s' % field_name,
                                             'search_%s' % field_name))
-                    # save original field name in field to ease later access
+                    # save original names in field to ease later access
                     getattr(new, field_name)._attribute_name = attribute_name
-                    # getter
-                    setattr(new, 'get_%s' % field_name,
-                            cls.get_attribute(sample_name))
+                    getattr(new, field_name)._sample_name = sample_name
                     # setter
-                    setattr(new, 'set_%s' % field_name,
-                            cls.set_attribute(sample_name))
+                    setattr(new, 'set_%s' % field_name, cls.set_attribute())
                     # searcher
                     setattr(new, 'search_%s' % field_name,
-                            cls.search_attribute(sample_name))
+                            cls.search_attribute(indicators_model_name))
 
             # add back reference to the indicator model
             measured_field_name = '%s_%ss' % (
@@ -2177,49 +3718,13 @@ class Artist(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
     @classmethod
     def create(cls, vlist):
         Configuration = Pool().get('collecting_society.configuration')
-        default_roles = [('add', [
-            r.id for r in
-            AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])])]
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            # autocreate sequence
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.artist_sequence.get()
+        # autocreate sequence
+        Configuration.set_codes(vlist, 'artist_sequence')
 
-        acls = {}
         elist = super().create(vlist)
-        for entry in elist:
-            if entry.acl:
-                continue
-            # only normally created artists
-            if entry.entity_origin != 'direct':
-                continue
-            # solo
-            if entry.party and entry.party.web_user:
-                acls[entry.party.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': entry.party.web_user.id,
-                    'roles': default_roles
-                }
-            # group
-            for member in entry.solo_artists:
-                if not member.party or not member.party.web_user:
-                    continue
-                acls[member.party.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': member.party.web_user.id,
-                    'roles': default_roles
-                }
-            # always autocreate creator acl
-            if entry.entity_creator and entry.entity_creator.web_user:
-                acls[entry.entity_creator.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': entry.entity_creator.web_user.id,
-                    'roles': default_roles
-                }
-        AccessControlEntry.create(list(acls.values()))
+        cls.create_default_aces(elist)
 
         return elist
 
@@ -2233,55 +3738,133 @@ class Artist(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
 
     @classmethod
     def write(cls, *args):
-        default_roles = [('add', [
-            r.id for r in
-            AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])])]
-        actions = iter(args)
-        args = []
-        for artists, values in zip(actions, actions):
-            for artist in artists:
-                remaining = []
-                for action, member_ids in values.get('solo_artists', []):
-                    # add aces if not present
-                    if action == 'add':
-                        for member_id in member_ids:
-                            member = cls.search([('id', '=', member_id)])
-                            if not member:
-                                continue
-                            member = member[0]
-                            if not member.party or not member.party.web_user:
-                                continue
-                            remaining.append(member.party.web_user.id)
-                            ace = AccessControlEntry.search([
-                                ('entity', '=', str(artist)),
-                                ('web_user', '=', member.party.web_user)])
-                            if ace:  # keep existing ace
-                                continue
-                            AccessControlEntry.create([{
-                                'entity': str(artist),
-                                'web_user': member.party.web_user.id,
-                                'roles': default_roles}])
-                    # remove existing aces
-                    if action == 'remove':
-                        for member_id in member_ids:
-                            member = cls.search([('id', '=', member_id)])
-                            if not member:
-                                continue
-                            member = member[0]
-                            if not member.party or not member.party.web_user:
-                                continue
-                            # prevent deletion for members with same web_user
-                            if member.party.web_user.id in remaining:
-                                continue
-                            ace = AccessControlEntry.search([
-                                ('entity', '=', str(artist)),
-                                ('web_user', '=', member.party.web_user)])
-                            if not ace:
-                                continue
-                            AccessControlEntry.delete(ace)
-            args.extend((artists, values))
+        cls._sync_member_aces(args)
         super().write(*args)
 
+    @classmethod
+    def _get_default_ace_queries(cls, ids):
+        """
+        Returns the SQL queries of the creator, the solo artist and the
+        members of directly created artists, see AccessControlList
+        """
+        pool = Pool()
+        UserParty = pool.get('web.user-party.party')
+        ArtistArtist = pool.get('artist-artist')
+        artist = cls.__table__()
+        solo = cls.__table__()
+        member = ArtistArtist.__table__()
+        user_party = UserParty.__table__()
+
+        # only normally created artists
+        where = reduce_ids(artist.id, ids) & (artist.entity_origin == 'direct')
+        return [
+            # creator
+            artist.join(
+                user_party,
+                condition=user_party.party == artist.entity_creator
+                ).select(artist.id, user_party.user, where=where),
+            # solo
+            artist.join(
+                user_party, condition=user_party.party == artist.party
+                ).select(artist.id, user_party.user, where=where),
+            # group
+            artist.join(
+                member, condition=member.group_artist == artist.id
+                ).join(
+                solo, condition=solo.id == member.solo_artist
+                ).join(
+                user_party, condition=user_party.party == solo.party
+                ).select(artist.id, user_party.user, where=where),
+            ]
+
+    @classmethod
+    def _sync_member_aces(cls, args):
+        """
+        Synchronizes the ACEs of the web users of added and removed members
+
+        The web users of all affected members and their existing ACEs are read
+        with one query each, the difference is applied with one create and one
+        delete.
+
+        Args:
+            args: the arguments of write()
+        """
+        pool = Pool()
+        Entry = pool.get('ace')
+        UserParty = pool.get('web.user-party.party')
+        artist = cls.__table__()
+        user_party = UserParty.__table__()
+        entry = Entry.__table__()
+        cursor = Transaction().connection.cursor()
+
+        changes = []
+        member_ids = set()
+        for artists, values in zip(args[::2], args[1::2]):
+            actions = [
+                (action, ids) for action, ids in values.get('solo_artists', [])
+                if action in {'add', 'remove'}]
+            if artists and actions:
+                changes.append((artists, actions))
+                member_ids.update(i for _, ids in actions for i in ids)
+        if not member_ids:
+            return
+
+        # web users of the members
+        web_users = {}
+        for sub_ids in grouped_slice(member_ids):
+            cursor.execute(*artist.join(
+                    user_party, condition=user_party.party == artist.party
+                    ).select(
+                    artist.id, user_party.user,
+                    where=reduce_ids(artist.id, sub_ids)))
+            web_users.update(cursor)
+        if not web_users:
+            return
+
+        # existing aces of the web users
+        existing = {}
+        entities = sorted({str(a) for artists, _ in changes for a in artists})
+        for sub_entities in grouped_slice(entities):
+            cursor.execute(*entry.select(
+                    entry.id, entry.entity, entry.web_user,
+                    where=entry.entity.in_(list(sub_entities))
+                    & entry.web_user.in_(list(set(web_users.values())))))
+            for ace_id, entity, web_user in cursor:
+                existing[(entity, web_user)] = ace_id
+
+        to_create, to_delete = set(), set()
+        for artists, actions in changes:
+            for record in artists:
+                added = set()
+                for action, ids in actions:
+                    users = {web_users[i] for i in ids if i in web_users}
+                    if action == 'add':
+                        added |= users
+                    else:
+                        # prevent deletion for members with same web_user
+                        users -= added
+                    for user in users:
+                        key = (str(record), user)
+                        if action == 'add':
+                            to_delete.discard(key)
+                            if key not in existing:
+                                to_create.add(key)
+                        else:
+                            to_create.discard(key)
+                            if key in existing:
+                                to_delete.add(key)
+
+        if to_create:
+            default_roles = [('add', Entry.get_default_role_ids())]
+            Entry.create([{
+                        'entity': entity,
+                        'web_user': web_user,
+                        'roles': default_roles,
+                        } for entity, web_user in sorted(to_create)])
+        if to_delete:
+            Entry.delete(Entry.browse(
+                    [existing[k] for k in sorted(to_delete)]))
+
     @classmethod
     def delete(cls, records):
         for record in records:
@@ -2388,6 +3971,12 @@ class Creation(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
     'Creation'
     __name__ = 'creation'
     _history = True
+    # permissions derived from the permissions on the artist
+    _derived_permissions = {
+        'view_creation':   'view_artist_creations',
+        'edit_creation':   'edit_artist_creations',
+        'delete_creation': 'delete_artist_creations',
+    }
     title = fields.Char(
         'Title', required=True, states=STATES, depends=DEPENDS,
         help='The abstract title of the creation, needed to identify '
@@ -2558,30 +4147,20 @@ class Creation(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
 
     @classmethod
     def create(cls, vlist):
-        Configuration = Pool().get('collecting_society.configuration')
-        default_roles = [('add', [
-            r.id for r in
-            AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])])]
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+        AccessControlEffective = pool.get('ace.effective')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.creation_sequence.get()
+        Configuration.set_codes(vlist, 'creation_sequence')
 
-        acls = {}
         elist = super().create(vlist)
-        for entry in elist:
-            if entry.acl:
-                continue
-            # always autocreate creator acl
-            if entry.entity_creator and entry.entity_creator.web_user:
-                acls[entry.entity_creator.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': entry.entity_creator.web_user.id,
-                    'roles': default_roles
-                }
-        AccessControlEntry.create(list(acls.values()))
+        aces = cls.create_default_aces(elist)
+        # the entities of the new ACEs are updated with the ACEs already
+        updated = {str(a.entity) for a in aces}
+        entities = [str(e) for e in elist if str(e) not in updated]
+        if entities:
+            AccessControlEffective.update(entities)
 
         return elist
 
@@ -2593,6 +4172,17 @@ class Creation(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
         default['code'] = None
         return super().copy(creations, default=default)
 
+    @classmethod
+    def write(cls, *args):
+        AccessControlEffective = Pool().get('ace.effective')
+        super().write(*args)
+        # the derived permissions depend on the artist
+        creations = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'artist' in values for r in records]
+        if creations:
+            AccessControlEffective.update([str(r) for r in creations])
+
     @classmethod
     def search_rec_name(cls, name, clause):
         return [
@@ -2601,24 +4191,30 @@ class Creation(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
             ('title',) + tuple(clause[1:]),
         ]
 
+    @classmethod
+    def _permitted_query(cls, web_user, code):
+        Artist = Pool().get('artist')
+        creation = cls.__table__()
+        query = super()._permitted_query(web_user, code)
+        if code in cls._derived_permissions:
+            query |= creation.select(
+                creation.id,
+                where=creation.artist.in_(Artist._permitted_query(
+                        web_user, cls._derived_permissions[code])))
+        return query
+
     def permits(self, web_user, code, derive=True):
         if super().permits(web_user, code, derive):
             return True
         if not derive:
             return False
-        derivation = {
-            'view_creation':   'view_artist_creations',
-            'edit_creation':   'edit_artist_creations',
-            'delete_creation': 'delete_artist_creations',
-        }
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            return code in effective
+        derivation = self._derived_permissions
         if self.artist:
-            for ace in self.artist.acl:
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code == derivation[code]:
-                            return True
+            return derivation.get(code) in self.artist.get_permission_codes(
+                web_user, [self.artist])[str(self.artist)]
         return False
 
     def permissions(self, web_user, valid_codes=[], derive=True):
@@ -2626,29 +4222,28 @@ class Creation(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
             web_user, valid_codes, derive)
         if not derive:
             return direct_permissions
-        derivation = {
-            'view_artist_creations':   'view_creation',
-            'edit_artist_creations':   'edit_creation',
-            'delete_artist_creations': 'delete_creation',
-        }
+        derivation = {v: k for k, v in self._derived_permissions.items()}
         if not set(valid_codes).intersection(set(derivation.values())):
             return direct_permissions
         permissions = set(direct_permissions)
-        if self.artist:
-            for ace in self.artist.acl:
-                if not derivation:
-                    continue
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code in derivation:
-                            permissions.add(derivation[permission.code])
-                            del derivation[permission.code]
-            if valid_codes:
-                permissions = permissions.intersection(valid_codes)
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            permissions.update(effective)
+        elif self.artist:
+            permissions.update(
+                derivation[c] for c in self.artist.get_permission_codes(
+                    web_user, [self.artist])[str(self.artist)]
+                if c in derivation)
+        if valid_codes:
+            permissions = permissions.intersection(valid_codes)
         return tuple(permissions)
 
+    @classmethod
+    def _get_effective_permissions(cls, creations):
+        return super()._get_effective_permissions(creations) | (
+            cls._get_derived_effective_permissions({
+                    str(c): [c.artist.id] for c in creations if c.artist}))
+
 
 class CreationDerivative(ModelSQL, ModelView, PublicApi):
     'Creation - Original - Derivative'
@@ -2882,6 +4477,12 @@ class Release(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
     __name__ = 'release'
     _history = True
     _rec_name = 'title'
+    # permissions derived from the permissions on the artists
+    _derived_permissions = {
+        'view_release':   'view_artist_releases',
+        'edit_release':   'edit_artist_releases',
+        'delete_release': 'delete_artist_releases',
+    }
 
     # Note: The metaclass adds relations to indicators and shortcut function
     #       fields to their attributes to this class (see metaclass docstring)
@@ -3007,30 +4608,20 @@ class Release(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
 
     @classmethod
     def create(cls, vlist):
-        Configuration = Pool().get('collecting_society.configuration')
-        default_roles = [('add', [
-            r.id for r in
-            AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])])]
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+        AccessControlEffective = pool.get('ace.effective')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.release_sequence.get()
+        Configuration.set_codes(vlist, 'release_sequence')
 
-        acls = {}
         elist = super().create(vlist)
-        for entry in elist:
-            if entry.acl:
-                continue
-            # always autocreate creator acl
-            if entry.entity_creator and entry.entity_creator.web_user:
-                acls[entry.entity_creator.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': entry.entity_creator.web_user.id,
-                    'roles': default_roles
-                }
-        AccessControlEntry.create(list(acls.values()))
+        aces = cls.create_default_aces(elist)
+        # the entities of the new ACEs are updated with the ACEs already
+        updated = {str(a.entity) for a in aces}
+        entities = [str(e) for e in elist if str(e) not in updated]
+        if entities:
+            AccessControlEffective.update(entities)
 
         return elist
 
@@ -3042,6 +4633,28 @@ class Release(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
         default['code'] = None
         return super().copy(releases, default=default)
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Utilisation = pool.get('utilisation')
+        AccessControlEffective = pool.get('ace.effective')
+        super().write(*args)
+        # the start and end of utilisations depend on the production date
+        releases = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'production_date' in values for r in records]
+        if releases:
+            with Transaction().set_context(active_test=False):
+                Utilisation.update_start_end(Utilisation.search([
+                            ('context', 'in', [str(r) for r in releases]),
+                            ]))
+        # the derived permissions depend on the artists
+        releases = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'artists' in values for r in records]
+        if releases:
+            AccessControlEffective.update([str(r) for r in releases])
+
     @classmethod
     def delete(cls, records):
         for record in records:
@@ -3093,24 +4706,33 @@ class Release(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
                     societies.append(society.id)
         return list(set(societies))
 
+    @classmethod
+    def _permitted_query(cls, web_user, code):
+        pool = Pool()
+        Artist = pool.get('artist')
+        ArtistRelease = pool.get('artist-release')
+        artist_release = ArtistRelease.__table__()
+        query = super()._permitted_query(web_user, code)
+        if code in cls._derived_permissions:
+            query |= artist_release.select(
+                artist_release.release,
+                where=artist_release.artist.in_(Artist._permitted_query(
+                        web_user, cls._derived_permissions[code])))
+        return query
+
     def permits(self, web_user, code, derive=True):
         if super().permits(web_user, code, derive):
             return True
         if not derive:
             return False
-        derivation = {
-            'view_release':   'view_artist_releases',
-            'edit_release':   'edit_artist_releases',
-            'delete_release': 'delete_artist_releases',
-        }
-        for artist in self.artists:
-            for ace in artist.acl:
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code == derivation[code]:
-                            return True
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            return code in effective
+        derivation = self._derived_permissions
+        if self.artists:
+            codes = self.artists[0].get_permission_codes(
+                web_user, self.artists)
+            return any(derivation.get(code) in c for c in codes.values())
         return False
 
     def permissions(self, web_user, valid_codes=[], derive=True):
@@ -3118,29 +4740,29 @@ class Release(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
             web_user, valid_codes, derive)
         if not derive:
             return direct_permissions
-        derivation = {
-            'view_artist_releases':   'view_release',
-            'edit_artist_releases':   'edit_release',
-            'delete_artist_releases': 'delete_release',
-        }
+        derivation = {v: k for k, v in self._derived_permissions.items()}
         if not set(valid_codes).intersection(set(derivation.values())):
             return direct_permissions
         permissions = set(direct_permissions)
-        for artist in self.artists:
-            for ace in artist.acl:
-                if not derivation:
-                    continue
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code in derivation:
-                            permissions.add(derivation[permission.code])
-                            del derivation[permission.code]
-            if valid_codes:
-                permissions = permissions.intersection(valid_codes)
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            permissions.update(effective)
+        elif self.artists:
+            codes = self.artists[0].get_permission_codes(
+                web_user, self.artists)
+            permissions.update(
+                derivation[c] for artist_codes in codes.values()
+                for c in artist_codes if c in derivation)
+        if valid_codes:
+            permissions = permissions.intersection(valid_codes)
         return tuple(permissions)
 
+    @classmethod
+    def _get_effective_permissions(cls, releases):
+        return super()._get_effective_permissions(releases) | (
+            cls._get_derived_effective_permissions({
+                    str(r): [a.id for a in r.artists] for r in releases}))
+
 
 class ReleaseTrack(ModelSQL, ModelView, PublicApi):
     'Release Track'
@@ -3352,25 +4974,122 @@ class Event(ModelSQL, ModelView, CurrencyDigits, CurrentState, PublicApi,
     start = fields.Function(
         fields.DateTime(
             'Start', help='Start of the event'),
-        'get_start')
+        'get_start', searcher='search_start_end')
     end = fields.Function(
         fields.DateTime(
             'End', help='End of the event'),
-        'get_end')
+        'get_end', searcher='search_start_end')
+    # materialized shortcuts, see update_start_end()
+    effective_start = fields.DateTime(
+        'Effective Start', readonly=True,
+        help='The confirmed or else estimated start of the event')
+    effective_end = fields.DateTime(
+        'Effective End', readonly=True,
+        help='The confirmed or else estimated end of the event')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table, (table.effective_start, Index.Range())),
+            Index(table, (table.effective_end, Index.Range())),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        EventIndicators = pool.get('event.indicators')
+        table = cls.__table__()
+        confirmed = EventIndicators.__table__()
+        estimated = EventIndicators.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        fill = not table_h.column_exist('effective_start')
+
+        super().__register__(module_name)
+
+        # Migration: materialize effective start and end
+        if fill:
+            cursor.execute(*table.update(
+                    [table.effective_start, table.effective_end], [
+                        Coalesce(*(
+                                indicators.select(
+                                    getattr(indicators, name),
+                                    where=indicators.id == getattr(
+                                        table, '%s_indicators' % sample))
+                                for sample, indicators in [
+                                    ('confirmed', confirmed),
+                                    ('estimated', estimated)]))
+                        for name in ['start', 'end']]))
+
+    @classmethod
+    def create(cls, vlist):
+        events = super().create(vlist)
+        cls.update_start_end(events)
+        return events
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        if any({'confirmed_indicators', 'estimated_indicators'} & set(values)
+                for values in args[1::2]):
+            cls.update_start_end([r for records in args[::2] for r in records])
 
     def get_start(self, name=None):
-        if self.confirmed_indicators and self.confirmed_indicators.start:
-            return self.confirmed_indicators.start
-        if self.estimated_indicators and self.estimated_indicators.start:
-            return self.estimated_indicators.start
-        return None
+        return self.effective_start
 
     def get_end(self, name=None):
-        if self.confirmed_indicators and self.confirmed_indicators.end:
-            return self.confirmed_indicators.end
-        if self.estimated_indicators and self.estimated_indicators.end:
-            return self.estimated_indicators.end
-        return None
+        return self.effective_end
+
+    @classmethod
+    def search_start_end(cls, name, clause):
+        return [
+            ('effective_%s' % name,) + tuple(clause[1:]),
+        ]
+
+    def _get_start_end(self):
+        """
+        Returns the confirmed or else estimated start and end of the event
+        """
+        start = end = None
+        for indicators in [
+                self.confirmed_indicators, self.estimated_indicators]:
+            if indicators:
+                start = start or indicators.start
+                end = end or indicators.end
+        return start, end
+
+    @classmethod
+    def update_start_end(cls, events):
+        """
+        Stores the effective start and end of events
+
+        The events are written with one write per distinct start and end.
+        The utilisations in the context of changed events are updated, too.
+        """
+        Utilisation = Pool().get('utilisation')
+
+        changed = defaultdict(list)
+        for event in events:
+            start_end = event._get_start_end()
+            if start_end != (event.effective_start, event.effective_end):
+                changed[start_end].append(event)
+        if not changed:
+            return
+        to_write = []
+        for (start, end), events_ in changed.items():
+            to_write.extend([events_, {
+                        'effective_start': start,
+                        'effective_end': end,
+                        }])
+        cls.write(*to_write)
+        with Transaction().set_context(active_test=False):
+            Utilisation.update_start_end(Utilisation.search([
+                        ('context', 'in', [
+                                str(event) for events_ in changed.values()
+                                for event in events_]),
+                        ]))
 
 
 class EventPerformance(ModelSQL, ModelView, CurrentState, PublicApi):
@@ -4201,23 +5920,6 @@ class DeviceMessageFingerprint(ModelSQL, ModelView):
         'Data', states={'required': True},
         help='The fingerprint data of a creation sample')
 
-    def get_device(self, name):
-        if self.message:
-            return self.message[0].device.id
-
-
-class DeviceMessageFingerprintMatchStart(ModelView):
-    'Device Message Fingerprint Match Start'
-    __name__ = 'device.message.fingerprint.match.start'
-    fingerprints = fields.One2Many(
-        'device.message.fingerprint', None, 'Fingerprints',
-        states={'required': True}, help='The fingerprints to match')
-
-
-class DeviceMessageFingerprintMatch(Wizard):
-    'Device Message Fingerprint Match'
-    __name__ = 'device.message.fingerprint.match'
-
     # TODO: Create a configuration model for fingerprint services
     fingerprint_services = {
         # algorithm
@@ -4236,6 +5938,214 @@ class DeviceMessageFingerprintMatch(Wizard):
             }
         }
     }
+    # maximum concurrent requests and timeout (seconds) of the services
+    _match_workers = 8
+    _match_timeout = 30
+    # fingerprints per committed batch of the background matching
+    _match_batch_size = 100
+
+    def get_device(self, name):
+        if self.message:
+            return self.message[0].device.id
+
+    def get_match_service(self):
+        """
+        Returns the service for the algorithm and version of the fingerprint,
+        or None if unknown
+        """
+        return self.fingerprint_services.get(
+            self.algorithm, {}).get(self.version)
+
+    @classmethod
+    def query_services(cls, queries):
+        """
+        Queries the fingerprint services concurrently
+
+        The requests are sent over one pooled HTTP session by a thread pool
+        with at most _match_workers requests in flight and a timeout of
+        _match_timeout seconds each.
+
+        Args:
+            queries: list of tuples of fingerprint and service
+
+        Returns:
+            list of responses or request exceptions in the order of queries
+        """
+        if not queries:
+            return []
+        # the payloads are read here, as the transaction is local to a thread
+        payloads = [
+            (service['url'], service['data'](fingerprint), service['verify'])
+            for fingerprint, service in queries]
+        workers = min(cls._match_workers, len(payloads))
+
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=workers, pool_maxsize=workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            def post(payload):
+                url, data, verify = payload
+                try:
+                    return session.post(
+                        url, data=data, verify=verify,
+                        timeout=cls._match_timeout)
+                except requests.exceptions.RequestException as e:
+                    return e
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(post, payloads))
+
+    @staticmethod
+    def parse_response(response):
+        """
+        Returns the parsed response of a service or None, if it failed
+        """
+        if isinstance(response, requests.exceptions.RequestException):
+            return None
+        if response.status_code != 200:
+            return None
+        try:
+            result = json.loads(response.text)
+        except ValueError:
+            return None
+        if not isinstance(result, dict) or not {
+                'score', 'track_id'}.issubset(result):
+            return None
+        return result
+
+    @staticmethod
+    def get_match(service, result, creations):
+        """
+        Returns the matched state and creation of a service result
+
+        Args:
+            service: the fingerprint service
+            result: the parsed response of the service
+            creations: dict of creation id (str) to creation
+
+        Returns:
+            tuple of matched state and creation (or None)
+        """
+        if result['score'] < service['threshold']:
+            return 'fail_score', None
+        if not result['track_id']:
+            return 'fail_code', None
+        creation = creations.get(str(result['track_id']))
+        if not creation:
+            return 'fail_creation', None
+        return 'success', creation
+
+    @classmethod
+    def get_matched_creations(cls, results):
+        """
+        Returns the creations of the service results with one search
+
+        Returns:
+            dict of creation id (str) to creation
+        """
+        Creation = Pool().get('creation')
+        track_ids = list({
+                r['track_id'] for r in results if r and r['track_id']})
+        if not track_ids:
+            return {}
+        return {str(c.id): c for c in Creation.search([
+                    ('id', 'in', track_ids)])}
+
+    @classmethod
+    def set_matches(cls, matches):
+        """
+        Writes the outcome of matches with one write
+
+        The matched creation is only replaced by successful matches.
+
+        Args:
+            matches: list of tuples of fingerprint, matched state and
+                creation (or None)
+        """
+        to_write = defaultdict(list)
+        for fingerprint, matched_state, creation in matches:
+            values = {
+                'matched_state': matched_state,
+                'state': (
+                    'matched' if fingerprint.state == 'created'
+                    else fingerprint.state),
+                }
+            if creation:
+                values['matched_creation'] = creation.id
+            to_write[tuple(sorted(values.items()))].append(fingerprint)
+        args = []
+        for values, fingerprints in to_write.items():
+            args.extend((fingerprints, dict(values)))
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def match_queued(cls):
+        """
+        Matches the fingerprints in state created in the background
+
+        The fingerprints are processed in committed batches in the order of
+        their ids. The outcome is recorded per fingerprint without interrupting
+        the batch, so a crashed run resumes with the remaining fingerprints.
+        Fingerprints with an unknown service or without data are skipped and
+        failed requests are retried by the next run.
+
+        Returns:
+            Counter of the outcomes
+        """
+        transaction = Transaction()
+        progress = Counter()
+        last_id = 0
+        while True:
+            fingerprints = cls.search([
+                    ('state', '=', 'created'),
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=cls._match_batch_size)
+            if not fingerprints:
+                break
+            last_id = fingerprints[-1].id
+
+            queries = []
+            for fingerprint in fingerprints:
+                service = fingerprint.get_match_service()
+                if not service or not fingerprint.data:
+                    progress['skipped'] += 1
+                    continue
+                queries.append((fingerprint, service))
+            results = [
+                cls.parse_response(r) for r in cls.query_services(queries)]
+            creations = cls.get_matched_creations(results)
+
+            matches = []
+            for (fingerprint, service), result in zip(queries, results):
+                if result is None:
+                    progress['error'] += 1
+                    continue
+                matched_state, creation = cls.get_match(
+                    service, result, creations)
+                progress[matched_state] += 1
+                matches.append((fingerprint, matched_state, creation))
+            cls.set_matches(matches)
+            transaction.commit()
+            logger.info(
+                'matching fingerprints: %s', ', '.join(
+                    '%s %s' % (k, v) for k, v in sorted(progress.items())))
+        return progress
+
+
+class DeviceMessageFingerprintMatchStart(ModelView):
+    'Device Message Fingerprint Match Start'
+    __name__ = 'device.message.fingerprint.match.start'
+    fingerprints = fields.One2Many(
+        'device.message.fingerprint', None, 'Fingerprints',
+        states={'required': True}, help='The fingerprints to match')
+
+
+class DeviceMessageFingerprintMatch(Wizard):
+    'Device Message Fingerprint Match'
+    __name__ = 'device.message.fingerprint.match'
 
     start = StateView(
         'device.message.fingerprint.match.start',
@@ -4260,9 +6170,11 @@ class DeviceMessageFingerprintMatch(Wizard):
         }
 
     def transition_match(self):
-        Warning = Pool().get('res.user.warning')
-        Creation = Pool().get('creation')
-        services = self.fingerprint_services
+        pool = Pool()
+        Warning = pool.get('res.user.warning')
+        Fingerprint = pool.get('device.message.fingerprint')
+        services = Fingerprint.fingerprint_services
+        queries = []
         for fingerprint in self.start.fingerprints:
 
             # sanity check: overwrite match
@@ -4310,20 +6222,18 @@ class DeviceMessageFingerprintMatch(Wizard):
                         'contains no data.' % fingerprint.id)
                 continue
 
-            # query fingerprint service
-            service = algorithm[fingerprint.version]
-            try:
-                request = requests.post(
-                    service['url'],
-                    data=service['data'](fingerprint),
-                    verify=service['verify']
-                )
-            except requests.exceptions.RequestException as e:
+            queries.append((fingerprint, algorithm[fingerprint.version]))
+
+        # query fingerprint services concurrently
+        responses = Fingerprint.query_services(queries)
+        results = []
+        for (fingerprint, service), request in zip(queries, responses):
+            if isinstance(request, requests.exceptions.RequestException):
                 raise UserError(
                     'Fingerprint Service Error',
                     'The service for algorithm "%s" version "%s" returned:\n\n'
                     '%s' % (
-                        fingerprint.algorithm, fingerprint.version, e))
+                        fingerprint.algorithm, fingerprint.version, request))
 
             # sanity check: response code
             if request.status_code != 200:
@@ -4338,14 +6248,23 @@ class DeviceMessageFingerprintMatch(Wizard):
                         '- Reason: %s' % (
                             fingerprint.algorithm, fingerprint.version,
                             request.status_code, request.reason))
+                results.append(None)
                 continue
 
             # parse fingerprint service response
             # TODO: log response
-            response = json.loads(request.text)
+            results.append(json.loads(request.text))
+
+        creations = Fingerprint.get_matched_creations(results)
+        matches = []
+        for (fingerprint, service), response in zip(queries, results):
+            if response is None:
+                continue
+            matched_state, creation = Fingerprint.get_match(
+                service, response, creations)
 
             # sanity check: low score
-            if response['score'] < service['threshold']:
+            if matched_state == 'fail_score':
                 warning_name = 'lowfingerprintscore,%s' % fingerprint.id
                 if Warning.check(warning_name):
                     raise UserWarning(
@@ -4354,29 +6273,18 @@ class DeviceMessageFingerprintMatch(Wizard):
                         'matching score "%s" is lower than "%s"' % (
                             fingerprint.id, response['score'],
                             service['threshold']))
-                fingerprint.matched_state = 'fail_score'
-                if fingerprint.state == 'created':
-                    fingerprint.state = 'matched'
-                fingerprint.save()
-                continue
 
             # sanity check: empty track_id
-            if not response['track_id']:
+            elif matched_state == 'fail_code':
                 warning_name = 'nocreationcode,%s' % fingerprint.id
                 if Warning.check(warning_name):
                     raise UserWarning(
                         warning_name, 'No Creation Code',
                         'The fingerprint "%s" cannot be matched, because an '
                         'empty creation code was returned.' % fingerprint.id)
-                fingerprint.matched_state = 'fail_code'
-                if fingerprint.state == 'created':
-                    fingerprint.state = 'matched'
-                fingerprint.save()
-                continue
 
             # sanity check: unknown creation
-            creations = Creation.search([('id', '=', response['track_id'])])
-            if not creations:
+            elif matched_state == 'fail_creation':
                 warning_name = 'creationnotfound,%s' % fingerprint.id
                 if Warning.check(warning_name):
                     raise UserWarning(
@@ -4385,18 +6293,11 @@ class DeviceMessageFingerprintMatch(Wizard):
                         'corresponding creation code "%s" was not found in '
                         'the database.' % (
                             fingerprint.id, response['track_id']))
-                fingerprint.matched_state = 'fail_creation'
-                if fingerprint.state == 'created':
-                    fingerprint.state = 'matched'
-                fingerprint.save()
-                continue
 
-            # update fingerprint
-            fingerprint.matched_creation = creations[0]
-            fingerprint.matched_state = 'success'
-            if fingerprint.state == 'created':
-                fingerprint.state = 'matched'
-            fingerprint.save()
+            matches.append((fingerprint, matched_state, creation))
+
+        # update fingerprints
+        Fingerprint.set_matches(matches)
 
         return 'end'
 
@@ -4880,14 +6781,21 @@ class Utilisation(ModelSQL, ModelView, CurrencyDigits, CurrentState,
             'Start', depends=DEPENDS, states={
                 'required': True,
             }, help='Start of the period of utilisation'),
-        'get_start', 'set_start')
+        'get_start', 'set_start', 'search_start_end')
     end_override = fields.DateTime(
         'End',
         help='End of the period of utilisation, if setter is used')
     end = fields.Function(
         fields.DateTime(
             'End', help='End of the period of utilisation'),
-        'get_end', 'set_end')
+        'get_end', 'set_end', 'search_start_end')
+    # materialized start and end, see update_start_end()
+    effective_start = fields.DateTime(
+        'Effective Start', readonly=True,
+        help='The start of the period of utilisation')
+    effective_end = fields.DateTime(
+        'Effective End', readonly=True,
+        help='The end of the period of utilisation')
     confirmation = fields.Selection(
         [
             (None, ''),
@@ -4963,6 +6871,10 @@ class Utilisation(ModelSQL, ModelView, CurrencyDigits, CurrentState,
             ('code_uniq', Unique(table, table.code),
              'The code of the utilisation must be unique.')
         ]
+        cls._sql_indexes.update({
+            Index(table, (table.effective_start, Index.Range())),
+            Index(table, (table.effective_end, Index.Range())),
+        })
         # cls._order.insert(1, ('start', 'ASC'))
         # cls._error_messages.update({
         #     'missing_account_revenue': 'Product "%(product)s" misses a '
@@ -4971,6 +6883,68 @@ class Utilisation(ModelSQL, ModelView, CurrencyDigits, CurrentState,
         #     ' is missing a distribution product or administration product.',
         # })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Event = pool.get('event')
+        Release = pool.get('release')
+        Tariff = pool.get('tariff_system.tariff')
+        TariffCategory = pool.get('tariff_system.category')
+        table = cls.__table__()
+        event = Event.__table__()
+        release = Release.__table__()
+        tariff = Tariff.__table__()
+        category = TariffCategory.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        fill = not table_h.column_exist('effective_start')
+
+        super().__register__(module_name)
+
+        # Migration: materialize effective start and end, see _get_start_end
+        if fill:
+            is_release = table.context == Concat('release,', release.id)
+            is_event = table.context == Concat('event,', event.id)
+            if backend.name == 'sqlite':
+                production_start = SQLiteDateTime(release.production_date)
+                production_end = SQLiteDateTime(
+                    release.production_date, '+1 day')
+            else:
+                production_start = Cast(release.production_date, 'TIMESTAMP')
+                production_end = production_start + Literal(
+                    datetime.timedelta(days=1))
+            reproduction = Exists(tariff.join(
+                    category, condition=category.id == tariff.category
+                    ).join(
+                    release, condition=is_release
+                    ).select(
+                    release.id,
+                    where=(tariff.id == table.tariff)
+                    & (category.code == 'C')
+                    & (release.production_date != Null)))
+            live = Exists(tariff.join(
+                    category, condition=category.id == tariff.category
+                    ).select(
+                    tariff.id,
+                    where=(tariff.id == table.tariff)
+                    & (category.code == 'L')
+                    & table.context.like('event,%')))
+            cursor.execute(*table.update(
+                    [table.effective_start, table.effective_end], [
+                        Case(
+                            (reproduction, release.select(
+                                    production_start, where=is_release)),
+                            (live, event.select(
+                                    event.effective_start, where=is_event)),
+                            else_=table.start_override),
+                        Case(
+                            (reproduction, release.select(
+                                    production_end, where=is_release)),
+                            (live, event.select(
+                                    event.effective_end, where=is_event)),
+                            else_=table.end_override),
+                        ]))
+
     @staticmethod
     def default_state():
         return 'created'
@@ -4985,11 +6959,17 @@ class Utilisation(ModelSQL, ModelView, CurrencyDigits, CurrentState,
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.utilisation_sequence.get()
-        return super().create(vlist)
+        Configuration.set_codes(vlist, 'utilisation_sequence')
+        utilisations = super().create(vlist)
+        cls.update_start_end(utilisations)
+        return utilisations
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        if any({'start_override', 'end_override', 'tariff', 'context'}
+                & set(values) for values in args[1::2]):
+            cls.update_start_end([r for records in args[::2] for r in records])
 
     @classmethod
     def copy(cls, utilisations, default=None):
@@ -5001,108 +6981,92 @@ class Utilisation(ModelSQL, ModelView, CurrencyDigits, CurrentState,
 
     @classmethod
     def set_start(cls, utilisations, name, start):
-        for utilisation in utilisations:
-            # if utilisation.context is not None:
-            #     return None
-            utilisation.start_override = start
-            utilisation.save()
+        # if utilisation.context is not None:
+        #     return None
+        cls.write(utilisations, {'start_override': start})
 
     def get_start(self, name=None):
-        if self.context:
-            if self.tariff.category.code == 'C':  # reproduction
-                if self.context.production_date is not None:  # return proddate
-                    return datetime.datetime.combine(
-                        self.context.production_date,
-                        datetime.time(0, 0, 0, 0)
-                    )
-            if self.tariff.category.code == 'L':  # live
-                return self.context.start  # event start date
-
-        # all other tariffs get the start date from a manually entered date
-        return self.start_override
+        return self.effective_start
 
     @classmethod
     def set_end(cls, utilisations, name, end):
-        for utilisation in utilisations:
-            # if utilisation.context is not None:
-            #     return None
-            utilisation.end_override = end
-            utilisation.save()
+        # if utilisation.context is not None:
+        #     return None
+        cls.write(utilisations, {'end_override': end})
 
     def get_end(self, name=None):
+        return self.effective_end
+
+    @classmethod
+    def search_start_end(cls, name, clause):
+        return [
+            ('effective_%s' % name,) + tuple(clause[1:]),
+        ]
+
+    def _get_start_end(self):
+        """
+        Returns the start and end of the period of utilisation
+        """
         if self.context:
             if self.tariff.category.code == 'C':  # reproduction
                 if self.context.production_date is not None:  # return proddate
-                    return datetime.datetime.combine(         # + 1
-                        self.context.production_date + datetime.timedelta(
-                            days=1),
-                        datetime.time(0, 0, 0, 0)
-                    )
+                    start = datetime.datetime.combine(
+                        self.context.production_date,
+                        datetime.time(0, 0, 0, 0))
+                    return start, start + datetime.timedelta(days=1)
             if self.tariff.category.code == 'L':  # live
-                return self.context.end  # event end date
+                return self.context.start, self.context.end  # event dates
 
-        # all other tariffs get the end date from a manually entered date
-        return self.end_override
+        # all other tariffs get the dates from manually entered dates
+        return self.start_override, self.end_override
 
-    def _get_invoice_lines(self):
-        '''
-        Returns invoice lines for each utilisation
+    @classmethod
+    def update_start_end(cls, utilisations):
+        """
+        Stores the effective start and end of utilisations
+
+        The start and end depend on the overrides, the tariff category and
+        the context of the utilisation (see _get_start_end) and need to be
+        updated, if one of them changes. The utilisations are written with
+        one write per distinct start and end.
+        """
+        changed = defaultdict(list)
+        for utilisation in utilisations:
+            start_end = utilisation._get_start_end()
+            if start_end != (
+                    utilisation.effective_start, utilisation.effective_end):
+                changed[start_end].append(utilisation)
+        to_write = []
+        for (start, end), utilisations_ in changed.items():
+            to_write.extend([utilisations_, {
+                        'effective_start': start,
+                        'effective_end': end,
+                        }])
+        if to_write:
+            cls.write(*to_write)
+
+    def _get_invoice_line_values(self, templates):
         '''
-        pool = Pool()
-        InvoiceLine = pool.get('account.invoice.line')
+        Returns the values of the invoice lines for the utilisation
 
+        Args:
+            templates: invoice line templates for each tariff category id
+                (see TariffCategory.get_invoice_line_templates)
+        '''
         if self.state != 'confirmed':
             return []
 
-        distribution_product = self.tariff.category.distribution_product
-        administration_product = self.tariff.category.administration_product
-        if not all([distribution_product, administration_product]):
-            self.raise_user_error('missing_tariff_product', {
-                'tariff_category': self.tariff.category.rec_name})
-
-        distribution_invoice_line = InvoiceLine()
-        distribution_invoice_line.product = distribution_product
-        distribution_invoice_line.account =  \
-            distribution_product.account_revenue_used
-        if not distribution_invoice_line.account:
-            self.raise_user_error('missing_account_revenue', {
-                'product': distribution_product.rec_name,
-            })
-        distribution_invoice_line.type = 'line'
-        distribution_invoice_line.description = '{}: {}'.format(
-            'Distribution', self.code)
-        distribution_invoice_line.origin = self
-        distribution_invoice_line.quantity = 1
-        distribution_invoice_line.unit = distribution_product.default_uom
-        distribution_invoice_line.unit_price = (
-            self.confirmed_distribution_amount
-            or distribution_product.list_price)
-        distribution_invoice_line.taxes = (
-            distribution_product.customer_taxes_used)
-        distribution_invoice_line.invoice_type = 'out'
-
-        administration_invoice_line = InvoiceLine()
-        administration_invoice_line.product = administration_product
-        administration_invoice_line.account =  \
-            administration_product.account_revenue_used
-        if not administration_invoice_line.account:
-            self.raise_user_error('missing_account_revenue', {
-                'product': administration_product.rec_name,
-            })
-        administration_invoice_line.type = 'line'
-        administration_invoice_line.description = '{}: {}'.format(
-            'Administration', self.code)
-        administration_invoice_line.origin = self
-        administration_invoice_line.quantity = 1
-        administration_invoice_line.unit = administration_product.default_uom
-        administration_invoice_line.unit_price = (
-            self.confirmed_administration_fee
-            or administration_product.list_price)
-        administration_invoice_line.taxes =  \
-            administration_product.customer_taxes_used
-        administration_invoice_line.invoice_type = 'out'
-
-        return [distribution_invoice_line, administration_invoice_line]
+        lines = []
+        for price_field, template in templates[self.tariff.category.id]:
+            values = template.copy()
+            values['description'] = '{}: {}'.format(
+                template['description'], self.code)
+            values['origin'] = str(self)
+            values['unit_price'] = (
+                getattr(self, price_field) or template['unit_price'])
+            values['taxes'] = [('add', list(template['taxes']))]
+            lines.append(values)
+        return lines
 
 
 class UtilisationCreationlist(ModelSQL, ModelView, CurrencyDigits,
@@ -5222,10 +7186,7 @@ class HarddiskLabel(ModelSQL, ModelView, CurrentState):
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.harddisk_label_sequence.get()
+        Configuration.set_codes(vlist, 'harddisk_label_sequence')
         return super().create(vlist)
 
     @classmethod
@@ -5351,10 +7312,7 @@ class FilesystemLabel(ModelSQL, ModelView, CurrentState):
         Configuration = Pool().get('collecting_society.configuration')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.filesystem_label_sequence.get()
+        Configuration.set_codes(vlist, 'filesystem_label_sequence')
         return super().create(vlist)
 
     @classmethod
@@ -5432,6 +7390,12 @@ class Content(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
     __name__ = 'content'
     _rec_name = 'uuid'
     _history = True
+    # permissions derived from the permissions on the artist of the creation
+    _derived_permissions = {
+        'view_content':   'view_artist_content',
+        'edit_content':   'edit_artist_content',
+        'delete_content': 'delete_artist_content',
+    }
 
     code = fields.Char(
         'Code', required=True, states={
@@ -5671,30 +7635,20 @@ class Content(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
 
     @classmethod
     def create(cls, vlist):
-        Configuration = Pool().get('collecting_society.configuration')
-        default_roles = [('add', [
-            r.id for r in
-            AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])])]
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+        AccessControlEffective = pool.get('ace.effective')
 
         vlist = [x.copy() for x in vlist]
-        for values in vlist:
-            if not values.get('code'):
-                config = Configuration(1)
-                values['code'] = config.content_sequence.get()
+        Configuration.set_codes(vlist, 'content_sequence')
 
-        acls = {}
         elist = super().create(vlist)
-        for entry in elist:
-            if entry.acl:
-                continue
-            # always autocreate creator acl
-            if entry.entity_creator and entry.entity_creator.web_user:
-                acls[entry.entity_creator.web_user.id] = {
-                    'entity': str(entry),
-                    'web_user': entry.entity_creator.web_user.id,
-                    'roles': default_roles
-                }
-        AccessControlEntry.create(list(acls.values()))
+        aces = cls.create_default_aces(elist)
+        # the entities of the new ACEs are updated with the ACEs already
+        updated = {str(a.entity) for a in aces}
+        entities = [str(e) for e in elist if str(e) not in updated]
+        if entities:
+            AccessControlEffective.update(entities)
 
         return elist
 
@@ -5706,6 +7660,17 @@ class Content(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
         default['code'] = None
         return super().copy(contents, default=default)
 
+    @classmethod
+    def write(cls, *args):
+        AccessControlEffective = Pool().get('ace.effective')
+        super().write(*args)
+        # the derived permissions depend on the creation
+        contents = [
+            r for records, values in zip(args[::2], args[1::2])
+            if 'creation' in values for r in records]
+        if contents:
+            AccessControlEffective.update([str(r) for r in contents])
+
     def get_rec_name(self, name):
         result = '%s: %s %s %s %sHz %sBit' % (
             self.name,
@@ -5735,24 +7700,36 @@ class Content(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
             ('name',) + tuple(clause[1:]),
         ]
 
+    @classmethod
+    def _permitted_query(cls, web_user, code):
+        pool = Pool()
+        Artist = pool.get('artist')
+        Creation = pool.get('creation')
+        content = cls.__table__()
+        creation = Creation.__table__()
+        query = super()._permitted_query(web_user, code)
+        if code in cls._derived_permissions:
+            query |= content.join(
+                creation, condition=content.creation == creation.id
+                ).select(
+                content.id,
+                where=creation.artist.in_(Artist._permitted_query(
+                        web_user, cls._derived_permissions[code])))
+        return query
+
     def permits(self, web_user, code, derive=True):
         if super().permits(web_user, code, derive):
             return True
         if not derive:
             return False
-        derivation = {
-            'view_content':   'view_artist_content',
-            'edit_content':   'edit_artist_content',
-            'delete_content': 'delete_artist_content',
-        }
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            return code in effective
+        derivation = self._derived_permissions
         if self.creation and self.creation.artist:
-            for ace in self.creation.artist.acl:
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code == derivation[code]:
-                            return True
+            artist = self.creation.artist
+            return derivation.get(code) in artist.get_permission_codes(
+                web_user, [artist])[str(artist)]
         return False
 
     def permissions(self, web_user, valid_codes=[], derive=True):
@@ -5760,29 +7737,30 @@ class Content(ModelSQL, ModelView, EntityOrigin, AccessControlList, PublicApi,
             web_user, valid_codes, derive)
         if not derive:
             return direct_permissions
-        derivation = {
-            'view_artist_content':   'view_content',
-            'edit_artist_content':   'edit_content',
-            'delete_artist_content': 'delete_content',
-        }
-        if not set([valid_codes]).intersection(set(derivation.values())):
+        derivation = {v: k for k, v in self._derived_permissions.items()}
+        if not set(valid_codes).intersection(set(derivation.values())):
             return direct_permissions
         permissions = set(direct_permissions)
-        if self.creation and self.creation.artist:
-            for ace in self.creation.artist.acl:
-                if not derivation:
-                    continue
-                if ace.web_user != web_user:
-                    continue
-                for role in ace.roles:
-                    for permission in role.permissions:
-                        if permission.code in derivation:
-                            permissions.add(derivation[permission.code])
-                            del derivation[permission.code]
-            if valid_codes:
-                permissions = permissions.intersection(valid_codes)
+        effective = self._get_effective_codes(web_user)
+        if effective is not None:
+            permissions.update(effective)
+        elif self.creation and self.creation.artist:
+            artist = self.creation.artist
+            permissions.update(
+                derivation[c] for c in artist.get_permission_codes(
+                    web_user, [artist])[str(artist)]
+                if c in derivation)
+        if valid_codes:
+            permissions = permissions.intersection(valid_codes)
         return tuple(permissions)
 
+    @classmethod
+    def _get_effective_permissions(cls, contents):
+        return super()._get_effective_permissions(contents) | (
+            cls._get_derived_effective_permissions({
+                    str(c): [c.creation.artist.id] for c in contents
+                    if c.creation and c.creation.artist}))
+
 
 class Checksum(ModelSQL, ModelView):
     'Checksum'
@@ -5843,7 +7821,7 @@ acl_objects = [
 ]
 
 
-class AccessControlEntry(ModelSQL, ModelView):
+class AccessControlEntry(AccessControlCaches, ModelSQL, ModelView):
     'Access Control Entry'
     __name__ = 'ace'
     _history = True
@@ -5884,8 +7862,28 @@ class AccessControlEntry(ModelSQL, ModelView):
              'Error!\nAn ACE for the web user and entity already exists.'),
         ]
 
+    @classmethod
+    def get_default_role_ids(cls):
+        """
+        Returns the IDs of the default access roles
+
+        The IDs are memoized for the rest of the transaction.
+        """
+        memo = _transaction_memo('ace.default_roles')
+        if 'ids' not in memo:
+            memo['ids'] = [
+                r.id for r in
+                AccessRole.search([('name', 'in', DEFAULT_ACCESS_ROLES)])]
+        return memo['ids']
+
+    @classmethod
+    def _get_effective_entities(cls, records):
+        return {
+            str(e.entity) for e in cls.browse([r.id for r in records])
+            if e.entity}
+
 
-class AccessControlEntryRole(ModelSQL, ModelView):
+class AccessControlEntryRole(AccessControlCaches, ModelSQL, ModelView):
     'Access Control Entry - Access Role'
     __name__ = 'ace-ace.role'
     _history = True
@@ -5898,8 +7896,177 @@ class AccessControlEntryRole(ModelSQL, ModelView):
     #     'Including Subobjects',  # TODO: require for artist, invisible else
     #     help="Does the role also apply to the subobjects?")
 
+    @classmethod
+    def _get_effective_entities(cls, records):
+        return {
+            str(r.ace.entity) for r in cls.browse([r.id for r in records])
+            if r.ace.entity}
+
+
+class AccessControlEffective(ModelSQL):
+    'Access Control Effective Permission'
+    __name__ = 'ace.effective'
+
+    web_user = fields.Many2One(
+        'web.user', 'Web User', required=True, ondelete='CASCADE',
+        help='The web user interacting with an object.')
+    entity = fields.Reference(
+        'Object', acl_objects, required=True,
+        help='The object being interacted with.')
+    code = fields.Char(
+        'Code', required=True,
+        help='The code of a direct or derived permission of the web user.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        cls._sql_constraints = [
+            ('web_user_entity_code_uniq',
+             Unique(table, table.web_user, table.entity, table.code),
+             'Error!\nThe effective permission already exists.'),
+        ]
+        cls._sql_indexes.update({
+                Index(
+                    table,
+                    (table.web_user, Index.Equality()),
+                    (table.code, Index.Equality())),
+                Index(table, (table.entity, Index.Equality())),
+                })
+
+    @staticmethod
+    def enabled():
+        """
+        Returns True, if the effective permissions are materialized
+        """
+        Configuration = Pool().get('collecting_society.configuration')
+        return bool(Configuration.get_cached().effective_permissions)
+
+    @classmethod
+    def get_permission_codes(cls, web_user, entities):
+        """
+        Returns the effective permission codes of a web user for entities
+
+        The codes include the derived permissions and are memoized for the
+        rest of the transaction.
+
+        Args:
+            web_user: the web user (or its id)
+            entities: iterable of entities with an ACL
+
+        Returns:
+            dict of entity reference (str) to frozenset of permission codes
+        """
+        web_user_id = getattr(web_user, 'id', web_user)
+        keys = [str(entity) for entity in entities]
+        if web_user_id is None:
+            return dict.fromkeys(keys, frozenset())
+        memo = _transaction_memo('ace.effective')
+        missing = {k for k in keys if (web_user_id, k) not in memo}
+        if missing:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            codes = defaultdict(set)
+            for sub_keys in grouped_slice(sorted(missing)):
+                cursor.execute(*table.select(
+                        table.entity, table.code,
+                        where=(table.web_user == web_user_id)
+                        & table.entity.in_(list(sub_keys))))
+                for entity, code in cursor:
+                    codes[entity].add(code)
+            for key in missing:
+                memo[(web_user_id, key)] = frozenset(codes[key])
+        return {key: memo[(web_user_id, key)] for key in keys}
+
+    @classmethod
+    def permitted_query(cls, Model, web_user, code):
+        """
+        Returns an SQL query of the IDs of the entities of a model, for which
+        the web user has the effective permission code
+        """
+        table = cls.__table__()
+        return table.select(
+            Cast(
+                Substring(
+                    table.entity,
+                    Position(',', table.entity) + Literal(1)),
+                Model.id.sql_type().base),
+            where=(table.web_user == getattr(web_user, 'id', web_user))
+            & (table.code == code)
+            & table.entity.like(Model.__name__ + ',%'))
+
+    @classmethod
+    def update(cls, entities=None):
+        """
+        Recomputes the effective permissions of entities
+
+        The permissions derived from an artist are recomputed with the artist
+        and the permissions derived from a creation with the creation. If the
+        permissions are not materialized, all rows are removed.
 
-class AccessRole(ModelSQL, ModelView):
+        Args:
+            entities: iterable of entity references (str), None for all
+        """
+        pool = Pool()
+        Creation = pool.get('creation')
+        Release = pool.get('release')
+        Content = pool.get('content')
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        _clear_transaction_memo('ace.effective')
+        ids = defaultdict(set)
+        if entities is None:
+            cursor.execute(*table.delete())
+            if not cls.enabled():
+                return
+            for model, _ in acl_objects:
+                model_table = pool.get(model).__table__()
+                cursor.execute(*model_table.select(model_table.id))
+                ids[model].update(i for i, in cursor)
+        else:
+            if not cls.enabled():
+                return
+            for entity in entities:
+                model, id_ = entity.split(',')
+                ids[model].add(int(id_))
+            with transaction.set_context(active_test=False):
+                artist_ids = list(ids['artist'])
+                if artist_ids:
+                    ids['creation'].update(c.id for c in Creation.search([
+                                ('artist', 'in', artist_ids)]))
+                    ids['release'].update(r.id for r in Release.search([
+                                ('artists', 'in', artist_ids)]))
+                creation_ids = list(ids['creation'])
+                if creation_ids:
+                    ids['content'].update(c.id for c in Content.search([
+                                ('creation', 'in', creation_ids)]))
+            keys = [
+                '%s,%s' % (m, i) for m, model_ids in ids.items()
+                for i in model_ids]
+            for sub_keys in grouped_slice(keys):
+                cursor.execute(*table.delete(
+                        where=table.entity.in_(list(sub_keys))))
+
+        rows = set()
+        with transaction.set_context(active_test=False):
+            for model, model_ids in ids.items():
+                Model = pool.get(model)
+                for sub_ids in grouped_slice(model_ids):
+                    # skip deleted entities
+                    records = Model.search([('id', 'in', list(sub_ids))])
+                    rows |= Model._get_effective_permissions(records)
+        for sub_rows in grouped_slice(sorted(rows)):
+            cursor.execute(*table.insert(
+                    [table.web_user, table.entity, table.code,
+                        table.create_uid, table.create_date],
+                    [[web_user, entity, code, transaction.user,
+                        CurrentTimestamp()]
+                        for web_user, entity, code in sub_rows]))
+
+
+class AccessRole(AccessControlCaches, ModelSQL, ModelView):
     'Access Role'
     __name__ = 'ace.role'
     _history = True
@@ -5913,6 +8080,82 @@ class AccessRole(ModelSQL, ModelView):
         help='Permissions of a role.')
     permissions_list = fields.Function(
         fields.Char('Permissions'), 'on_change_with_permissions_list')
+    _permission_bits_cache = Cache('ace.role.permission_bits', context=False)
+
+    @classmethod
+    def get_permission_bits(cls):
+        """
+        Returns the permission codes as bits and the roles as bitsets
+
+        Each permission code is assigned one bit and each role the bitset of
+        its permission codes, so a permission test is a dictionary lookup and
+        a bit test. The bitsets are cached until a role, permission or their
+        relation is modified (see AccessControlCaches).
+
+        Returns:
+            tuple of dict of permission code to bit (int) and dict of Role ID
+            (int) to bitset (int)
+        """
+        bits = cls._permission_bits_cache.get('bits')
+        if bits is not None:
+            return bits
+        pool = Pool()
+        RolePermission = pool.get('ace.role-ace.permission')
+        Permission = pool.get('ace.permission')
+        role_permission = RolePermission.__table__()
+        permission = Permission.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*permission.select(
+                permission.code, order_by=[permission.id]))
+        code_bits = {}
+        for code, in cursor:
+            code_bits.setdefault(code, 1 << len(code_bits))
+        cursor.execute(*role_permission.join(
+                permission,
+                condition=permission.id == role_permission.permission
+                ).select(role_permission.role, permission.code))
+        role_bits = defaultdict(int)
+        for role, code in cursor:
+            role_bits[role] |= code_bits[code]
+        bits = (code_bits, dict(role_bits))
+        cls._permission_bits_cache.set('bits', bits)
+        return bits
+
+    @classmethod
+    def get_entities(cls, roles):
+        """
+        Returns the references of the entities with ACEs granting roles
+        """
+        pool = Pool()
+        Entry = pool.get('ace')
+        EntryRole = pool.get('ace-ace.role')
+        entry = Entry.__table__()
+        entry_role = EntryRole.__table__()
+        cursor = Transaction().connection.cursor()
+
+        entities = set()
+        for sub_roles in grouped_slice(roles):
+            cursor.execute(*entry.join(
+                    entry_role, condition=entry_role.ace == entry.id
+                    ).select(
+                    entry.entity,
+                    where=reduce_ids(
+                        entry_role.role, [r.id for r in sub_roles]),
+                    group_by=[entry.entity]))
+            entities.update(e for e, in cursor)
+        return entities
+
+    @classmethod
+    def clear_access_control_caches(cls):
+        super().clear_access_control_caches()
+        cls._permission_bits_cache.clear()
+        # the default roles are looked up by name
+        _clear_transaction_memo('ace.default_roles')
+
+    @classmethod
+    def _get_effective_entities(cls, records):
+        return cls.get_entities(records)
 
     @fields.depends('permissions')
     def on_change_with_permissions_list(self, name=None):
@@ -5924,7 +8167,7 @@ class AccessRole(ModelSQL, ModelView):
         return "\n".join([n for e in permissions for n in permissions[e]])
 
 
-class AccessRolePermission(ModelSQL, ModelView):
+class AccessRolePermission(AccessControlCaches, ModelSQL, ModelView):
     'Access Role - Access Permission'
     __name__ = 'ace.role-ace.permission'
     _history = True
@@ -5935,8 +8178,20 @@ class AccessRolePermission(ModelSQL, ModelView):
         'ace.permission', 'Permission',
         required=True, ondelete='CASCADE')
 
+    @classmethod
+    def clear_access_control_caches(cls):
+        AccessRole = Pool().get('ace.role')
+        super().clear_access_control_caches()
+        AccessRole._permission_bits_cache.clear()
+
+    @classmethod
+    def _get_effective_entities(cls, records):
+        AccessRole = Pool().get('ace.role')
+        return AccessRole.get_entities(
+            [r.role for r in cls.browse([r.id for r in records])])
+
 
-class AccessPermission(ModelSQL, ModelView):
+class AccessPermission(AccessControlCaches, ModelSQL, ModelView):
     'Access Permission'
     __name__ = 'ace.permission'
     _history = True
@@ -5963,6 +8218,12 @@ class AccessPermission(ModelSQL, ModelView):
              'The code of the permission must be unique.'),
         ]
 
+    @classmethod
+    def clear_access_control_caches(cls):
+        AccessRole = Pool().get('ace.role')
+        super().clear_access_control_caches()
+        AccessRole._permission_bits_cache.clear()
+
 
 ##############################################################################
 # Type Mappings
@@ -5,6 +5,8 @@ from trytond.model import MultiValueMixin
 from trytond.pool import Pool
 from trytond.pyson import Id
 
+from .collecting_society import _transaction_memo, _clear_transaction_memo
+
 
 __all__ = ['Configuration']
 
@@ -80,6 +82,95 @@ class Configuration(ModelSingleton, ModelSQL, ModelView, MultiValueMixin):
     distribution_plan_sequence = fields.MultiValue(distribution_plan_sequence)
     harddisk_label_sequence = fields.MultiValue(harddisk_label_sequence)
     filesystem_label_sequence = fields.MultiValue(filesystem_label_sequence)
+    collection_workers = fields.Integer(
+        'Collection Workers',
+        help='The number of worker processes for a collection run')
+    distribution_move_lines = fields.Integer(
+        'Distribution Move Lines',
+        help='The maximum number of lines of an account move of a '
+        'distribution')
+    effective_permissions = fields.Boolean(
+        'Effective Permissions',
+        help='Materialize the direct and derived permissions of the web '
+        'users for fast authorization checks')
+
+    @staticmethod
+    def default_collection_workers():
+        return 1
+
+    @staticmethod
+    def default_distribution_move_lines():
+        return 1000
+
+    @classmethod
+    def get_cached(cls):
+        """
+        Returns the configuration
+
+        The instance is memoized for the rest of the transaction, so its
+        values are read only once. The memo is cleared on modifications.
+        """
+        memo = _transaction_memo(cls.__name__)
+        if 'singleton' not in memo:
+            memo['singleton'] = cls(1)
+        return memo['singleton']
+
+    @classmethod
+    def get_sequence(cls, name):
+        """
+        Returns a sequence of the configuration
+
+        All sequences are resolved with one read, including their defaults,
+        and memoized for the rest of the transaction.
+
+        Args:
+            name: the name of the sequence field, e.g. artist_sequence
+        """
+        Sequence = Pool().get('ir.sequence')
+        memo = _transaction_memo(cls.__name__)
+        if 'sequences' not in memo:
+            names = [
+                n for n, f in cls._fields.items()
+                if isinstance(f, fields.MultiValue)
+                and n.endswith('_sequence')]
+            values, = cls.read([cls.get_cached().id], names)
+            memo['sequences'] = {
+                n: Sequence(values[n]) if values[n] is not None else None
+                for n in names}
+        return memo['sequences'][name]
+
+    @classmethod
+    def set_codes(cls, vlist, sequence_name, field='code'):
+        """
+        Sets the missing codes of the values to create from a sequence
+
+        The codes are reserved from the sequence with one operation.
+
+        Args:
+            vlist: list of values to create
+            sequence_name: the name of the sequence field, e.g. artist_sequence
+            field: the name of the code field
+        """
+        missing = [v for v in vlist if not v.get(field)]
+        if not missing:
+            return
+        sequence = cls.get_sequence(sequence_name)
+        for values, code in zip(missing, sequence.get_many(len(missing))):
+            values[field] = code
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        _clear_transaction_memo(cls.__name__)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        AccessControlEffective = Pool().get('ace.effective')
+        super().write(*args)
+        _clear_transaction_memo(cls.__name__)
+        if any('effective_permissions' in v for v in args[1::2]):
+            AccessControlEffective.update()
 
     @classmethod
     def default_artist_sequence(cls, **pattern):
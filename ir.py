@@ -0,0 +1,68 @@
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society
+from trytond.ir.sequence import sql_sequence
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Sequence', 'Cron']
+
+
+class Sequence(metaclass=PoolMeta):
+    __name__ = 'ir.sequence'
+
+    def get_many(self, count):
+        """
+        Returns the next values of the sequence
+
+        The numbers of an incremental sequence are reserved with one operation
+        instead of one round trip per value. Other sequence types fall back to
+        get().
+
+        Args:
+            count: the number of values
+
+        Returns:
+            list of sequence values (str)
+        """
+        cls = self.__class__
+        if count < 2 or self.type != 'incremental':
+            return [self.get() for _ in range(count)]
+        transaction = Transaction()
+        # bypass rules on sequences
+        with transaction.set_context(user=False, _check_access=False), \
+                transaction.set_user(0):
+            sequence = cls(self.id)
+            if sql_sequence and not sequence._strict:
+                cursor = transaction.connection.cursor()
+                cursor.execute(
+                    'SELECT nextval(%s) FROM generate_series(1, %s)',
+                    (sequence._sql_sequence_name, count))
+                numbers = [n for n, in cursor]
+            else:
+                cls.lock([sequence])
+                sequence = cls(self.id)
+                increment = sequence.number_increment
+                number_next = sequence.number_next_internal
+                cls.write([sequence], {
+                        'number_next_internal': (
+                            number_next + count * increment),
+                        })
+                numbers = range(
+                    number_next, number_next + count * increment, increment)
+            date = transaction.context.get('date')
+            prefix = cls._process(sequence.prefix, date=date)
+            suffix = cls._process(sequence.suffix, date=date)
+            return [
+                '%s%s%s' % (prefix, '%%0%sd' % sequence.padding % n, suffix)
+                for n in numbers]
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('device.message.fingerprint|match_queued',
+                'Match Fingerprints'))
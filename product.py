@@ -0,0 +1,53 @@
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['ProductTemplate', 'Product', 'ProductCategory']
+
+
+def clear_invoice_line_templates():
+    'Invalidates the invoice line templates of the tariff categories'
+    TariffCategory = Pool().get('tariff_system.category')
+    TariffCategory._invoice_line_templates_cache.clear()
+
+
+class ProductTemplate(metaclass=PoolMeta):
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductTemplate, cls).write(*args)
+        clear_invoice_line_templates()
+
+    @classmethod
+    def delete(cls, templates):
+        super(ProductTemplate, cls).delete(templates)
+        clear_invoice_line_templates()
+
+
+class Product(metaclass=PoolMeta):
+    __name__ = 'product.product'
+
+    @classmethod
+    def write(cls, *args):
+        super(Product, cls).write(*args)
+        clear_invoice_line_templates()
+
+    @classmethod
+    def delete(cls, products):
+        super(Product, cls).delete(products)
+        clear_invoice_line_templates()
+
+
+class ProductCategory(metaclass=PoolMeta):
+    __name__ = 'product.category'
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductCategory, cls).write(*args)
+        clear_invoice_line_templates()
+
+    @classmethod
+    def delete(cls, categories):
+        super(ProductCategory, cls).delete(categories)
+        clear_invoice_line_templates()
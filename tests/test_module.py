@@ -1,12 +1,1448 @@
 # For copyright and license terms, see COPYRIGHT.rst (top level of repository)
 # Repository: https://github.com/C3S/collecting_society
+import datetime
+import json
+import threading
+import time
+from decimal import Decimal
+from fractions import Fraction
+from unittest.mock import patch
 
-from trytond.tests.test_tryton import ModuleTestCase
+import requests
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.collecting_society.collecting_society import (
+    COLLECT_CHUNK_SIZE, DEFAULT_ACCESS_ROLES, _transaction_memo)
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class CollectingSocietyModuleTestCase(ModuleTestCase):
     'Test Collecting Society module'
     module = 'collecting_society'
 
+    @with_transaction()
+    def test_configuration_cached(self):
+        'Test configuration is memoized per transaction'
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+
+        config = Configuration.get_cached()
+        self.assertIs(Configuration.get_cached(), config)
+        sequence = Configuration.get_sequence('artist_sequence')
+        self.assertTrue(sequence)
+        self.assertEqual(
+            Configuration.get_sequence('artist_sequence'), sequence)
+        self.assertEqual(config.collection_workers, 1)
+
+    @with_transaction()
+    def test_sequence_get_many(self):
+        'Test reserving the codes of a batch from a sequence'
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+        Sequence = pool.get('ir.sequence')
+        SequenceType = pool.get('ir.sequence.type')
+
+        sequence_type, = SequenceType.search([], limit=1)
+        sequence, = Sequence.create([{
+                    'name': 'Test',
+                    'sequence_type': sequence_type.id,
+                    'prefix': 'T',
+                    'padding': 3,
+                    'number_increment': 2,
+                    }])
+        self.assertEqual(sequence.get_many(0), [])
+        self.assertEqual(sequence.get_many(1), ['T001'])
+        self.assertEqual(sequence.get_many(3), ['T003', 'T005', 'T007'])
+        self.assertEqual(sequence.get(), 'T009')
+
+        vlist = [{'code': 'C1'}, {}, {'code': None}]
+        Configuration.set_codes(vlist, 'creation_sequence')
+        self.assertEqual(vlist[0], {'code': 'C1'})
+        codes = [v['code'] for v in vlist[1:]]
+        self.assertTrue(all(codes))
+        self.assertEqual(len(set(codes)), 2)
+
+    def _create_location(self, **values):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Category = pool.get('location.category')
+        Location = pool.get('location')
+
+        party, = Party.create([{'name': 'Venue'}])
+        category, = Category.create([{'name': 'Club', 'code': 'C'}])
+        values.update({
+                'name': 'Venue',
+                'category': category.id,
+                'party': party.id,
+                'entity_creator': party.id,
+                })
+        location, = Location.create([values])
+        return location
+
+    @with_transaction()
+    def test_indicators_get(self):
+        'Test shortcut fields read the indicators of their sample'
+        pool = Pool()
+        Location = pool.get('location')
+        Indicators = pool.get('location.indicators')
+
+        self.assertEqual(
+            Location.estimated_turnover_gastronomy._sample_name, 'estimated')
+        self.assertEqual(
+            Location.confirmed_turnover_gastronomy._sample_name, 'confirmed')
+
+        location = self._create_location()
+        Indicators.write([location.estimated_indicators], {
+                'turnover_gastronomy': Decimal('10')})
+        Indicators.write([location.confirmed_indicators], {
+                'turnover_gastronomy': Decimal('20')})
+        location = Location(location.id)
+        self.assertEqual(
+            location.estimated_turnover_gastronomy, Decimal('10'))
+        self.assertEqual(
+            location.confirmed_turnover_gastronomy, Decimal('20'))
+
+    @with_transaction()
+    def test_indicators_write(self):
+        'Test writing shortcut fields of both samples'
+        pool = Pool()
+        Location = pool.get('location')
+
+        location = self._create_location()
+        Location.write([location], {
+                'estimated_turnover_gastronomy': Decimal('10'),
+                'confirmed_turnover_gastronomy': Decimal('20'),
+                })
+        location = Location(location.id)
+        self.assertNotEqual(
+            location.estimated_indicators, location.confirmed_indicators)
+        self.assertEqual(
+            location.estimated_indicators.turnover_gastronomy, Decimal('10'))
+        self.assertEqual(
+            location.confirmed_indicators.turnover_gastronomy, Decimal('20'))
+
+    @with_transaction()
+    def test_indicators_create(self):
+        'Test creating with shortcut fields of both samples'
+        pool = Pool()
+        Location = pool.get('location')
+
+        location = self._create_location(
+            estimated_turnover_gastronomy=Decimal('10'),
+            confirmed_turnover_gastronomy=Decimal('20'))
+        self.assertNotEqual(
+            location.estimated_indicators, location.confirmed_indicators)
+        self.assertEqual(
+            location.estimated_indicators.turnover_gastronomy, Decimal('10'))
+        self.assertEqual(
+            location.confirmed_indicators.turnover_gastronomy, Decimal('20'))
+
+        copy, = Location.copy([location])
+        self.assertNotEqual(
+            copy.estimated_indicators, location.estimated_indicators)
+        self.assertNotEqual(
+            copy.confirmed_indicators, location.confirmed_indicators)
+
+    @with_transaction()
+    def test_indicators_search(self):
+        'Test searching shortcut fields of both samples'
+        pool = Pool()
+        Location = pool.get('location')
+
+        location = self._create_location(
+            estimated_turnover_gastronomy=Decimal('10'),
+            confirmed_turnover_gastronomy=Decimal('20'))
+        self.assertEqual(Location.search([
+                    ('estimated_turnover_gastronomy', '=', Decimal('10')),
+                    ]), [location])
+        self.assertEqual(Location.search([
+                    ('estimated_turnover_gastronomy', '=', Decimal('20')),
+                    ]), [])
+        self.assertEqual(Location.search([
+                    ('confirmed_turnover_gastronomy', '>', Decimal('15')),
+                    ]), [location])
+        self.assertEqual(Location.search([
+                    ('estimated_opening_hours', '=', None),
+                    ]), [location])
+
+    def _create_fiscalyear(self, company):
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+
+        create_chart(company)
+        fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+        return fiscalyear
+
+    def _create_move(self, party, account, other, amount, post=True):
+        pool = Pool()
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        Date = pool.get('ir.date')
+
+        journal, = Journal.search([('code', '=', 'REV')])
+        move, = Move.create([{
+                    'journal': journal.id,
+                    'period': Period.find(
+                        Transaction().context['company'], Date.today()),
+                    'date': Date.today(),
+                    'lines': [('create', [{
+                                    'party': party.id,
+                                    'account': account.id,
+                                    'credit': amount,
+                                    'debit': Decimal(0),
+                                    }, {
+                                    'account': other.id,
+                                    'credit': Decimal(0),
+                                    'debit': amount,
+                                    }])],
+                    }])
+        if post:
+            Move.post([move])
+        return move
+
+    @with_transaction()
+    def test_distribution_pocket(self):
+        'Test pocket balances resume from the last snapshot'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Distribution = pool.get('distribution')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Pocket = pool.get('distribution.pocket')
+
+        company = create_company()
+        with set_company(company):
+            self._create_fiscalyear(company)
+            pocket_account, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('party_required', '=', True),
+                    ], limit=1)
+            other, = Account.search([('type.revenue', '=', True)], limit=1)
+            party, = Party.create([{'name': 'Licensee'}])
+            distribution, = Distribution.create([{}])
+
+            self._create_move(party, pocket_account, other, Decimal(10))
+            pockets = Pocket.snapshot(distribution, [party], [pocket_account])
+            self.assertEqual(pockets[party.id].balance, Decimal(10))
+            self.assertEqual(pockets[party.id].budget, Decimal(10))
+
+            draft = self._create_move(
+                party, pocket_account, other, Decimal(5), post=False)
+            self._create_move(party, pocket_account, other, Decimal(3))
+            pockets = Pocket.snapshot(distribution, [party], [pocket_account])
+            self.assertEqual(pockets[party.id].balance, Decimal(10))
+            self.assertEqual(pockets[party.id].budget, Decimal(18))
+
+            # the lines of the draft move posted later are not skipped
+            Move.post([draft])
+            pockets = Pocket.get_pockets([party], [pocket_account])
+            self.assertEqual(pockets[party.id].balance, Decimal(18))
+            self.assertEqual(pockets[party.id].budget, Decimal(18))
+            # without pocket accounts only the last snapshot is resumed
+            self.assertEqual(
+                Pocket.get_pockets([party], [])[party.id].balance,
+                Decimal(10))
+
+    def _create_tariff(self, revenue, code='C'):
+        pool = Pool()
+        AccountCategory = pool.get('product.category')
+        Tariff = pool.get('tariff_system.tariff')
+        TariffCategory = pool.get('tariff_system.category')
+        TariffSystem = pool.get('tariff_system')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        account_category, = AccountCategory.create([{
+                    'name': 'Distribution',
+                    'accounting': True,
+                    'account_revenue': revenue.id,
+                    }])
+        unit, = Uom.search([('symbol', '=', 'u')])
+        template, = Template.create([{
+                    'name': 'Distribution',
+                    'default_uom': unit.id,
+                    'account_category': account_category.id,
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        tariff_category, = TariffCategory.create([{
+                    'name': 'Club',
+                    'code': code,
+                    'administration_product': product.id,
+                    'distribution_product': product.id,
+                    }])
+        system, = TariffSystem.create([{'version': '1.0-%s' % code}])
+        tariff, = Tariff.create([{
+                    'system': system.id,
+                    'category': tariff_category.id,
+                    }])
+        return tariff
+
+    def _create_declaration(self, licensee, tariff):
+        Declaration = Pool().get('declaration')
+
+        declaration, = Declaration.create([{
+                    'licensee': licensee.id,
+                    'creation_time': datetime.datetime(2020, 1, 1),
+                    'state': 'created',
+                    'period': 'onetime',
+                    'tariff': tariff.id,
+                    }])
+        return declaration
+
+    def _create_collection(self):
+        pool = Pool()
+        Collection = pool.get('collection')
+        User = pool.get('res.user')
+
+        collection, = Collection.create([{
+                    'date': datetime.date(2020, 2, 1),
+                    'time': datetime.datetime(2020, 2, 1),
+                    'entity_origin': 'automatic',
+                    'entity_creator': User(Transaction().user).id,
+                    }])
+        return collection
+
+    def _create_utilisations(self, tariff, licensees, **values):
+        Utilisation = Pool().get('utilisation')
+
+        declarations = {}
+        utilisations = []
+        for licensee in licensees:
+            if licensee not in declarations:
+                declarations[licensee] = self._create_declaration(
+                    licensee, tariff)
+            utilisations += Utilisation.create([dict({
+                            'declaration': declarations[licensee].id,
+                            'licensee': licensee.id,
+                            'tariff': tariff.id,
+                            'start': datetime.datetime(2020, 1, 15),
+                            }, **values)])
+        return utilisations
+
+    def _create_distribution_data(self, company, amount):
+        pool = Pool()
+        Account = pool.get('account.account')
+        Allocation = pool.get('allocation')
+        Artist = pool.get('artist')
+        Creation = pool.get('creation')
+        CreationList = pool.get('utilisation.creationlist')
+        DistributionPlan = pool.get('distribution.plan')
+        Party = pool.get('party.party')
+        Space = pool.get('location.space')
+        SpaceCategory = pool.get('location.space.category')
+        Utilisation = pool.get('utilisation')
+
+        self._create_fiscalyear(company)
+        revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+        expense, = Account.search([('type.expense', '=', True)], limit=1)
+        tariff = self._create_tariff(revenue)
+        plan, = DistributionPlan.create([{'version': '1.0'}])
+
+        licensee, composer, performer = [
+            Party.create([{'name': name}])[0]
+            for name in ['Licensee', 'Composer', 'Performer']]
+        artists = [Artist.create([{
+                        'name': party.name,
+                        'party': party.id,
+                        'entity_creator': party.id,
+                        }])[0] for party in [composer, performer]]
+        creations = [Creation.create([{
+                        'title': 'Song %s' % artist.name,
+                        'artist': artist.id,
+                        'entity_creator': artist.party.id,
+                        }])[0] for artist in artists]
+        space_category, = SpaceCategory.create([{
+                    'name': 'Dancefloor',
+                    'code': 'D',
+                    }])
+        space, = Space.create([{
+                    'location': self._create_location().id,
+                    'category': space_category.id,
+                    }])
+        creation_list, = CreationList.create([{
+                    'start': datetime.datetime(2020, 1, 1),
+                    'context': str(space),
+                    'items': [('create', [{
+                                    'creation': creations[0].id,
+                                    'weight': 2,
+                                    }, {
+                                    'creation': creations[1].id,
+                                    'weight': 1,
+                                    }])],
+                    }])
+        declaration = self._create_declaration(licensee, tariff)
+        collection = self._create_collection()
+        allocation, = Allocation.create([{
+                    'state': 'collected',
+                    'licensee': licensee.id,
+                    'collection': collection.id,
+                    }])
+        Utilisation.create([{
+                    'declaration': declaration.id,
+                    'licensee': licensee.id,
+                    'tariff': tariff.id,
+                    'distribution_plan': plan.id,
+                    'creation_list': creation_list.id,
+                    'allocation': allocation.id,
+                    'start': datetime.datetime(2020, 1, 15),
+                    'confirmed_distribution_amount': Decimal('9'),
+                    'confirmed_administration_fee': Decimal('1'),
+                    }])
+        self._create_move(licensee, revenue, expense, amount)
+        return allocation, revenue, artists
+
+    def _start_distribute(self):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Distribute = pool.get('distribution.distribute', type='wizard')
+
+        session_id, _, _ = Distribute.create()
+        distribute = Distribute(session_id)
+        distribute.start.date = Date.today()
+        distribute.start.from_date = datetime.date(2020, 1, 1)
+        distribute.start.thru_date = datetime.date(2020, 1, 31)
+        return distribute
+
+    @with_transaction()
+    def test_distribute_calculate(self):
+        'Test calculating the hat credits of collected allocations'
+        pool = Pool()
+        Pocket = pool.get('distribution.pocket')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            allocation, account, artists = self._create_distribution_data(
+                company, Decimal('9'))
+            distribute = self._start_distribute()
+
+            party_utilisations = distribute._get_party_utilisations()
+            self.assertEqual(
+                list(party_utilisations), [allocation.licensee.id])
+            accounts = distribute._get_pocket_accounts()
+            self.assertEqual(list(accounts.values()), [account])
+            pockets = Pocket.get_pockets(
+                Party.browse(party_utilisations), accounts.values())
+            self.assertEqual(
+                distribute._calculate(party_utilisations, pockets, accounts),
+                [(allocation, Decimal('9'), Decimal('1'), {account.id: {
+                                artists[0].id: Decimal('6'),
+                                artists[1].id: Decimal('3'),
+                                }})])
+
+            # the pocket of the licensee does not cover the amount
+            pockets[allocation.licensee.id].balance = Decimal('8')
+            self.assertEqual(
+                distribute._calculate(party_utilisations, pockets, accounts),
+                [])
+
+    @with_transaction()
+    def test_distribute_wizard(self):
+        'Test simulating and running the distribute wizard'
+        pool = Pool()
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Pocket = pool.get('distribution.pocket')
+
+        company = create_company()
+        with set_company(company):
+            allocation, account, artists = self._create_distribution_data(
+                company, Decimal('9'))
+            Journal.create([{
+                        'name': 'Transfer',
+                        'code': 'TRANS',
+                        'type': 'general',
+                        }])
+            distribute = self._start_distribute()
+
+            report = distribute.default_report(None)
+            self.assertEqual(report['utilisations'], 1)
+            self.assertEqual(report['parties'], 1)
+            self.assertEqual(report['artists'], 2)
+            self.assertEqual(report['amount'], Decimal('9'))
+            self.assertEqual(report['fee_amount'], Decimal('1'))
+            rows = report['report'].decode('utf-8').splitlines()
+            self.assertEqual(rows[0], 'type,code,name,amount')
+            self.assertEqual(rows[1], 'fee,%s,Licensee,1.00' % (
+                    allocation.licensee.code))
+            self.assertEqual(rows[2:], [
+                    'hat,%s,%s,%s' % (artist.code, artist.name, amount)
+                    for artist, amount in zip(artists, ['6.00', '3.00'])])
+            # the simulation does not write records
+            self.assertFalse(Pocket.search([]))
+            self.assertIsNone(allocation.distribution)
+
+            self.assertEqual(distribute.transition_distribute(), 'end')
+            self.assertTrue(allocation.distribution)
+            self.assertEqual(len(Pocket.search([])), 1)
+            move, = Move.search([('origin', '=', str(allocation))])
+            self.assertEqual(
+                sorted(
+                    (line.account, line.party, line.artist, line.debit,
+                        line.credit)
+                    for line in move.lines if line.artist), [
+                    (artist.party.account_payable_used, artist.party, artist,
+                        Decimal(0), Decimal(amount))
+                    for artist, amount in zip(artists, [6, 3])])
+            pocket_line, = [
+                line for line in move.lines if not line.artist]
+            self.assertEqual(pocket_line.account, account)
+            self.assertEqual(pocket_line.party, allocation.licensee)
+            self.assertEqual(pocket_line.debit, Decimal('9'))
+
+            # the distributed allocation is not distributed again
+            self.assertEqual(
+                self._start_distribute().default_report(None)['amount'], 0)
+
+    @with_transaction()
+    def test_distribute_share_vectors(self):
+        'Test derivative shares are read from the distribution plan'
+        pool = Pool()
+        Artist = pool.get('artist')
+        Creation = pool.get('creation')
+        Derivative = pool.get('creation.original.derivative')
+        Distribute = pool.get('distribution.distribute', type='wizard')
+        DistributionPlan = pool.get('distribution.plan')
+        Party = pool.get('party.party')
+
+        creations = []
+        for name in ['Original', 'Remix']:
+            party, = Party.create([{'name': name}])
+            artist, = Artist.create([{
+                        'name': name,
+                        'party': party.id,
+                        'entity_creator': party.id,
+                        }])
+            creations.extend(Creation.create([{
+                            'title': name,
+                            'artist': artist.id,
+                            'entity_creator': party.id,
+                            }]))
+        original, remix = creations
+        # the cyclic relation back to the remix is skipped
+        for original_creation, derivative_creation in [
+                (original, remix), (remix, original)]:
+            Derivative.create([{
+                        'original_creation': original_creation.id,
+                        'derivative_creation': derivative_creation.id,
+                        'allocation_type': 'remix',
+                        }])
+        plan, = DistributionPlan.create([{
+                    'version': '1.0',
+                    'remix_share': Decimal('0.5'),
+                    }])
+        other_plan, = DistributionPlan.create([{'version': '2.0'}])
+
+        vectors = Distribute._get_share_vectors([
+                (plan.id, remix.id), (other_plan.id, remix.id)])
+        self.assertEqual(vectors, {
+                (plan.id, remix.id): {
+                    original.artist.id: Fraction(1, 2),
+                    remix.artist.id: Fraction(1, 2),
+                    },
+                (other_plan.id, remix.id): {
+                    remix.artist.id: Fraction(1),
+                    },
+                })
+
+    @with_transaction()
+    def test_distribute_share_vectors_cycle(self):
+        'Test the shares of derivatives on a cycle are path independent'
+        pool = Pool()
+        Creation = pool.get('creation')
+        Derivative = pool.get('creation.original.derivative')
+        Distribute = pool.get('distribution.distribute', type='wizard')
+        DistributionPlan = pool.get('distribution.plan')
+
+        first, second = [Creation.create([{
+                        'title': artist.name,
+                        'artist': artist.id,
+                        'entity_creator': artist.party.id,
+                        }])[0] for artist in [
+                    self._create_artist(name)
+                    for name in ['First', 'Second']]]
+        Derivative.create([{
+                    'original_creation': original.id,
+                    'derivative_creation': derivative.id,
+                    'allocation_type': 'remix',
+                    } for original, derivative in [
+                    (first, second), (second, first)]])
+        plan, = DistributionPlan.create([{
+                    'version': '1.0',
+                    'remix_share': Decimal('0.5'),
+                    }])
+        keys = [(plan.id, first.id), (plan.id, second.id)]
+
+        both = Distribute._get_share_vectors(keys)
+        for key in keys:
+            self.assertEqual(Distribute._get_share_vectors([key]), {
+                    key: both[key]})
+        self.assertEqual(both[keys[0]], {
+                first.artist.id: Fraction(1, 2),
+                second.artist.id: Fraction(1, 2),
+                })
+
+        # the order of the traversal does not change the vectors
+        originals = Distribute._get_originals([first.id, second.id])
+        vectors = Distribute._get_contribution_vectors([first.id, second.id])
+        shares = plan.original_shares
+        for order in [keys, keys[::-1]]:
+            memo = {}
+            for key in order:
+                vector, _ = Distribute._get_derived_vector(
+                    key[1], vectors, originals, shares, memo, set())
+                self.assertEqual(vector, both[key])
+
+    @with_transaction()
+    def test_distribute_split(self):
+        'Test splitting amounts by largest remainder'
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Distribute = pool.get('distribution.distribute', type='wizard')
+
+        currency = Currency(rounding=Decimal('0.01'))
+        # the exact amounts are 0.33833... and 0.67166...
+        self.assertEqual(Distribute._split(
+                {1: Decimal('1'), 2: Decimal('0.01')}, {
+                    1: {1: Fraction(1, 3), 2: Fraction(2, 3)},
+                    2: {1: Fraction(1, 2), 2: Fraction(1, 2)},
+                    }, currency),
+            {1: Decimal('0.34'), 2: Decimal('0.67')})
+
+    def _create_artist(self, name, web_user=False):
+        pool = Pool()
+        Artist = pool.get('artist')
+        Party = pool.get('party.party')
+        WebUser = pool.get('web.user')
+
+        party, = Party.create([{'name': name}])
+        if web_user:
+            WebUser.create([{
+                        'email': '%s@example.com' % name.lower(),
+                        'party': party.id,
+                        }])
+        artist, = Artist.create([{
+                    'name': name,
+                    'party': party.id,
+                    'entity_creator': party.id,
+                    }])
+        return artist
+
+    @with_transaction()
+    def test_effective_start_end_migration(self):
+        'Test migrating the effective start and end of utilisations'
+        pool = Pool()
+        Account = pool.get('account.account')
+        DistributionPlan = pool.get('distribution.plan')
+        Event = pool.get('event')
+        Party = pool.get('party.party')
+        Release = pool.get('release')
+        Utilisation = pool.get('utilisation')
+
+        artist = self._create_artist('Artist')
+        event, = Event.create([{
+                    'name': 'Concert',
+                    'location': self._create_location().id,
+                    'estimated_start': datetime.datetime(2020, 1, 10, 20),
+                    'estimated_end': datetime.datetime(2020, 1, 11, 2),
+                    }])
+        release, = Release.create([{
+                    'title': 'Album',
+                    'type': 'artist',
+                    'artists': [('add', [artist.id])],
+                    'entity_creator': artist.party.id,
+                    'production_date': datetime.date(2020, 1, 5),
+                    }])
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            plan, = DistributionPlan.create([{'version': '1.0'}])
+            licensee, = Party.create([{'name': 'Licensee'}])
+            utilisations = [self._create_utilisations(
+                        self._create_tariff(revenue, code), [licensee],
+                        distribution_plan=plan.id, context=str(context))[0]
+                for code, context in [
+                    ('C', release), ('L', event), ('P', event)]]
+        expected = [
+            (datetime.datetime(2020, 1, 5), datetime.datetime(2020, 1, 6)),
+            (event.start, event.end),
+            (datetime.datetime(2020, 1, 15), None),
+            ]
+        self.assertEqual(
+            [(u.effective_start, u.effective_end) for u in utilisations],
+            expected)
+
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'sqlite':
+            # SQLite refuses to drop indexed columns
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = ? AND sql LIKE ?",
+                (Utilisation._table, '%effective_%'))
+            for name, in cursor.fetchall():
+                cursor.execute('DROP INDEX "%s"' % name)
+        table_h = Utilisation.__table_handler__()
+        for name in ['effective_start', 'effective_end']:
+            table_h.drop_column(name)
+        Utilisation.__register__('collecting_society')
+        utilisations = Utilisation.browse([u.id for u in utilisations])
+        self.assertEqual(
+            [(u.effective_start, u.effective_end) for u in utilisations],
+            expected)
+
+    @with_transaction()
+    def test_access_permission_memo(self):
+        'Test permissions are memoized until the ACEs are modified'
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Artist = pool.get('artist')
+        Entry = pool.get('ace')
+        WebUser = pool.get('web.user')
+
+        artist, other = [
+            self._create_artist(name) for name in ['Artist', 'Other']]
+        web_user, = WebUser.create([{'email': 'member@example.com'}])
+        role, = AccessRole.search([('name', '=', 'Stakeholder')])
+        memo = _transaction_memo('ace.permission_bits')
+
+        self.assertFalse(artist.permits(web_user, 'view_artist'))
+        self.assertIn((web_user.id, str(artist)), memo)
+        Entry.create([{
+                    'web_user': web_user.id,
+                    'entity': str(artist),
+                    'roles': [('add', [role.id])],
+                    }])
+        self.assertNotIn((web_user.id, str(artist)), memo)
+
+        self.assertTrue(artist.permits(web_user, 'view_artist'))
+        self.assertFalse(artist.permits(web_user, 'edit_artist'))
+        self.assertFalse(artist.permits(None, 'view_artist'))
+        self.assertEqual(
+            artist.permissions(web_user, ['view_artist', 'edit_artist']),
+            ('view_artist',))
+        codes = Artist.get_permission_codes(web_user.id, [artist, other])
+        self.assertIn('view_artist', codes[str(artist)])
+        self.assertEqual(codes[str(other)], frozenset())
+
+        # the memoized bitsets are used for later checks
+        memo[(web_user.id, str(other))] = memo[(web_user.id, str(artist))]
+        self.assertTrue(other.permits(web_user, 'view_artist'))
+
+    @with_transaction()
+    def test_access_search_permitted(self):
+        'Test searching entities by permissions including derived ones'
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Artist = pool.get('artist')
+        Creation = pool.get('creation')
+        Entry = pool.get('ace')
+        WebUser = pool.get('web.user')
+
+        artist, other = [
+            self._create_artist(name) for name in ['Artist', 'Other']]
+        creation, other_creation, unrelated = [Creation.create([{
+                        'title': title,
+                        'artist': artist_.id,
+                        'entity_creator': artist_.party.id,
+                        }])[0] for title, artist_ in [
+                    ('Song', artist), ('Other Song', other),
+                    ('Unrelated Song', other)]]
+        web_user, stranger = [
+            WebUser.create([{'email': email}])[0]
+            for email in ['member@example.com', 'stranger@example.com']]
+        administrator, = AccessRole.search([('name', '=', 'Administrator')])
+        stakeholder, = AccessRole.search([('name', '=', 'Stakeholder')])
+        Entry.create([{
+                    'web_user': web_user.id,
+                    'entity': str(entity),
+                    'roles': [('add', [role.id])],
+                    } for entity, role in [
+                    (artist, administrator), (other_creation, stakeholder)]])
+
+        self.assertEqual(
+            Artist.search_permitted(web_user, 'view_artist'), [artist])
+        self.assertEqual(
+            Creation.search_permitted(
+                web_user, 'view_creation', order=[('title', 'ASC')]),
+            [other_creation, creation])
+        self.assertEqual(
+            Creation.search_permitted(
+                web_user.id, 'view_creation', [('artist', '=', other.id)]),
+            [other_creation])
+        self.assertEqual(
+            Creation.search_permitted(
+                web_user, 'edit_creation', count=True), 1)
+        self.assertEqual(
+            Creation.search_permitted(stranger, 'view_creation'), [])
+
+    @with_transaction()
+    def test_access_role_permission_bits_cache(self):
+        'Test role bitsets are only cleared by role modifications'
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Entry = pool.get('ace')
+        Permission = pool.get('ace.permission')
+        WebUser = pool.get('web.user')
+
+        artist = self._create_artist('Artist')
+        web_user, = WebUser.create([{'email': 'member@example.com'}])
+        role, = AccessRole.search([('name', '=', 'Stakeholder')])
+        AccessRole.get_permission_bits()
+        Entry.create([{
+                    'web_user': web_user.id,
+                    'entity': str(artist),
+                    'roles': [('add', [role.id])],
+                    }])
+        self.assertIsNotNone(AccessRole._permission_bits_cache.get('bits'))
+
+        permission, = Permission.create([{
+                    'code': 'test_permission',
+                    'entity': 'artist',
+                    }])
+        new_role, = AccessRole.create([{
+                    'name': 'Tester',
+                    'permissions': [('add', [permission.id])],
+                    }])
+        for Model, records in [
+                (AccessRole, [new_role]),
+                (Permission, [permission])]:
+            AccessRole.get_permission_bits()
+            Model.write(records, {'description': 'Changed'})
+            self.assertIsNone(AccessRole._permission_bits_cache.get('bits'))
+
+    @with_transaction()
+    def test_access_default_roles_memo(self):
+        'Test default roles are only looked up again on role modifications'
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Entry = pool.get('ace')
+
+        default_roles = AccessRole.search([
+                ('name', 'in', DEFAULT_ACCESS_ROLES)])
+        memo = _transaction_memo('ace.default_roles')
+        self.assertEqual(
+            sorted(Entry.get_default_role_ids()),
+            sorted(r.id for r in default_roles))
+
+        artist = self._create_artist('Artist', web_user=True)
+        entry, = Entry.search([('entity', '=', str(artist))])
+        self.assertEqual(entry.roles, tuple(default_roles))
+        self.assertIn('ids', memo)
+
+        AccessRole.create([{'name': 'Tester'}])
+        self.assertNotIn('ids', memo)
+
+    @with_transaction()
+    def test_access_artist_members(self):
+        'Test the ACEs of added and removed members of a group'
+        pool = Pool()
+        AccessRole = pool.get('ace.role')
+        Artist = pool.get('artist')
+        Entry = pool.get('ace')
+
+        band = self._create_artist('Band')
+        Artist.write([band], {'group': True})
+        singer, drummer = [
+            self._create_artist(name, web_user=True)
+            for name in ['Singer', 'Drummer']]
+        singer_user, drummer_user = [
+            a.party.web_user for a in [singer, drummer]]
+        self.assertFalse(Entry.search([('entity', '=', str(band))]))
+
+        Artist.write([band], {
+                'solo_artists': [('add', [singer.id, drummer.id])],
+                })
+        entries = Entry.search(
+            [('entity', '=', str(band))], order=[('id', 'ASC')])
+        self.assertEqual(
+            {e.web_user for e in entries}, {singer_user, drummer_user})
+        default_roles = AccessRole.search(
+            [('name', 'in', DEFAULT_ACCESS_ROLES)], order=[('id', 'ASC')])
+        for entry in entries:
+            self.assertEqual(
+                sorted(entry.roles, key=lambda r: r.id), default_roles)
+
+        Artist.write([band], {'solo_artists': [('remove', [singer.id])]})
+        entry, = Entry.search([('entity', '=', str(band))])
+        self.assertEqual(entry.web_user, drummer_user)
+
+        # adding again in the same write keeps the ACE
+        Artist.write([band], {
+                'solo_artists': [
+                    ('remove', [drummer.id]), ('add', [drummer.id])],
+                })
+        self.assertEqual(
+            Entry.search([('entity', '=', str(band))]), [entry])
+
+    @with_transaction()
+    def test_access_effective_create(self):
+        'Test effective permissions of new creations'
+        pool = Pool()
+        Configuration = pool.get('collecting_society.configuration')
+        Creation = pool.get('creation')
+        Effective = pool.get('ace.effective')
+
+        # the sequences are read from the defaults before the configuration
+        # record is inserted, as they have no multi value models to read
+        Configuration.get_sequence('creation_sequence')
+        configuration = Configuration.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*configuration.insert(
+                [configuration.id, configuration.effective_permissions],
+                [[1, True]]))
+        self.assertTrue(Effective.enabled())
+        artist = self._create_artist('Artist', web_user=True)
+        web_user = artist.party.web_user
+        creation, = Creation.create([{
+                    'title': 'Song',
+                    'artist': artist.id,
+                    'entity_creator': artist.party.id,
+                    }])
+        codes = Effective.get_permission_codes(web_user, [creation])
+        self.assertTrue(codes[str(creation)])
+
+        # the permissions of the creation were updated completely
+        Effective.update()
+        self.assertEqual(
+            Effective.get_permission_codes(web_user, [creation]), codes)
+
+    @with_transaction()
+    def test_collect_parallel_serial(self):
+        'Test collecting serially without a shared database'
+        Collection = Pool().get('collection')
+
+        collection = self._create_collection()
+        partitions = patch.object(
+            Collection, '_get_licensee_partitions',
+            side_effect=lambda count: [[1], [2]][:count])
+        for database_name in ['', ':memory:']:
+            with partitions, \
+                    patch.object(Collection, 'collect_chunks') as chunks, \
+                    self.assertLogs(
+                        'trytond.modules.collecting_society', 'WARNING'):
+                self.assertEqual(collection.collect_parallel(
+                        workers=2, database_name=database_name), [])
+                chunks.assert_called_once()
+
+    @with_transaction()
+    def test_collect_parallel_options(self):
+        'Test passing the loaded configuration to the workers'
+        Collection = Pool().get('collection')
+
+        collection = self._create_collection()
+        with patch.object(
+                    Collection, '_get_licensee_partitions',
+                    side_effect=lambda count: [[1], [2]][:count]), \
+                patch('multiprocessing.get_context') as get_context, \
+                patch.object(Transaction(), 'commit'):
+            processes = get_context.return_value.Pool.return_value
+            starmap = processes.__enter__.return_value.starmap
+            starmap.return_value = [[], []]
+            self.assertEqual(collection.collect_parallel(
+                    workers=2, database_name='test'), [])
+        (_, args), = [call.args for call in starmap.call_args_list]
+        self.assertEqual([a[0] for a in args], [
+                {s: dict(config.items(s)) for s in config.sections()}] * 2)
+        self.assertEqual([a[1] for a in args], ['test'] * 2)
+
+    @with_transaction()
+    def test_collect(self):
+        'Test collecting utilisations grouped by licensee'
+        pool = Pool()
+        Account = pool.get('account.account')
+        DistributionPlan = pool.get('distribution.plan')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            receivable, = Account.search(
+                [('type.receivable', '=', True)], limit=1)
+            tariff = self._create_tariff(revenue)
+            plan, = DistributionPlan.create([{'version': '1.0'}])
+            licensees = [Party.create([{
+                            'name': name,
+                            'account_receivable': receivable.id,
+                            }])[0] for name in ['Licensee 1', 'Licensee 2']]
+            utilisations = self._create_utilisations(
+                tariff, [licensees[1], licensees[0], licensees[1]],
+                distribution_plan=plan.id)
+            collection = self._create_collection()
+
+            allocations = collection.collect(utilisations)
+            self.assertEqual(
+                [a.licensee for a in allocations], licensees)
+            self.assertEqual(
+                [sorted(a.utilisations) for a in allocations],
+                [[utilisations[1]], sorted(utilisations[::2])])
+            self.assertEqual(
+                [a.invoice_amount for a in allocations], [1, 2])
+            self.assertEqual(
+                [a.collection for a in allocations], [collection] * 2)
+            self.assertEqual(collection.collect([]), [])
+
+    @with_transaction()
+    def test_collect_wizard(self):
+        'Test collecting the filtered utilisations in chunks'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Collect = pool.get('utilisation.allocation.collect', type='wizard')
+        Collection = pool.get('collection')
+        DistributionPlan = pool.get('distribution.plan')
+        Party = pool.get('party.party')
+        Utilisation = pool.get('utilisation')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            receivable, = Account.search(
+                [('type.receivable', '=', True)], limit=1)
+            tariff = self._create_tariff(revenue)
+            plan, = DistributionPlan.create([{'version': '1.0'}])
+            licensees = [Party.create([{
+                            'name': name,
+                            'account_receivable': receivable.id,
+                            }])[0] for name in ['Licensee 1', 'Licensee 2']]
+            self._create_utilisations(
+                tariff, [licensees[0], licensees[1], licensees[0]],
+                distribution_plan=plan.id)
+            # the declarations add utilisations, too
+            utilisations = Utilisation.search(
+                [('licensee', '=', licensees[0].id)], order=[('id', 'ASC')])
+
+            session_id, _, _ = Collect.create()
+            collect = Collect(session_id)
+            self.assertEqual(collect.default_start(None), {
+                    'state': 'confirmed',
+                    'chunk_size': COLLECT_CHUNK_SIZE,
+                    })
+            collect.start.collection = None
+            collect.start.utilisations = []
+            collect.start.from_date = datetime.date(2020, 1, 1)
+            collect.start.thru_date = datetime.date(2020, 1, 31)
+            collect.start.licensee = licensees[0]
+            collect.start.tariff_category = tariff.category
+            collect.start.state = None
+            collect.start.chunk_size = 1
+            # every chunk is committed
+            with patch.object(Transaction, 'commit') as commit:
+                collect.transition_collect()
+            self.assertEqual(commit.call_count, len(utilisations))
+
+            collection, = Collection.search([])
+            self.assertFalse(collection.locked)
+            self.assertEqual(collection.cursor, utilisations[-1].id)
+            self.assertEqual(
+                [a.licensee for a in collection.allocations],
+                [licensees[0]] * len(utilisations))
+            self.assertEqual(
+                sorted(
+                    u for a in collection.allocations
+                    for u in a.utilisations),
+                utilisations)
+            self.assertFalse(Utilisation.search([
+                        ('licensee', '=', licensees[1].id),
+                        ('allocation', '!=', None),
+                        ]))
+
+    @with_transaction()
+    def test_allocation_create_invoices(self):
+        'Test invoicing the confirmed utilisations of allocations'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Allocation = pool.get('allocation')
+        DistributionPlan = pool.get('distribution.plan')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            receivable, = Account.search(
+                [('type.receivable', '=', True)], limit=1)
+            tariff = self._create_tariff(revenue)
+            plan, = DistributionPlan.create([{'version': '1.0'}])
+            licensees = [Party.create([{
+                            'name': name,
+                            'account_receivable': receivable.id,
+                            'addresses': [('create', [{}])],
+                            }])[0] for name in ['Licensee 1', 'Licensee 2']]
+            confirmed = self._create_utilisations(
+                tariff, [licensees[0]] * 2,
+                distribution_plan=plan.id,
+                state='confirmed',
+                confirmed_distribution_amount=Decimal('9'),
+                confirmed_administration_fee=Decimal('1'))
+            created = self._create_utilisations(
+                tariff, [licensees[1]], distribution_plan=plan.id)
+            collection = self._create_collection()
+            allocations = [Allocation.create([{
+                            'state': 'calculated',
+                            'licensee': licensee.id,
+                            'collection': collection.id,
+                            'utilisations': [
+                                ('add', [u.id for u in utilisations])],
+                            }])[0] for licensee, utilisations in zip(
+                        licensees, [confirmed, created])]
+
+            self.assertEqual(Allocation.create_invoices([]), [])
+            invoice, = Allocation.create_invoices(allocations)
+            self.assertEqual(invoice.party, licensees[0])
+            self.assertEqual(invoice.account, receivable)
+            self.assertEqual(invoice.type, 'out')
+            self.assertEqual(len(invoice.lines), 4)
+            self.assertEqual(
+                sorted(line.unit_price for line in invoice.lines),
+                [Decimal('1'), Decimal('1'), Decimal('9'), Decimal('9')])
+            self.assertEqual(
+                {line.origin for line in invoice.lines}, set(confirmed))
+            self.assertEqual(invoice.untaxed_amount, Decimal('20'))
+            self.assertEqual(Invoice.search([]), [invoice])
+
+    @with_transaction()
+    def test_tariff_category_invoice_line_templates(self):
+        'Test caching the invoice line templates of tariff categories'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AccountCategory = pool.get('product.category')
+        AccountConfiguration = pool.get('account.configuration')
+        TariffCategory = pool.get('tariff_system.category')
+        Tax = pool.get('account.tax')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company, tax=True)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            category = self._create_tariff(revenue).category
+            product = category.distribution_product
+            cache = TariffCategory._invoice_line_templates_cache
+            key = (category.id, company.id)
+
+            templates = TariffCategory.get_invoice_line_templates([category])
+            self.assertEqual(
+                [price_field for price_field, _ in templates[category.id]], [
+                    'confirmed_distribution_amount',
+                    'confirmed_administration_fee',
+                    ])
+            for _, values in templates[category.id]:
+                self.assertEqual(values['product'], product.id)
+                self.assertEqual(values['account'], revenue.id)
+                self.assertEqual(values['unit'], product.default_uom.id)
+            self.assertEqual(cache.get(key), templates[category.id])
+
+            # modified products invalidate the templates
+            Template.write([product.template], {'list_price': Decimal('5')})
+            self.assertIsNone(cache.get(key))
+            templates = TariffCategory.get_invoice_line_templates([category])
+            self.assertEqual(
+                {v['unit_price'] for _, v in templates[category.id]},
+                {Decimal('5')})
+
+            # so do modified accounts, taxes and account configurations
+            tax, = Tax.search([])
+            for Model, records, values in [
+                    (Account, [revenue], {'name': 'Revenue'}),
+                    (Tax, [tax], {'rate': Decimal('.1')}),
+                    (AccountConfiguration, [AccountConfiguration(1)],
+                        {'default_category_account_revenue': revenue.id}),
+                    ]:
+                TariffCategory.get_invoice_line_templates([category])
+                Model.write(records, values)
+                self.assertIsNone(cache.get(key))
+
+            AccountCategory.write(
+                [product.account_category], {'account_revenue': None})
+            with self.assertRaises(UserError):
+                TariffCategory.get_invoice_line_templates([category])
+
+    @with_transaction()
+    def test_distribute_contribution_vectors(self):
+        'Test splitting creations by the contributions of their artists'
+        pool = Pool()
+        Creation = pool.get('creation')
+        Distribute = pool.get('distribution.distribute', type='wizard')
+
+        band, composer, texter, singer, drummer = [
+            self._create_artist(name) for name in [
+                'Band', 'Composer', 'Texter', 'Singer', 'Drummer']]
+        song, unclaimed = [Creation.create([{
+                        'title': title,
+                        'artist': band.id,
+                        'entity_creator': band.party.id,
+                        'contributions': [('create', contributions)],
+                        }])[0] for title, contributions in [
+                    ('Song', [{
+                                'artist': composer.id,
+                                'type': 'composition',
+                                }, {
+                                'artist': texter.id,
+                                'type': 'text',
+                                }, {
+                                'artist': singer.id,
+                                'type': 'performance',
+                                'performance': 'recording',
+                                }, {
+                                'artist': drummer.id,
+                                'type': 'performance',
+                                'performance': 'recording',
+                                }]),
+                    ('Unclaimed', []),
+                    ]]
+
+        vectors = Distribute._get_contribution_vectors(
+            [song.id, unclaimed.id])
+        self.assertEqual(vectors, {
+                song.id: {
+                    composer.id: Fraction(13, 40),
+                    texter.id: Fraction(7, 40),
+                    singer.id: Fraction(1, 4),
+                    drummer.id: Fraction(1, 4),
+                    },
+                unclaimed.id: {band.id: Fraction(1)},
+                })
+        self.assertEqual(sum(vectors[song.id].values()), 1)
+
+    @with_transaction()
+    def test_effective_start_end(self):
+        'Test materializing the start and end of events and utilisations'
+        pool = Pool()
+        Account = pool.get('account.account')
+        DistributionPlan = pool.get('distribution.plan')
+        Event = pool.get('event')
+        Party = pool.get('party.party')
+        TariffCategory = pool.get('tariff_system.category')
+        Utilisation = pool.get('utilisation')
+
+        start = datetime.datetime(2020, 1, 10, 20)
+        end = datetime.datetime(2020, 1, 11, 2)
+        event, = Event.create([{
+                    'name': 'Concert',
+                    'location': self._create_location().id,
+                    'estimated_start': start,
+                    'estimated_end': end,
+                    }])
+        self.assertEqual(
+            (event.effective_start, event.effective_end), (start, end))
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('type.revenue', '=', True)], limit=1)
+            tariff = self._create_tariff(revenue, 'P')
+            plan, = DistributionPlan.create([{'version': '1.0'}])
+            licensee, = Party.create([{'name': 'Licensee'}])
+            utilisation, = self._create_utilisations(
+                tariff, [licensee], distribution_plan=plan.id,
+                context=str(event))
+            # the dates of other tariff categories are entered manually
+            self.assertEqual(utilisation.effective_start, utilisation.start)
+            self.assertEqual(
+                utilisation.effective_start, datetime.datetime(2020, 1, 15))
+
+            # live utilisations take the dates of the event
+            TariffCategory.write([tariff.category], {'code': 'L'})
+            utilisation = Utilisation(utilisation.id)
+            self.assertEqual(
+                (utilisation.effective_start, utilisation.effective_end),
+                (start, end))
+
+            confirmed = start + datetime.timedelta(hours=1)
+            Event.write([event], {'confirmed_start': confirmed})
+            event = Event(event.id)
+            self.assertEqual(
+                (event.effective_start, event.effective_end),
+                (confirmed, end))
+            utilisation = Utilisation(utilisation.id)
+            self.assertEqual(utilisation.start, confirmed)
+            self.assertEqual(Utilisation.search([
+                        ('id', '=', utilisation.id),
+                        ('start', '>=', confirmed),
+                        ]), [utilisation])
+
+            # without a confirmed end, the estimated end is effective
+            later = end + datetime.timedelta(hours=1)
+            Event.write([event], {'estimated_end': later})
+            self.assertEqual(Event(event.id).end, later)
+            self.assertEqual(Event.search([('end', '=', later)]), [event])
+            self.assertEqual(Utilisation(utilisation.id).end, later)
+
+    def _create_response(self, status_code, content):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = content.encode('utf-8')
+        return response
+
+    @with_transaction()
+    def test_fingerprint_query_services(self):
+        'Test querying the fingerprint services concurrently'
+        pool = Pool()
+        Creation = pool.get('creation')
+        Fingerprint = pool.get('device.message.fingerprint')
+
+        service = Fingerprint.fingerprint_services['echoprint']['1.0.0']
+        fingerprints = [
+            Fingerprint(data='code%s' % i) for i in range(12)]
+        lock = threading.Lock()
+        in_flight = []
+        concurrency = []
+
+        def post(session, url, data=None, verify=None, timeout=None):
+            with lock:
+                in_flight.append(data)
+                concurrency.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(data)
+            if data['fp_code'] == b'code3':
+                raise requests.exceptions.Timeout()
+            return self._create_response(200, json.dumps({
+                        'score': 60,
+                        'track_id': data['fp_code'].decode('utf-8'),
+                        }))
+
+        self.assertEqual(Fingerprint.query_services([]), [])
+        with patch.object(requests.Session, 'post', post):
+            responses = Fingerprint.query_services(
+                [(f, service) for f in fingerprints])
+        self.assertEqual(len(responses), len(fingerprints))
+        self.assertIsInstance(responses[3], requests.exceptions.Timeout)
+        self.assertIsNone(Fingerprint.parse_response(responses[3]))
+        results = [Fingerprint.parse_response(r) for r in responses]
+        self.assertEqual(
+            [r['track_id'] for r in results if r],
+            ['code%s' % i for i in range(12) if i != 3])
+        self.assertLessEqual(max(concurrency), Fingerprint._match_workers)
+        self.assertGreater(max(concurrency), 1)
+
+        for response in [
+                self._create_response(500, '{}'),
+                self._create_response(200, 'no json'),
+                self._create_response(200, '{"score": 60}')]:
+            self.assertIsNone(Fingerprint.parse_response(response))
+
+        creation = Creation(1)
+        creations = {'1': creation}
+        for result, match in [
+                ({'score': 10, 'track_id': '1'}, ('fail_score', None)),
+                ({'score': 60, 'track_id': ''}, ('fail_code', None)),
+                ({'score': 60, 'track_id': '2'}, ('fail_creation', None)),
+                ({'score': 60, 'track_id': '1'}, ('success', creation))]:
+            self.assertEqual(
+                Fingerprint.get_match(service, result, creations), match)
+
+    @with_transaction()
+    def test_fingerprint_match_queued(self):
+        'Test matching the queued fingerprints in committed batches'
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        Device = pool.get('device')
+        Fingerprint = pool.get('device.message.fingerprint')
+        Space = pool.get('location.space')
+        SpaceCategory = pool.get('location.space.category')
+        WebUser = pool.get('web.user')
+
+        self.assertIn('device.message.fingerprint|match_queued', dict(
+                Cron.method.selection))
+        artist = self._create_artist('Artist')
+        creation, = pool.get('creation').create([{
+                    'title': 'Song',
+                    'artist': artist.id,
+                    'entity_creator': artist.party.id,
+                    }])
+        web_user, = WebUser.create([{'email': 'device@example.com'}])
+        device, = Device.create([{
+                    'uuid': 'device',
+                    'web_user': web_user.id,
+                    }])
+        space_category, = SpaceCategory.create([{
+                    'name': 'Dancefloor',
+                    'code': 'D',
+                    }])
+        space, = Space.create([{
+                    'location': self._create_location().id,
+                    'category': space_category.id,
+                    }])
+        fingerprints = [Fingerprint.create([{
+                        'state': state,
+                        'matched_state': 'success',
+                        'timestamp': datetime.datetime(2020, 1, 1),
+                        'algorithm': algorithm,
+                        'version': '1.0.0',
+                        'data': data,
+                        'message': [('create', [{
+                                        'device': device.id,
+                                        'timestamp': datetime.datetime(
+                                            2020, 1, 1),
+                                        'direction': 'incoming',
+                                        'category': 'fingerprint',
+                                        'context': str(space),
+                                        }])],
+                        }])[0] for state, algorithm, data in [
+                    ('created', 'echoprint', 'match'),
+                    ('created', 'echoprint', 'low'),
+                    ('created', 'unknown', 'match'),
+                    ('created', 'echoprint', 'error'),
+                    ('matched', 'echoprint', 'match'),
+                    ]]
+        # the match selection has no empty value for unmatched fingerprints
+        fingerprint = Fingerprint.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*fingerprint.update(
+                [fingerprint.matched_state], [None],
+                where=fingerprint.state == 'created'))
+
+        def query_services(queries):
+            responses = []
+            for fingerprint, _ in queries:
+                if fingerprint.data == 'error':
+                    responses.append(requests.exceptions.ConnectionError())
+                    continue
+                responses.append(self._create_response(200, json.dumps({
+                                'score': 60 if fingerprint.data == 'match'
+                                else 10,
+                                'track_id': creation.id,
+                                })))
+            return responses
+
+        with patch.object(Fingerprint, '_match_batch_size', 2), \
+                patch.object(Fingerprint, 'query_services', query_services), \
+                patch.object(Transaction, 'commit') as commit:
+            progress = Fingerprint.match_queued()
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(progress, {
+                'success': 1,
+                'fail_score': 1,
+                'skipped': 1,
+                'error': 1,
+                })
+
+        fingerprints = Fingerprint.browse([f.id for f in fingerprints])
+        self.assertEqual(
+            [(f.state, f.matched_state) for f in fingerprints], [
+                ('matched', 'success'),
+                ('matched', 'fail_score'),
+                ('created', None),
+                ('created', None),
+                ('matched', 'success'),
+                ])
+        self.assertEqual(fingerprints[0].matched_creation, creation)
+        self.assertIsNone(fingerprints[1].matched_creation)
+
 
 del ModuleTestCase